@@ -0,0 +1,148 @@
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.site import SyntheticSite
+
+"""Benchmark the scanner against a synthetic site served on localhost, so
+results don't depend on the network or on somebody else's server.
+
+Every configuration (a combination of --threads, --engines, --parsers and
+--processes) scans the whole site on fresh processes, which are the ones
+measured: wall time, CPU time and peak RSS come from the kernel once they
+exit, request latencies from the --stats-file of the scanner and request
+counts from the site itself.
+
+Run it from the root of the repository:
+    $ python -m benchmarks.run --pages 500 --threads 4,16 --engines threads,async
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run_configuration(site, threads, engine, parser, extra_args, workdir, processes=1):
+    """Scan site with a configuration and return its measurements. With
+    more than one process, they split the scan over a shared frontier, and
+    are measured together: CPU time is their sum, peak RSS the largest and
+    request latencies those of the first one."""
+    database = os.path.join(workdir, 'xss.db')
+    frontier = os.path.join(workdir, 'frontier.db')
+    stats_paths = [os.path.join(workdir, 'stats{0}.json'.format(i)) for i in range(processes)]
+    for path in [database, frontier] + stats_paths:
+        if os.path.exists(path):
+            os.remove(path)
+    commands = []
+    for i, stats_path in enumerate(stats_paths):
+        command = [sys.executable, 'scanner.py', site.url, str(threads),
+                   '--engine', engine, '--parser', parser, '--database', database,
+                   '--stats-file', stats_path, '--progress-interval', '0'] + extra_args
+        if processes > 1:
+            command += ['--shared-frontier', frontier, '--shard', '{0}/{1}'.format(i, processes)]
+        else:
+            command += ['--frontier', frontier]
+        if engine == 'async':
+            command += ['--concurrency', str(threads)]
+        commands.append(command)
+    site.reset_stats()
+    start = time.perf_counter()
+    running = {subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL).pid: command
+               for command in commands}
+    cpu = peak_rss = 0
+    while running:
+        pid, status, usage = os.wait4(-1, 0)
+        command = running.pop(pid, None)
+        if command is None:
+            continue
+        if status:
+            raise RuntimeError("The scan failed: {0}".format(' '.join(command)))
+        cpu += usage.ru_utime + usage.ru_stime
+        peak_rss = max(peak_rss, usage.ru_maxrss)
+    wall = time.perf_counter() - start
+    with open(stats_paths[0]) as stats_file:
+        requests = json.load(stats_file)['stages'].get('request', {})
+    site_stats = site.stats.as_dict()
+    return dict(threads=threads, engine=engine, parser=parser, processes=processes,
+                pages=site_stats['page_requests'],
+                attack_requests=site_stats['attack_requests'],
+                errors=site_stats['errors'],
+                seconds=round(wall, 3),
+                pages_per_second=round(site_stats['page_requests'] / wall, 1),
+                attacks_per_second=round(site_stats['attack_requests'] / wall, 1),
+                p50_ms=requests.get('p50_ms', 0),
+                p99_ms=requests.get('p99_ms', 0),
+                peak_rss_mb=round(peak_rss / 1024, 1),  # KiB on Linux
+                cpu_seconds=round(cpu, 2),
+                cpu_percent=round(100 * cpu / wall, 1))
+
+COLUMNS = ('threads', 'engine', 'parser', 'processes', 'pages', 'attack_requests', 'seconds',
+           'pages_per_second', 'attacks_per_second', 'p50_ms', 'p99_ms',
+           'peak_rss_mb', 'cpu_percent')
+
+def print_table(results):
+    rows = [COLUMNS] + [tuple(str(result[column]) for column in COLUMNS)
+                        for result in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(COLUMNS))]
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
+
+def comma_separated(kind):
+    return lambda value: [kind(item) for item in value.split(',')]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=("Benchmark the scanner against a "
+                                                  "synthetic site on localhost."))
+    parser.add_argument("--pages", type=int, default=200, help="Pages on the site.")
+    parser.add_argument("--fanout", type=int, default=5, help="Links on every page.")
+    parser.add_argument("--forms", type=int, default=2, help="Forms on every page.")
+    parser.add_argument("--shared-forms", type=int, default=1,
+                        help="How many of the forms are the same on every page.")
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="Seconds the site takes to answer every request.")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with a 500.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the site links.")
+    parser.add_argument("--downloads", type=int, default=0,
+                        help="Binaries linked from the pages, see benchmarks/site.py.")
+    parser.add_argument("--download-size", type=float, default=10,
+                        help="Megabytes of every binary.")
+    parser.add_argument("--threads", type=comma_separated(int), default=[4, 16],
+                        help=("Comma separated threads to try. For the async engine, "
+                              "the concurrency."))
+    parser.add_argument("--engines", type=comma_separated(str), default=['threads'],
+                        help="Comma separated engines to try: threads, async.")
+    parser.add_argument("--parsers", type=comma_separated(str), default=['stream'],
+                        help="Comma separated parsers to try: stream, soup.")
+    parser.add_argument("--processes", type=comma_separated(int), default=[1],
+                        help=("Comma separated scanner processes to try. More than one "
+                              "split every scan over a shared frontier."))
+    parser.add_argument("--json", type=str, default=None,
+                        help="Also write the results to this file, as json.")
+    parser.add_argument("scanner_args", nargs=argparse.REMAINDER,
+                        help="Anything after -- is passed to scanner.py as is.")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    extra_args = [arg for arg in args.scanner_args if arg != '--']
+    site = SyntheticSite(args.pages, args.fanout, args.forms, args.shared_forms,
+                         args.latency, args.error_rate, args.seed,
+                         downloads=args.downloads,
+                         download_size=int(args.download_size * 1024 * 1024))
+    results = []
+    with site, tempfile.TemporaryDirectory() as workdir:
+        for threads, engine, parser, processes in itertools.product(
+                args.threads, args.engines, args.parsers, args.processes):
+            result = run_configuration(site, threads, engine, parser, extra_args, workdir,
+                                       processes)
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+import html
+import http.server
+import random
+import socketserver
+import threading
+import time
+import zlib
+from urllib.parse import urlsplit, parse_qsl
+
+"""A synthetic website to scan without touching the network. Pages are
+/page0 to /page{pages - 1}, /page0 being the home page (also served on /).
+Every page links to fanout other pages, chosen at random but always the
+same for a given seed, and has forms forms: the first shared_forms are the
+same on every page (think of a search box), the rest belong to that page.
+Every response takes latency seconds, and a random error_rate of them are
+500s. Pages have an ETag, and a conditional GET for an unchanged page gets
+a 304, unless etags is False. The first throttled requests get a 429
+instead, with a Retry-After header if retry_after is given, as a site
+rate limiting its clients would.
+
+If downloads is given, every page also links to one of /download0 to
+/download{downloads - 1}, binaries of download_size bytes: even ones are
+PDFs, odd ones are served as text/html, as misconfigured servers do.
+
+Forms tell apart XSS from what only looks like it: the answer to form 0 (a
+shared one, if any) shows the comment as it was sent, the answer to form 1
+shows it HTML escaped and the rest don't show it at all. So form 0 is the
+only one vulnerable.
+
+The site counts what it is asked for: page fetches (a GET of a page with
+no query), downloads and everything else, which can only be attacks.
+"""
+
+class SiteStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.page_requests = 0
+        self.download_requests = 0
+        self.attack_requests = 0
+        self.not_modified = 0
+        self.errors = 0
+        self.throttled = 0
+
+    def count_throttled(self):
+        with self._lock:
+            self.throttled += 1
+
+    def count(self, is_page, is_error, is_not_modified=False):
+        with self._lock:
+            if is_not_modified:
+                self.not_modified += 1
+            if is_page:
+                self.page_requests += 1
+            else:
+                self.attack_requests += 1
+            if is_error:
+                self.errors += 1
+
+    def count_download(self):
+        with self._lock:
+            self.download_requests += 1
+
+    def as_dict(self):
+        with self._lock:
+            return dict(page_requests=self.page_requests,
+                        download_requests=self.download_requests,
+                        attack_requests=self.attack_requests,
+                        not_modified=self.not_modified, errors=self.errors,
+                        throttled=self.throttled)
+
+class SyntheticSite:
+    """Serve the site on a background thread. Use start and stop, or as a
+    context manager."""
+    def __init__(self, pages=100, fanout=5, forms=2, shared_forms=1, latency=0.0,
+                 error_rate=0.0, seed=0, port=0, etags=True, downloads=0,
+                 download_size=10 * 1024 * 1024, throttled=0, retry_after=None):
+        self.pages = pages
+        self.fanout = fanout
+        self.forms = forms
+        self.shared_forms = shared_forms
+        self.latency = latency
+        self.error_rate = error_rate
+        self.etags = etags
+        self.downloads = downloads
+        self.download_size = download_size
+        self.throttled = throttled
+        self.retry_after = retry_after
+        self._throttle_lock = threading.Lock()
+        self.stats = SiteStats()
+        self._random = random.Random(seed)
+        self._links = [[self._random.randrange(pages) for _ in range(fanout)]
+                       for _ in range(pages)]
+        self._server = _ThreadingServer(('127.0.0.1', port), _handler_for(self))
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/'.format(self._server.server_address[1])
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_stats(self):
+        self.stats = SiteStats()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def render(self, page):
+        links = ''.join('<li><a href="/page{0}">Page {0}</a></li>'.format(link)
+                        for link in self._links[page])
+        if self.downloads:
+            links += '<li><a href="/download{0}">Download</a></li>'.format(page % self.downloads)
+        forms = ''.join(self._render_form(page, form) for form in range(self.forms))
+        return ('<!DOCTYPE html><html><head><title>Page {0}</title></head><body>'
+                '<h1>Page {0}</h1><ul>{1}</ul>{2}<p>{3}</p></body></html>'
+                .format(page, links, forms, 'Some text. ' * 50))
+
+    def _render_form(self, page, form):
+        action = ('/form{0}'.format(form) if form < self.shared_forms
+                  else '/page{0}/form{1}'.format(page, form))
+        method = 'get' if form % 2 == 0 else 'post'
+        return ('<form action="{0}" method="{1}"><input name="q{2}" type="text">'
+                '<textarea name="comment"></textarea><input type="submit" value="Go">'
+                '</form>'.format(action, method, form))
+
+    def page_for(self, path):
+        """The page number of path, or None if it is not a page."""
+        if path == '/':
+            return 0
+        if path.startswith('/page') and path[5:].isdigit():
+            page = int(path[5:])
+            return page if page < self.pages else None
+        return None
+
+    def answer(self, path, data):
+        """The answer to a form submitted to path with data, urlencoded."""
+        form = path.rsplit('/form', 1)[-1]
+        comment = dict(parse_qsl(data)).get('comment', '')
+        if form == '0':
+            shown = comment
+        elif form == '1':
+            shown = html.escape(comment)
+        else:
+            shown = ''
+        return '<html><body>Thanks! <p>{0}</p></body></html>'.format(shown)
+
+    def download_for(self, path):
+        """The download number of path, or None if it is not a download."""
+        if path.startswith('/download') and path[9:].isdigit():
+            download = int(path[9:])
+            return download if download < self.downloads else None
+        return None
+
+    def should_throttle(self):
+        with self._throttle_lock:
+            if self.throttled <= 0:
+                return False
+            self.throttled -= 1
+            return True
+
+    def should_fail(self):
+        return self.error_rate and self._random.random() < self.error_rate
+
+def _handler_for(site):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body go out on separate writes: with Nagle on, the body
+        # waits for the delayed ACK of the headers, 40ms on every keep-alive request
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self._respond(urlsplit(self.path).query)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            self._respond(self.rfile.read(length).decode('utf-8', 'replace'))
+
+        def _respond(self, data):
+            if site.latency:
+                time.sleep(site.latency)
+            if site.should_throttle():
+                site.stats.count_throttled()
+                headers = {} if site.retry_after is None else {'Retry-After': str(site.retry_after)}
+                return self._send(429, b'Too Many Requests', headers=headers)
+            path, query = urlsplit(self.path)[2:4]
+            download = site.download_for(path)
+            if download is not None:
+                return self._send_download(download)
+            page = site.page_for(path)
+            is_page = self.command == 'GET' and page is not None and not query
+            is_error = site.should_fail()
+            body = site.render(page).encode() if is_page else site.answer(path, data).encode()
+            etag = '"{0}"'.format(zlib.crc32(body)) if is_page and site.etags else None
+            is_not_modified = etag is not None and self.headers.get('If-None-Match') == etag
+            site.stats.count(is_page, is_error, is_not_modified)
+            if is_error:
+                self._send(500, b'Internal Server Error')
+            elif is_not_modified:
+                self._send(304, b'', etag)
+            else:
+                self._send(200, body, etag)
+
+        def _send_download(self, download):
+            site.stats.count_download()
+            is_pdf = download % 2 == 0
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/pdf' if is_pdf else 'text/html')
+            self.send_header('Content-Length', str(site.download_size))
+            self.end_headers()
+            chunk = (b'%PDF-1.4\n' if is_pdf else b'\x89PNG\r\n\x1a\n').ljust(64 * 1024, b'\x00')
+            try:
+                for sent in range(0, site.download_size, len(chunk)):
+                    self.wfile.write(chunk[:site.download_size - sent])
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True  # the scanner had seen enough
+
+        def _send(self, status, body, etag=None, headers=None):
+            self.send_response(status)
+            if etag is not None:
+                self.send_header('ETag', etag)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+class _ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
@@ -1,15 +1,167 @@
-"""A simple module to hold a global reference to the logger.
-Rather uninteresting.
+"""A simple module to hold a global reference to the logger, and to set
+up where its records go. Importing it doesn't: until configure_logging is
+called, records go wherever logging sends them by default (warnings and
+up to stderr), and nothing is written to disk.
+
+configure_logging puts a queue between the logger and the handlers: the
+thread logging something only formats the message and puts it on the
+queue, while a listener thread writes it out. The listener also keeps the
+same line from being logged over and over: after burst records from the
+same line of code in interval seconds, the rest are only counted, and
+logged as a single record when the interval is over, whether or not
+anything else is logged after them.
 """
 
+import atexit
+import json
 import logging
-logging.getLogger("requests").setLevel(logging.DEBUG)
-logging.basicConfig(filename='logs/logs.log', level=logging.DEBUG,
-                    format='[%(asctime)s] {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s',
-                    datefmt='%H:%M:%S')
-console_logger = logging.StreamHandler()
-console_logger.setLevel(logging.ERROR)
-console_format = logging.Formatter('%(levelname)-s: %(message)s')
-console_logger.setFormatter(console_format)
-logging.getLogger('').addHandler(console_logger)
+import logging.handlers
+import queue
+import threading
+import time
+
 logger = logging.getLogger('')
+
+TEXT_FORMAT = '[%(asctime)s] {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s'
+CONSOLE_FORMAT = '%(levelname)-s: %(message)s'
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line, for whatever reads the log after us."""
+    def format(self, record):
+        entry = dict(time=self.formatTime(record, self.datefmt), level=record.levelname,
+                     logger=record.name, where='{0}:{1}'.format(record.pathname, record.lineno),
+                     thread=record.threadName, message=record.getMessage())
+        if getattr(record, 'repeats', None):
+            entry['repeats'] = record.repeats
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+class RepeatLimiter(logging.Handler):
+    """Hands records to handlers, but at most burst of them every interval
+    seconds from the same line of code. The rest are counted, and once the
+    interval is over, the last one of them is handed with a note of how
+    many there were, and a repeats attribute with the count. Errors are
+    never held back.
+
+    Only meant to be called by a single thread, the listener's."""
+    def __init__(self, handlers, burst=10, interval=10.0):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}  # line of code: [started, records, held back, last held back]
+
+    def emit(self, record):
+        now = time.monotonic()
+        self._summarize(now)
+        if record.levelno >= logging.ERROR:
+            return self._handle(record)
+        key = (record.name, record.levelno, record.pathname, record.lineno)
+        window = self._windows.get(key)
+        if window is None:
+            window = self._windows[key] = [now, 0, 0, None]
+        window[1] += 1
+        if window[1] <= self.burst:
+            self._handle(record)
+        else:
+            window[2] += 1
+            window[3] = record
+
+    def tick(self):
+        """Hand the summary of every window whose interval is over."""
+        self._summarize(time.monotonic())
+
+    def flush(self):
+        self._summarize(None)
+        for handler in self.handlers:
+            handler.flush()
+
+    def close(self):
+        self.flush()
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+    def _summarize(self, now):
+        """Hand the summary of every window over, or of all of them if now
+        is None, and forget them."""
+        for key, (started, _, held_back, last) in list(self._windows.items()):
+            if now is not None and now - started < self.interval:
+                continue
+            del self._windows[key]
+            if held_back:
+                last.msg = '{0} (x{1:,} more like it in {2:.0f}s)'.format(
+                    last.getMessage(), held_back, (now or time.monotonic()) - started)
+                last.args = None
+                last.repeats = held_back
+                self._handle(last)
+
+    def _handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+class RepeatListener(logging.handlers.QueueListener):
+    """A QueueListener for a RepeatLimiter, which wakes up while the queue
+    is quiet so the summaries aren't held until the next record."""
+    def dequeue(self, block):
+        limiter = self.handlers[0]
+        while True:
+            try:
+                return self.queue.get(block, timeout=limiter.interval if block else None)
+            except queue.Empty:
+                if not block:
+                    raise
+                limiter.tick()
+
+_listener = None
+_lock = threading.Lock()
+
+def configure_logging(path='logs/logs.log', level='INFO', json_format=False,
+                      console_level='ERROR', burst=10, interval=10.0):
+    """Send every record of level or above to path (None for no file),
+    as text or, if json_format, as json lines, and the ones of
+    console_level or above to stderr too, always as text. Everything goes through a queue
+    and a listener thread, which is stopped at exit, or by stop_logging.
+    Calling it again replaces the previous configuration."""
+    global _listener
+    with _lock:
+        _stop_logging()
+        handlers = []
+        if path:
+            file_handler = logging.FileHandler(path)
+            file_handler.setFormatter(JsonFormatter(datefmt='%H:%M:%S') if json_format else
+                                      logging.Formatter(TEXT_FORMAT, datefmt='%H:%M:%S'))
+            handlers.append(file_handler)
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(console_level)
+        console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+        handlers.append(console_handler)
+        records = queue.SimpleQueue()
+        logger.addHandler(logging.handlers.QueueHandler(records))
+        logger.setLevel(level)
+        _listener = RepeatListener(records, RepeatLimiter(handlers, burst, interval))
+        _listener.start()
+
+def stop_logging():
+    """Write out whatever is still queued, and the summaries of the repeats
+    held back so far, and stop the listener."""
+    with _lock:
+        _stop_logging()
+
+def _stop_logging():
+    global _listener
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            logger.removeHandler(handler)
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.flush()
+            handler.close()
+        _listener = None
+
+atexit.register(stop_logging)
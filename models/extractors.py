@@ -0,0 +1,155 @@
+from html.parser import HTMLParser
+
+"""Extractors pull out of an HTML page everything the scanner cares about,
+and nothing else: the href of its links and its forms. They all return the
+same thing, an Extraction, so ScrappedWebsite doesn't care which one is used.
+
+The streaming extractor does it in a single pass over the HTML, reacting to
+tags as they come and never building a DOM. The soup extractor uses
+BeautifulSoup, which is slower but is the one to use if the streaming one
+chokes on some website.
+"""
+
+FIELD_TAGS = ('input', 'textarea', 'select', 'button')
+
+class Extraction:
+    """The links and forms of a page. links is a list of href strings, in
+    order. forms is a list of (method, action, fields) tuples, where method
+    and action are the attributes of the form (or None) and fields is a list
+    of (field_type, name, value) tuples: field_type is the type attribute
+    of an input ('text' if it has none) or the tag name for the rest."""
+    __slots__ = ('links', 'forms')
+
+    def __init__(self, links, forms):
+        self.links = links
+        self.forms = forms
+
+class StreamingExtractor(HTMLParser):
+    """Extract links and forms with the event based html.parser of the
+    standard library, in a single pass."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._links = []
+        self._forms = []
+        self._form = None  # the form being read, if any
+        self._text_field = None  # the textarea or option whose text we want
+        self._text = []
+
+    def extract(self, html_string):
+        self.feed(html_string)
+        self.close()
+        if self._form is not None:  # never closed, but browsers would submit it
+            self._close_form()
+        return Extraction(self._links, self._forms)
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = self._attribute(attrs, 'href')
+            if href is not None:
+                self._links.append(href)
+        elif tag == 'form':
+            if self._form is None:  # browsers ignore nested forms
+                self._form = (self._attribute(attrs, 'method'),
+                              self._attribute(attrs, 'action'), [])
+        elif self._form is None:
+            return
+        elif tag in FIELD_TAGS:
+            self._start_field(tag, attrs)
+        elif tag == 'option':
+            self._start_option(attrs)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag in ('textarea', 'option'):
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag == 'form' and self._form is not None:
+            self._close_form()
+        elif tag in ('textarea', 'option', 'select'):
+            self._end_text_field()
+
+    def handle_data(self, data):
+        if self._text_field is not None:
+            self._text.append(data)
+
+    def _close_form(self):
+        self._end_text_field()
+        method, action, fields = self._form
+        self._forms.append((method, action, [tuple(field) for field in fields]))
+        self._form = None
+
+    def _start_field(self, tag, attrs):
+        self._end_text_field()
+        field_type = (self._attribute(attrs, 'type') or 'text').lower() if tag == 'input' else tag
+        field = [field_type, self._attribute(attrs, 'name') or '', self._attribute(attrs, 'value')]
+        self._form[2].append(field)
+        if tag == 'textarea':
+            self._text_field = ('textarea', field)
+
+    def _start_option(self, attrs):
+        """A select is worth the value of its selected option, or of its
+        first option if none is selected."""
+        self._end_text_field()
+        select = self._form[2][-1] if self._form[2] and self._form[2][-1][0] == 'select' else None
+        if select is None:
+            return
+        if select[2] is None or self._attribute(attrs, 'selected', False) is not False:
+            value = self._attribute(attrs, 'value')
+            select[2] = value if value is not None else ''
+            if value is None:  # the value is the text of the option
+                self._text_field = ('option', select)
+
+    def _end_text_field(self):
+        if self._text_field is not None:
+            kind, field = self._text_field
+            text = ''.join(self._text)
+            field[2] = text if kind == 'textarea' else text.strip()
+            self._text_field = None
+            self._text = []
+
+    @staticmethod
+    def _attribute(attrs, name, default=None):
+        for attr_name, value in attrs:
+            if attr_name == name:
+                return value if value is not None else ''
+        return default
+
+class SoupExtractor:
+    """Extract links and forms by building a BeautifulSoup tree. Imported
+    lazily, so bs4 is only needed if this extractor is used."""
+
+    def extract(self, html_string):
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(html_string, 'html.parser')
+        links = [link.get('href') for link in soup.find_all('a') if link.get('href') is not None]
+        forms = [(form.get('method'), form.get('action'),
+                  [self._field(field) for field in form.find_all(FIELD_TAGS)])
+                 for form in soup.find_all('form')]
+        return Extraction(links, forms)
+
+    def _field(self, field):
+        if field.name == 'input':
+            return ((field.get('type') or 'text').lower(), field.get('name') or '', field.get('value'))
+        if field.name == 'textarea':
+            return ('textarea', field.get('name') or '', field.get_text())
+        if field.name == 'select':
+            options = field.find_all('option')
+            selected = [o for o in options if o.has_attr('selected')] or options[:1]
+            value = None
+            if selected:
+                value = selected[0].get('value')
+                value = value if value is not None else selected[0].get_text().strip()
+            return ('select', field.get('name') or '', value)
+        return (field.name, field.get('name') or '', field.get('value'))
+
+EXTRACTORS = {
+    'stream': StreamingExtractor,
+    'soup': SoupExtractor,
+}
+
+def extract(html_string, extractor='stream'):
+    """Return the Extraction of html_string using the extractor named
+    extractor, one of the keys of EXTRACTORS."""
+    return EXTRACTORS[extractor]().extract(html_string)
@@ -1,69 +1,97 @@
+import asyncio
+import collections
 import requests
 import json
 import glob
-from urllib.parse import urlparse
-from bs4 import BeautifulSoup
+import os
+import threading
+import functools
+import hashlib
+from urllib.parse import urljoin, urlsplit, urlunsplit
+from models.extractors import extract
+from models.verification import REFLECTED, UNVERIFIED, PROBE, nonce
+from utils.utils import THROTTLE_STATUSES
 
 """A module that holds all the main classes of the application.  """
 
+DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+
+@functools.lru_cache(maxsize=65536)
+def _standarize_url(url, gotten_from=None):
+    """Return the (url, scheme, netloc, path, query) of url, resolved
+    against the gotten_from url string if it is relative. Websites of the
+    same site link to the same places over and over, so this is cached.
+
+    Scheme and network location are case insensitive, so they are
+    lowercased, and a default port is dropped. The path is case sensitive
+    and is kept as is, but an empty one means '/'. The fragment is dropped.
+    The query keeps its order on url, which is what gets requested, but the
+    query attribute has its parameters sorted, so ?a=1&b=2 equals ?b=2&a=1.
+    """
+    if gotten_from is not None:
+        url = urljoin(gotten_from, url)
+    scheme, netloc, path, query, _ = urlsplit(url)
+    scheme, netloc = scheme.lower(), netloc.lower()
+    if netloc.endswith(DEFAULT_PORTS.get(scheme, '#')):
+        netloc = netloc[:-len(DEFAULT_PORTS[scheme])]
+    if netloc and not path:
+        path = '/'
+    url = urlunsplit((scheme, netloc, path, query, ''))
+    sorted_query = '&'.join(sorted(parameter for parameter in query.split('&') if parameter))
+    return url, scheme, netloc, path, sorted_query
+
 class URL:
     """A class to represent the URLs. Used mostly to define equality,
     so program wouldn't visit http://example.com#4 and http://example.com,
-    which are basically the same URL."""
+    which are basically the same URL.
+
+    Two URLs are the same if their network location, path and query are
+    the same. Those make the key of the URL, which is computed (and hashed)
+    once, as URLs are compared and hashed a lot and never change."""
+    __slots__ = ('url', 'scheme', 'netloc', 'path', 'query', 'key', '_hash')
+
     def __init__(self, url, gotten_from=None):
-        self._gotten_from = gotten_from
-        self.url = self._standarize_url(url)
-        self._parsed_url = urlparse(self.url)
-        self.netloc = self._parsed_url.netloc
-        self.scheme = self._parsed_url.scheme
-        self.path = self._parsed_url.path
-        self.query = self._parsed_url.query
+        gotten_from = gotten_from.url if gotten_from is not None else None
+        self.url, self.scheme, self.netloc, self.path, self.query = _standarize_url(url, gotten_from)
+        self.key = (self.netloc, self.path, self.query)
+        self._hash = hash(self.key)
 
     def __str__(self):
         return self.url
 
     def __eq__(self, another_url):
-        return (self.netloc == another_url.netloc and
-                self.path == another_url.path and
-                self.query == another_url.query)
+        if not isinstance(another_url, URL):
+            return NotImplemented
+        return self._hash == another_url._hash and self.key == another_url.key
 
     def __repr__(self):
         return "{0} {1}".format(str(self), super().__repr__())
 
     def __hash__(self):
-        return hash("{0}{1}".format(self.netloc, self.path))
-
-    def _standarize_url(self, url):
-        """Standarized the URL. Necesary mostly because of relative urls
-        and because urlparse _WILL_ distinguis between example.com and
-        EXAMPLE.com, and we don't want that.
-        """
-        url = url.lower()
-        parse_url = urlparse(url)
-        if not parse_url.netloc and self._gotten_from:
-            url = self._get_absolute_from_relative(url)
-        return url
+        return self._hash
 
     def is_on_same_domain_as(self, another_url):
         """True if another_url is on the same domain."""
         return self.netloc == another_url.netloc
 
-    def _get_absolute_from_relative(self, relative_url):
-        """Recreates the absolute URL from the gotten_from URL.
-        Return the absolute URL."""
-        url = "{0}://{1}{2}".format(self._gotten_from.scheme,
-                                    self._gotten_from.netloc,
-                                    relative_url)
-        return url
-
 class ScrappedWebsite:
-    """A ScrappedWebsite is a website parsed with BeautifulSoup and
-    with methods prepared to extract information about its DOM."""
-    def __init__(self, url, html_string):
-        """Inits the ScrappedWebsite with a url (stripping away the ending /
-        if it has it) and parsing it with BS."""
+    """A ScrappedWebsite is a website parsed by one of the extractors
+    (models/extractors.py) and with methods prepared to extract information
+    about its links and forms."""
+    def __init__(self, url, html_string, extractor='stream'):
+        """Inits the ScrappedWebsite with a url and extracting its links
+        and forms in one go. The html_string is not kept."""
         self.url = url
-        self._soup = BeautifulSoup(html_string, 'html.parser')
+        self._extraction = extract(html_string, extractor)
+
+    @classmethod
+    def from_extraction(cls, url, extraction):
+        """Return a ScrappedWebsite for an Extraction done elsewhere, as
+        the ProcessPoolParser does (models/parsing.py)."""
+        scrapped_website = cls.__new__(cls)
+        scrapped_website.url = url
+        scrapped_website._extraction = extraction
+        return scrapped_website
 
     def get_unique_relevant_links(self):
         """Return all the links found on the webpage which point
@@ -71,8 +99,7 @@ class ScrappedWebsite:
         duplicates.
         """
         raw_links = []
-        for link in self._soup.find_all('a'):
-            url_string = link.get('href')
+        for url_string in self._extraction.links:
             if url_string and not url_string.startswith('#'):
                 raw_links.append(URL(url_string, gotten_from=self.url))
         link_set = {l for l in raw_links if l.is_on_same_domain_as(self.url) and l != self.url}
@@ -81,38 +108,55 @@ class ScrappedWebsite:
     def _rebuild_action_link(self, action):
         return self.url if not action else URL(action, gotten_from=self.url)
 
+    def get_exposed_forms(self):
+        """Return a list with a tuple of (method, action, inputs) per form,
+        where method is either 'get' or 'post', action is the action of the
+        form and inputs is a list of (is_upload, query_name) tuples, one
+        per input, textarea, select or button of the form. is_upload
+        specifies if the input expects us to upload a file and query_name is
+        the name of the input.
+        """
+        return [(method, action, [(field_type == 'file', name) for field_type, name, _ in fields])
+                for method, action, fields in self.get_exposed_form_fields()]
+
+    def get_exposed_form_fields(self):
+        """Same as get_exposed_forms, but every input is a (field_type, name,
+        value) tuple, where field_type is the type of an input ('text' if it
+        has none) or the tag name for the rest and value is its value on the
+        page, or None."""
+        forms = []
+        for method, action, fields in self._extraction.forms:
+            action = self._rebuild_action_link(action)
+            method = (method or 'get').lower()
+            forms.append((method, action, [(field_type, name.lower(), value)
+                                           for field_type, name, value in fields]))
+        return forms
+
     def get_exposed_inputs(self):
         """Return a list with tuples of (method, action, is_upload, name), where
         method is either 'GET' or 'POST', action is the action
         of the exposed form, is_upload specifies if the form expects us to
         upload a file and query_name is the name of the input in the form
         """
-        def discriminate_query_type(query_type):
-            return True if query_type == 'file' else False
-
-        def lower_strings(*strings):
-            return [s.lower() for s in strings]
-
-        methods_actions_urls_and_names = []
-        for form in self._soup.find_all('form'):
-            action = self._rebuild_action_link(form.get('action'))
-            for input_ in form.find_all('input'):
-                query_type = input_.get('type')
-                is_upload = discriminate_query_type(query_type)
-                query_name = input_.get('name') or ''
-                method = form.get('method')
-                method, query_name = lower_strings(method, query_name)
-                methods_actions_urls_and_names.append((method, action, is_upload, query_name))
-        return methods_actions_urls_and_names
+        return [(method, action, is_upload, query_name)
+                for method, action, inputs in self.get_exposed_forms()
+                for is_upload, query_name in inputs]
 
 class XSS:
     """A simple class to represent the XSS vulnerability.
-    Holds the URL where it was found, the payload that got through
-    and the method ('GET' or 'POST')"""
-    def __init__(self, url, payload, method):
+    Holds the URL where it was found, the payload that got through,
+    the method ('GET' or 'POST') and, if the response was verified, where
+    the payload ended up on it: one of the outcomes of models/verification.py."""
+    def __init__(self, url, payload, method, reflection=None):
         self.url = url.url
-        self.payload = json.dumps(payload)
+        self.payload = json.dumps(self._as_text(payload))
         self.method = method
+        self.reflection = reflection
+
+    def _as_text(self, payload):
+        """Upload payloads are bytes, which json can't dump."""
+        return {name: test.decode('utf-8', 'replace') if isinstance(test, bytes) else test
+                for name, test in payload.items()}
 
     def __eq__(self, another):
         return (self.url == another.url and
@@ -123,24 +167,183 @@ class XSS:
         return ("XSS found on URL {0} with parameters {1} "
                 "via method {2}".format(self.url, self.payload, self.method))
 
-class XSSDetector:
-    """A class with methods and attributes to aid in the search of
-    xss in a scrapped_website (instance of ScrappedWebsite)."""
-    def __init__(self, scrapped_website, web_io):
-        """Attachs the scrapped website and web_io class to the instance.
-        It also creates the attack_information upon initialization.
+class AttackSurfaceIndex:
+    """Every form attacked during a scan, so the same form found on
+    another page (think of a search box on every page of a site) is not
+    attacked again. Forms are identified by their surface key: their method,
+    their action URL and the set of names of their inputs.
 
-        Web_io should be an instance of SafeIO found on utils.
-        """
-        self._scrapped_website = scrapped_website
-        self._get_tests = self._file_lines_as_list('xss_tests/get_method')
-        self._post_tests = self._file_lines_as_list('xss_tests/post_method')
-        self._common_tests = self._file_lines_as_list('xss_tests/common')
-        self._file_upload_tests = [self._file_as_str(f) for f in glob.glob('xss_tests/upload_tests/*')]
-        self.attack_information = self._create_attack_information()
-        self.web_io = web_io
+    When a surface is found again, the XSS it had are attributed to the new
+    page too. If it is still being attacked by someone else, the new page
+    waits on the surface and whoever is attacking it will attribute them
+    when it is done. Nobody blocks.
+
+    Shared by every XSSDetector of the scan, from any thread. If on_complete
+    is given, it is called with the key and findings of every surface once
+    its attack is complete.
+    """
+    def __init__(self, on_complete=None):
+        self._lock = threading.Lock()
+        self._surfaces = {}
+        self.on_complete = on_complete
+        self.seeded = 0
+        self.shared = 0
+        self.hits = 0
+        self.misses = 0
 
-    def _file_lines_as_list(self, file_):
+    @staticmethod
+    def surface_key(method, action, query_names):
+        return (method, action.key, frozenset(query_names))
+
+    def claim(self, key, page_url):
+        """Return None if the surface was never seen: it is now claimed by
+        the caller, who must attack it and then call complete. Else, return
+        the list of XSS known for it, attributed to page_url."""
+        with self._lock:
+            surface = self._surfaces.get(key)
+            if surface is None:
+                self._surfaces[key] = {'findings': None, 'waiting_pages': []}
+                self.misses += 1
+                return None
+            self.hits += 1
+            if surface['findings'] is None:
+                surface['waiting_pages'].append(page_url)
+                return []
+            return self._attribute(surface['findings'], [page_url])
+
+    def complete(self, key, findings):
+        """Record the findings of a surface claimed by the caller: tuples
+        of the arguments of an XSS but its url, (payload, method) or
+        (payload, method, reflection). Return the XSS of the pages which
+        were waiting for it."""
+        with self._lock:
+            surface = self._surfaces[key]
+            surface['findings'] = findings
+            waiting_pages, surface['waiting_pages'] = surface['waiting_pages'], []
+        if self.on_complete is not None:
+            self.on_complete(key, findings)
+        return self._attribute(findings, waiting_pages)
+
+    def seed(self, key, findings):
+        """Record a surface attacked on a previous scan, with its findings."""
+        with self._lock:
+            if key not in self._surfaces:
+                self.seeded += 1
+            self._surfaces[key] = {'findings': findings, 'waiting_pages': []}
+
+    def share(self, key, findings):
+        """Record a surface attacked by another process of the same scan,
+        unless it was claimed here already: then it is attacked here too."""
+        with self._lock:
+            if key in self._surfaces:
+                return
+            self.shared += 1
+            self._surfaces[key] = {'findings': findings, 'waiting_pages': []}
+
+    def abandon(self, key):
+        """Forget a surface whose attack could not finish, so it can be
+        claimed again. Pages waiting for it won't get anything."""
+        with self._lock:
+            self._surfaces.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return dict(surfaces=len(self._surfaces) - self.seeded - self.shared,
+                        seeded=self.seeded, shared=self.shared,
+                        hits=self.hits, misses=self.misses)
+
+    def _attribute(self, findings, page_urls):
+        return [XSS(page_url, *finding) for page_url in page_urls for finding in findings]
+
+class PayloadCorpus:
+    """The tests found on the xss_tests folder, read once and shared by
+    every XSSDetector of a scan. It is immutable: reloading it means
+    creating a new one, which is what refreshed does when a file changed.
+
+    Payloads are deduplicated across files: a payload on the common file
+    won't be sent again because it is also on the get_method file.
+    Upload tests are kept as bytes, which is what gets uploaded anyway.
+    """
+    __slots__ = ('_directory', '_common_tests', '_get_tests', '_post_tests',
+                 '_file_upload_tests', '_mtimes')
+
+    def __init__(self, directory, common_tests, get_tests, post_tests,
+                 file_upload_tests, mtimes):
+        self._directory = directory
+        self._common_tests = common_tests
+        self._get_tests = get_tests
+        self._post_tests = post_tests
+        self._file_upload_tests = file_upload_tests
+        self._mtimes = mtimes
+
+    directory = property(lambda self: self._directory)
+    common_tests = property(lambda self: self._common_tests)
+    get_tests = property(lambda self: self._get_tests)
+    post_tests = property(lambda self: self._post_tests)
+    file_upload_tests = property(lambda self: self._file_upload_tests)
+
+    @classmethod
+    def load(cls, directory='xss_tests'):
+        """Read every test file under directory and return a PayloadCorpus."""
+        common_tests = cls._unique(cls._file_lines_as_list(os.path.join(directory, 'common')))
+        get_tests = cls._unique(cls._file_lines_as_list(os.path.join(directory, 'get_method')),
+                                already_seen=common_tests)
+        post_tests = cls._unique(cls._file_lines_as_list(os.path.join(directory, 'post_method')),
+                                 already_seen=common_tests)
+        file_upload_tests = cls._unique(cls._file_as_bytes(f) for f in cls._upload_files(directory))
+        return cls(directory, common_tests, get_tests, post_tests,
+                   file_upload_tests, cls._current_mtimes(directory))
+
+    def digest(self):
+        """A hash of every test, which changes if any test does."""
+        digest = hashlib.blake2b(digest_size=16)
+        for tests in (self._common_tests, self._get_tests, self._post_tests,
+                      self._file_upload_tests):
+            for test in tests:
+                test = test if isinstance(test, bytes) else test.encode('utf-8', 'surrogatepass')
+                digest.update(len(test).to_bytes(8, 'big') + test)
+            digest.update(b'\x00' * 8)
+        return digest.hexdigest()
+
+    def is_stale(self):
+        """True if any test file was modified, added or removed since loading."""
+        return self._current_mtimes(self._directory) != self._mtimes
+
+    def refreshed(self):
+        """Return a freshly loaded corpus if the files changed, else self."""
+        return PayloadCorpus.load(self._directory) if self.is_stale() else self
+
+    @staticmethod
+    def _unique(tests, already_seen=()):
+        already_seen = set(already_seen)
+        unique_tests = []
+        for test in tests:
+            if test not in already_seen:
+                already_seen.add(test)
+                unique_tests.append(test)
+        return tuple(unique_tests)
+
+    @staticmethod
+    def _upload_files(directory):
+        return sorted(glob.glob(os.path.join(directory, 'upload_tests', '*')))
+
+    @classmethod
+    def _current_mtimes(cls, directory):
+        """The modification time of every test file. The upload_tests
+        folder itself is included, so new or deleted files are noticed."""
+        paths = [os.path.join(directory, name) for name in
+                 ('common', 'get_method', 'post_method', 'upload_tests')]
+        paths.extend(cls._upload_files(directory))
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                mtimes[path] = None
+        return mtimes
+
+    @staticmethod
+    def _file_lines_as_list(file_):
         try:
             with open(file_, 'r') as f:
                 file_lines_as_list = f.read().splitlines()
@@ -148,54 +351,427 @@ class XSSDetector:
             return []
         return file_lines_as_list
 
-    def _file_as_str(self, file_):
+    @staticmethod
+    def _file_as_bytes(file_):
         try:
-            with open(file_, 'r') as f:
-                file_as_string = f.read()
+            with open(file_, 'rb') as f:
+                file_as_bytes = f.read()
         except FileNotFoundError:
-            file_as_string = ''
-        return file_as_string
+            file_as_bytes = b''
+        return file_as_bytes
+
+# what the fields without a value of their own get, by type
+DEFAULT_VALUES = {'email': 'test@example.com', 'url': 'http://example.com/',
+                  'number': '1', 'range': '1', 'tel': '5555555555', 'date': '2000-01-01',
+                  'checkbox': 'on', 'radio': 'on', 'color': '#000000'}
+# fields browsers never submit, so they are never attacked with text payloads
+UNSUBMITTED_TYPES = ('file', 'reset', 'image')
+
+def default_value(field_type, value):
+    return value if value else DEFAULT_VALUES.get(field_type, 'test')
+
+class _Target:
+    """What XSSDetector attacks: the inputs of a form (or, on a single
+    injection, one of them), and the payloads still to be sent to them.
+    Form is shared by every target of the same form."""
+    __slots__ = ('method', 'url', 'is_upload', 'names', 'defaults', 'surface', 'form',
+                 'tests', 'probes', 'open_names', '_initial')
+
+    def __init__(self, method, url, is_upload, names, defaults, surface, form, tests):
+        self.method = method
+        self.url = url
+        self.is_upload = is_upload
+        self.surface = surface
+        self.form = form
+        self._initial = (tuple(names), defaults, tuple(tests))
+        self.reset()
+
+    def reset(self):
+        """Back to how it was before anything was sent."""
+        names, self.defaults, tests = self._initial
+        self.names = names
+        self.tests = collections.deque(tests)
+        self.probes = 0  # probe requests in flight
+        self.open_names = None  # the inputs the probe got through, while probing
+
+class XSSDetector:
+    """A class with methods and attributes to aid in the search of
+    xss in a scrapped_website (instance of ScrappedWebsite).
+
+    There are two ways of injecting payloads. 'single' sends each payload
+    to each input alone, and nothing else: N inputs cost N requests per
+    payload. 'batch' sends each payload to every input of a form a browser
+    would submit at once: text inputs, but also hidden ones, selects,
+    checkboxes and so on, since a server may reflect any of them. Only if
+    that request is flagged is the set of inputs bisected, to find out which
+    ones are vulnerable, the inputs left out of a half getting their default
+    values: a form with no vulnerable inputs costs one request per payload.
+
+    What flags a request depends on the verifier. Without one, any request
+    accepted by the server (a 2xx) is. With a ReflectionVerifier (see
+    models/verification.py), payloads are tagged with canaries and every
+    XSS found says where it ended up on the response; if reflected_only,
+    only requests whose payload was reflected as sent are flagged. Either
+    way, a request the host kept throttling until the retries ran out could
+    not be looked at: its payload is an XSS whose reflection is UNVERIFIED,
+    left for a human to check, and its inputs are not narrowed down. So is
+    a payload not found on a response cut at the max_body_size of the
+    web_io, as it may be on what was cut.
+
+    In which order payloads are sent, and whether all of them are, is up to
+    the policy: a PayloadPolicy (see models/scheduling.py). Without one,
+    they are all sent at once, in the order of the files.
+    """
+    def __init__(self, scrapped_website, web_io, corpus=None, surface_index=None,
+                 injection='single', verifier=None, reflected_only=False, policy=None):
+        """Attachs the scrapped website and web_io class to the instance.
+        It also creates the attack_information upon initialization.
+
+        Web_io should be an instance of SafeIO found on utils. Corpus should
+        be the PayloadCorpus shared by the scan. If none is given, one will
+        be loaded, which is fine for a one-off but wasteful for a crawl.
+        Surface_index should be the AttackSurfaceIndex shared by the scan.
+        If given, forms already attacked on other pages are not attacked
+        again; their XSS are attributed to this website instead.
+        Injection is either 'single' or 'batch'.
+        """
+        if corpus is None:
+            corpus = PayloadCorpus.load()
+        self._scrapped_website = scrapped_website
+        self._get_tests = corpus.get_tests
+        self._post_tests = corpus.post_tests
+        self._common_tests = corpus.common_tests
+        self._file_upload_tests = corpus.file_upload_tests
+        self._surface_index = surface_index
+        self.injection = injection
+        self.verifier = verifier
+        self.reflected_only = reflected_only
+        self.policy = policy
+        self._defaults = None  # see _default_of
+        self.attack_information = self._create_attack_information()
+        self.web_io = web_io
 
     def _create_attack_information(self):
         """Return a list of tuples that look like
-        (url, method, is_upload, {query_parameter: test}), where url is
-        the url to where the request will be sent, method is either
-        'GET' or 'POST', query_parameter is the name of the input of a form
-        on the scrapped website or '' and test is one the tests.
+        (method, url, is_upload, payload), where url is the url to where the
+        request will be sent, method is either 'GET' or 'POST' and payload
+        is a dictionary from the names of the inputs of a form on the
+        scrapped website to their values: one of the tests for the inputs
+        being attacked, their default for the rest.
+
+        Those are the requests detect would send if nothing was pruned nor
+        stopped early; on a batch injection, more may follow. Forms already
+        claimed on the surface index by another page are left out, and the
+        XSS known for them are kept for detect to return.
         """
-        def build_payload_and_append(method, url, is_upload, query_name, source_lst):
-            for test in source_lst:
-                payload = {query_name: test}
-                method_url_is_upload_and_payloads.append((method, url, is_upload, payload))
-
-        method_url_is_upload_and_payloads = []
-        exposed_inputs = self._scrapped_website.get_exposed_inputs()
-        for method, url, is_upload, query_name in exposed_inputs:
-            build_payload_and_append(method, url, is_upload,
-                                     query_name, self._common_tests)
+        self._targets = []
+        self._claimed_surfaces = []
+        self._inherited_xss = []
+        for form, (method, url, fields) in enumerate(self._scrapped_website.get_exposed_form_fields()):
+            inputs = [(field_type == 'file', name) for field_type, name, _ in fields]
+            surface = self._claim_surface(method, url, inputs)
+            if surface is False:
+                continue
+            if self.injection == 'batch':
+                self._create_batch_targets(method, url, fields, surface, form)
+            else:
+                self._create_single_targets(method, url, inputs, surface, form)
+        return [(target.method, target.url, target.is_upload,
+                 self._payload(target.names, test, target.defaults))
+                for target in self._targets for test in target.tests]
+
+    def _add_target(self, method, url, is_upload, names, tests, defaults, surface, form):
+        if names and tests:
+            if self.policy is not None:
+                tests = self.policy.order(tests)
+            self._targets.append(_Target(method, url, is_upload, names, defaults,
+                                         surface, form, tests))
+
+    def _create_batch_targets(self, method, url, fields, surface, form):
+        names = []
+        for field_type, name, _ in fields:
+            if name and field_type not in UNSUBMITTED_TYPES and name not in names:
+                names.append(name)
+        if method == 'get':
+            self._add_target(method, url, False, names, self._common_tests + self._get_tests,
+                             {}, surface, form)
+        elif method == 'post':
+            self._add_target(method, url, False, names, self._common_tests + self._post_tests,
+                             {}, surface, form)
+            file_names = [name for field_type, name, _ in fields if name and field_type == 'file']
+            self._add_target(method, url, True, file_names,
+                             self._common_tests + self._file_upload_tests, {}, surface, form)
+
+    def _create_single_targets(self, method, url, inputs, surface, form):
+        for is_upload, query_name in inputs:
+            tests = self._common_tests
             if method == 'get':
-                build_payload_and_append(method, url, is_upload,
-                                         query_name, self._get_tests)
+                tests = tests + self._get_tests
             elif method == 'post' and not is_upload:
-                build_payload_and_append(method, url, is_upload,
-                                         query_name, self._post_tests)
+                tests = tests + self._post_tests
             elif method == 'post' and is_upload:
-                build_payload_and_append(method, url, is_upload,
-                                         query_name, self._file_upload_tests)
+                tests = tests + self._file_upload_tests
+            self._add_target(method, url, is_upload, [query_name], tests, {}, surface, form)
+
+    def _payload(self, names, test, defaults, request_nonce=''):
+        if self.verifier is not None:
+            test = self.verifier.tag(test, request_nonce)
+        payload = dict(defaults)
+        payload.update((name, test) for name in names)
+        return payload
 
-        return method_url_is_upload_and_payloads
+    def _claim_surface(self, method, url, inputs):
+        """Return the surface key of the form if we must attack it, None if
+        there is no surface index and False if someone else attacked it."""
+        if self._surface_index is None:
+            return None
+        key = self._surface_index.surface_key(method, url, (name for _, name in inputs))
+        if key in self._claimed_surfaces:
+            return False  # the same form twice on this website
+        known_xss = self._surface_index.claim(key, self._scrapped_website.url)
+        if known_xss is not None:
+            self._inherited_xss.extend(known_xss)
+            return False
+        self._claimed_surfaces.append(key)
+        return key
 
     def detect(self):
         """Return a list of XSS objects representing found xss
-        on the scrapped website."""
+        on the scrapped website. Requests are sent in rounds: the probes or
+        the first payloads first, then the halves of every batch flagged on
+        the previous round, along with the next payloads."""
+        flagged_attacks = []
+        attacks = self._first_round()
+        try:
+            while attacks:
+                verdicts = [self._send(attack) for attack in attacks]
+                attacks = self._next_round(attacks, verdicts, flagged_attacks)
+        except BaseException:
+            self._abandon_surfaces()
+            raise
+        return self._found_xss(flagged_attacks)
+
+    async def detect_async(self):
+        """Same as detect, but for an AsyncWebIO: every payload of a round is
+        submitted concurrently and the web_io decides how many are really
+        in flight. What is found is handed to the surface index and the
+        policy on a thread, as the history of the policy may write it to
+        disk."""
+        flagged_attacks = []
+        attacks = self._first_round()
+        try:
+            while attacks:
+                verdicts = await asyncio.gather(*[self._send_async(attack) for attack in attacks])
+                attacks = self._next_round(attacks, verdicts, flagged_attacks)
+        except BaseException:
+            self._abandon_surfaces()
+            raise
+        return await asyncio.get_running_loop().run_in_executor(None, self._found_xss,
+                                                                flagged_attacks)
+
+    def _first_round(self):
+        """Attacks are (target, names, test, defaults) tuples."""
+        self._sent = collections.Counter()
+        self._confirmed = set()  # (form, name) of the inputs the early stop is done with
+        self._stopped_forms = set()
+        self._probes = self._pruned = self._not_sent = 0
+        probing = self.policy is not None and self.policy.probe
+        first_round = []
+        for target in self._targets:
+            target.reset()
+            if probing and not target.is_upload:
+                target.open_names = set()
+                first_round.append(self._probe(target, target.names, target.defaults))
+        return first_round + self._next_payloads()
+
+    def _probe(self, target, names, defaults):
+        target.probes += 1
+        self._probes += 1
+        return (target, names, PROBE, defaults)
+
+    def _send(self, attack):
+        """Send attack and return its verdict: (is_flagged, reflection,
+        payload), payload being what was sent, with a nonce of its own."""
+        target, names, test, defaults = attack
+        if self.verifier is None:
+            payload = self._payload(names, test, defaults)
+            is_accepted = self.web_io.was_request_accepted(target.url.url, target.method,
+                                                           target.is_upload, payload)
+            return self._acceptance_verdict(is_accepted, payload)
+        request_nonce = nonce()
+        payload = self._payload(names, test, defaults, request_nonce)
+        return self._verdict(self.web_io.get_page_response(target.url.url, target.method,
+                                                           target.is_upload, payload),
+                             test, request_nonce, payload)
+
+    async def _send_async(self, attack):
+        target, names, test, defaults = attack
+        if self.verifier is None:
+            payload = self._payload(names, test, defaults)
+            is_accepted = await self.web_io.was_request_accepted(target.url.url, target.method,
+                                                                 target.is_upload, payload)
+            return self._acceptance_verdict(is_accepted, payload)
+        request_nonce = nonce()
+        payload = self._payload(names, test, defaults, request_nonce)
+        return self._verdict(await self.web_io.get_page_response(target.url.url, target.method,
+                                                                  target.is_upload, payload),
+                             test, request_nonce, payload)
+
+    def _acceptance_verdict(self, is_accepted, payload):
+        if is_accepted is None:
+            return True, UNVERIFIED, payload
+        return is_accepted, None, payload
+
+    def _verdict(self, response, test, request_nonce, payload):
+        if response is not None and response.status_code in THROTTLE_STATUSES:
+            return True, UNVERIFIED, payload
+        if not (response and 200 <= response.status_code < 300):
+            return False, None, payload
+        if test == PROBE and self.reflected_only:
+            # an input encoding < and > may still be open inside an attribute
+            survivors = self.verifier.probe_survivors(response.text, request_nonce)
+            return bool(survivors) or response.truncated, None, payload
+        reflection = self.verifier.verify(response.text, test, request_nonce)
+        if reflection != REFLECTED and response.truncated:
+            # it may be past where the body was cut
+            return True, UNVERIFIED, payload
+        return (reflection == REFLECTED if self.reflected_only else True), reflection, payload
+
+    def _next_round(self, attacks, verdicts, flagged_attacks):
+        """Add the (attack, reflection, payload) of the flagged attacks on a
+        single input to flagged_attacks, and return the attacks for the next round:
+        both halves of every flagged attack on more than one input, and the
+        next payloads of every target."""
+        next_round = []
+        for attack, (is_flagged, reflection, payload) in zip(attacks, verdicts):
+            target, names, test, defaults = attack
+            if test == PROBE:
+                target.probes -= 1
+            if not is_flagged:
+                continue
+            if reflection == UNVERIFIED and test != PROBE:
+                # bisecting it would only send more requests to a host throttling us
+                flagged_attacks.append((attack, reflection, payload))
+                continue
+            if len(names) == 1:
+                if test == PROBE:
+                    target.open_names.add(names[0])
+                else:
+                    flagged_attacks.append((attack, reflection, payload))
+                    self._confirm(target, names[0])
+                continue
+            next_round.extend(self._halves(attack))
+        return next_round + self._next_payloads()
+
+    def _halves(self, attack):
+        """Both halves of a flagged attack, leaving out the inputs the early
+        stop is done with. The inputs of a half which is not attacked get
+        their defaults."""
+        target, names, test, defaults = attack
+        if test != PROBE:
+            if target.form in self._stopped_forms:
+                return []
+            names, defaults = self._names_left(target, names, defaults)
+            if len(names) < 2:  # it may have been flagged for the ones left out
+                return [(target, names, test, defaults)] if names else []
+        half = len(names) // 2
+        halves = []
+        for attacked, others in ((names[:half], names[half:]), (names[half:], names[:half])):
+            half_defaults = self._with_defaults(target, defaults, others)
+            if test == PROBE:
+                halves.append(self._probe(target, attacked, half_defaults))
+            else:
+                halves.append((target, attacked, test, half_defaults))
+        return halves
+
+    def _with_defaults(self, target, defaults, names):
+        """Defaults, plus the default of every input on names."""
+        if target.is_upload or not names:  # there is no default file to upload
+            return defaults
+        defaults = dict(defaults)
+        defaults.update((name, self._default_of(target.url, name)) for name in names)
+        return defaults
+
+    def _names_left(self, target, names, defaults):
+        """The names the early stop is not done with, and defaults for the rest."""
+        left = tuple(name for name in names if (target.form, name) not in self._confirmed)
+        if len(left) == len(names):
+            return names, defaults
+        return left, self._with_defaults(target, defaults, [name for name in names
+                                                            if name not in left])
+
+    def _confirm(self, target, name):
+        """A payload was confirmed on the input name of target."""
+        early_stop = self.policy.early_stop if self.policy is not None else 'none'
+        if early_stop == 'input':
+            self._confirmed.add((target.form, name))
+        elif early_stop == 'form':
+            self._stopped_forms.add(target.form)
+
+    def _next_payloads(self):
+        """The next wave of payloads of every target done probing. What
+        is not sent to an input because of the early stop is counted on
+        _not_sent, a payload and an input at a time."""
+        attacks = []
+        for target in self._targets:
+            if target.probes or not target.tests:
+                continue
+            if target.open_names is not None:  # it just finished probing
+                closed = [name for name in target.names if name not in target.open_names]
+                target.defaults = self._with_defaults(target, target.defaults, closed)
+                target.names = tuple(name for name in target.names if name in target.open_names)
+                target.open_names = None
+                self._pruned += len(closed)
+            names, defaults = self._names_left(target, target.names, target.defaults)
+            if target.form in self._stopped_forms:
+                names = ()
+            wave = self.policy.wave_size(len(target.tests)) if self.policy else len(target.tests)
+            wave = min(wave, len(target.tests)) if names else len(target.tests)
+            self._not_sent += wave * (len(target.names) - len(names))
+            if not names:
+                target.tests.clear()
+                continue
+            for _ in range(wave):
+                test = target.tests.popleft()
+                self._sent[test] += 1
+                attacks.append((target, names, test, defaults))
+        return attacks
+
+    def _default_of(self, url, name):
+        """The default value of the input named name on the forms to url."""
+        if self._defaults is None:
+            self._defaults = {}
+            for _, action, fields in self._scrapped_website.get_exposed_form_fields():
+                for field_type, field_name, value in fields:
+                    self._defaults.setdefault((action, field_name), default_value(field_type, value))
+        return self._defaults.get((url, name), 'test')
+
+    def _found_xss(self, flagged_attacks):
+        """Turn the flagged attacks into XSS objects. The findings of the
+        surfaces we claimed are handed to the surface index, which may
+        attribute them to other pages too, and what was sent and found to
+        the policy."""
         base_url = self._scrapped_website.url
-        found_xss_list = []
-        for method, url, is_upload, payload in self.attack_information:
-            if self.web_io.was_request_accepted(url.url, method, is_upload, payload):
-                xss_found = XSS(base_url, payload, method)
-                found_xss_list.append(xss_found)
+        found_xss_list = list(self._inherited_xss)
+        findings_by_surface = {key: [] for key in self._claimed_surfaces}
+        hits = set()
+        for (target, names, test, defaults), reflection, payload in flagged_attacks:
+            found_xss_list.append(XSS(base_url, payload, target.method, reflection))
+            if reflection != UNVERIFIED:
+                hits.add((id(target), test))
+            if target.surface is not None:
+                findings_by_surface[target.surface].append((payload, target.method, reflection))
+        for key, findings in findings_by_surface.items():
+            found_xss_list.extend(self._surface_index.complete(key, findings))
+        if self.policy is not None:
+            self.policy.record(self._sent, collections.Counter(test for _, test in hits),
+                               self._probes, self._pruned, self._not_sent)
         return found_xss_list
 
+    def _abandon_surfaces(self):
+        for key in self._claimed_surfaces:
+            self._surface_index.abandon(key)
+
 # scrap = ScrappedWebsite(URL, HTML_STRING)
 # xss = XSSDetector(scrap)
 # page = requests.get('https://xss-game.appspot.com/level1/frame')
@@ -0,0 +1,76 @@
+import asyncio
+import concurrent.futures
+import multiprocessing
+import threading
+from models.extractors import extract
+from models.models import ScrappedWebsite
+
+"""Parsers turn the HTML of a website into a ScrappedWebsite. Where that
+happens is what they are about: the InlineParser does it right there, in
+the thread (or coroutine) that fetched the website. The ProcessPoolParser
+sends the HTML to a pool of processes and waits for the extracted links and
+forms to come back, so parsing is not held back by the GIL and uses every
+core while the fetching threads keep doing I/O.
+"""
+
+def _extract_compact(html_string, extractor):
+    """Runs on the parser processes. The links are deduplicated there, so
+    less has to be sent back."""
+    extraction = extract(html_string, extractor)
+    extraction.links = list(dict.fromkeys(extraction.links))
+    return extraction
+
+class InlineParser:
+    """Parse websites on the caller's thread."""
+    def __init__(self, extractor='stream'):
+        self.extractor = extractor
+
+    def parse(self, url, html_string):
+        return ScrappedWebsite(url, html_string, self.extractor)
+
+    async def parse_async(self, url, html_string):
+        return self.parse(url, html_string)
+
+    def close(self):
+        pass
+
+class ProcessPoolParser:
+    """Parse websites on a pool of processes processes. At most max_pending
+    websites will be waiting to be parsed: callers asking for more wait
+    for a free slot, so a slow pool doesn't pile up HTML in memory."""
+    def __init__(self, extractor='stream', processes=None, max_pending=None):
+        """Processes defaults to the number of cores and max_pending to
+        twice the number of processes. The processes are spawned rather than
+        forked, as forking a process full of threads is asking for trouble."""
+        self.extractor = extractor
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_pending = max_pending or 2 * self.processes
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            self.processes, mp_context=multiprocessing.get_context('spawn'))
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._async_slots = None
+
+    def parse(self, url, html_string):
+        with self._slots:
+            future = self._pool.submit(_extract_compact, html_string, self.extractor)
+            extraction = future.result()
+        return ScrappedWebsite.from_extraction(url, extraction)
+
+    async def parse_async(self, url, html_string):
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self.max_pending)
+        async with self._async_slots:
+            loop = asyncio.get_running_loop()
+            extraction = await loop.run_in_executor(self._pool, _extract_compact,
+                                                    html_string, self.extractor)
+        return ScrappedWebsite.from_extraction(url, extraction)
+
+    def close(self):
+        self._pool.shutdown()
+
+def make_parser(extractor='stream', processes=0, max_pending=None):
+    """Return an InlineParser if processes is 0, else a ProcessPoolParser.
+    A negative processes means one per core."""
+    if processes == 0:
+        return InlineParser(extractor)
+    return ProcessPoolParser(extractor, processes if processes > 0 else None, max_pending)
@@ -0,0 +1,114 @@
+import collections
+import re
+import threading
+
+"""In which order payloads are sent to a form, and when to stop sending
+them. Payloads that found something on previous scans go first, and so do
+payloads of families that did: a payload never sent before is assumed to
+do as well as the rest of its family. Payloads doing equally well are
+interleaved by family, so the first few sent to a form try different
+things instead of twenty variations of the same <script>.
+
+Order alone saves nothing if every payload is sent anyway: it pays off
+with an early stop, which stops attacking an input (or a whole form) once
+a payload was confirmed on it. Without one, payloads are all sent at once,
+as they always were.
+
+Apart from that, inputs which block everything are pruned with a probe:
+before any payload, the form is sent PROBE (see models/verification.py),
+which has the characters every payload needs and nothing else. Inputs on
+which the probe isn't flagged are left out of every payload. When verifying
+reflections, it is flagged if any of its quotes, < or > comes back as sent:
+an input which only encodes < and > may still be broken out of inside an
+attribute. Only inputs which don't come back, or come back with every one
+of them encoded or stripped, are pruned.
+"""
+
+EARLY_STOPS = ('none', 'input', 'form')
+
+# the first one matching a payload is its family
+FAMILIES = (('script', re.compile(r'<\s*script', re.I)),
+            ('event_handler', re.compile(r'\bon[a-z]+\s*=', re.I)),
+            ('uri', re.compile(r'(javascript|vbscript|data)\s*:', re.I)),
+            ('tag', re.compile(r'<\s*[a-z!/]', re.I)),
+            ('breakout', re.compile(r'["\'`>]')))
+
+def family(test):
+    """The family of a payload: one of FAMILIES, 'upload' for upload tests
+    or 'other'."""
+    if isinstance(test, bytes):
+        return 'upload'
+    for name, pattern in FAMILIES:
+        if pattern.search(test):
+            return name
+    return 'other'
+
+class PayloadPolicy:
+    """Shared by every XSSDetector of a scan, which ask it for the order of
+    their payloads and tell it what they sent and found. If a PayloadHistory
+    (persistence/payload_history.py) is given, that goes there too.
+
+    Early_stop is one of EARLY_STOPS. With one, payloads are sent wave
+    payloads at a time to every form, so there is something to stop."""
+    def __init__(self, history=None, early_stop='none', probe=False, wave=4):
+        if early_stop not in EARLY_STOPS:
+            raise ValueError("Unknown early stop {0!r}".format(early_stop))
+        self.history = history
+        self.early_stop = early_stop
+        self.probe = probe
+        self.wave = wave
+        self._lock = threading.Lock()
+        self._families = {}
+        self._counters = collections.Counter()
+
+    def family(self, test):
+        families = self._families
+        test_family = families.get(test)
+        if test_family is None:
+            test_family = families[test] = family(test)
+        return test_family
+
+    def order(self, tests):
+        """Return tests, best first."""
+        families = [self.family(test) for test in tests]
+        if self.history is not None:
+            counts = self.history.counts(tests)
+        else:
+            counts = [(0, 0)] * len(tests)
+        family_counts = collections.defaultdict(lambda: [0, 0])
+        for test_family, (sent, hits) in zip(families, counts):
+            family_counts[test_family][0] += sent
+            family_counts[test_family][1] += hits
+        # every payload starts with the hit rate of its family, worth two forms
+        family_rates = {test_family: (hits + 1) / (sent + 2)
+                        for test_family, (sent, hits) in family_counts.items()}
+        keys = []
+        seen_of_family = collections.Counter()
+        for position, (test_family, (sent, hits)) in enumerate(zip(families, counts)):
+            rate = (hits + 2 * family_rates[test_family]) / (sent + 2)
+            keys.append((-rate, seen_of_family[test_family], position))
+            seen_of_family[test_family] += 1
+        return [tests[position] for _, _, position in sorted(keys)]
+
+    def wave_size(self, pending):
+        """How many of pending payloads to send at once to a form."""
+        return pending if self.early_stop == 'none' else self.wave
+
+    def record(self, sent, hits, probes=0, pruned=0, not_sent=0):
+        """Tell the policy what an XSSDetector did. Sent and hits are
+        counters by test: forms it was sent to, and flagged on. Probes are
+        the requests spent on the probe, pruned the inputs it left out and
+        not_sent how many times a payload was not sent to an input because
+        of the early stop."""
+        with self._lock:
+            self._counters.update(payloads_sent=sum(sent.values()), probes=probes,
+                                  pruned_inputs=pruned, not_sent=not_sent)
+        if self.history is not None:
+            self.history.record(sent, hits, {test: self.family(test) for test in sent})
+
+    def stats(self):
+        with self._lock:
+            stats = dict(payloads_sent=0, not_sent=0, pruned_inputs=0, probes=0)
+            stats.update(self._counters)
+        stats.update(early_stop=self.early_stop, probe=self.probe)
+        return stats
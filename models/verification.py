@@ -0,0 +1,198 @@
+import functools
+import hashlib
+import html
+import secrets
+from urllib.parse import quote, quote_plus
+from models.scheduling import family
+
+"""Telling if a payload made it to the response, and how. Every test of the
+corpus is tagged with a canary of its own, which is sent right before it,
+and every request with a nonce of its own, sent right before the canary:
+'<script>' becomes '9f8e7dxsc1a2b3c4d<script>'. The response is then looked
+for, with the nonce of the request in front:
+
+    * the tagged test, as sent: it was reflected.
+    * the tagged test, encoded (HTML escaped or URL quoted), or just the
+      canary: it made it to the response, but not in a way a browser would
+      run it. It was encoded.
+    * none of the above: it is absent.
+
+A tag in front would break some tests, which get it after them instead. A
+URI ('javascript:alert(1)') wouldn't be one anymore, so it gets a JavaScript
+comment with the tag: 'javascript:alert(1)//9f8e7dxsc1a2b3c4d'. Nor would
+an upload start with the magic bytes of its format, so it gets the tag at
+its end. Those are reflected if the tag comes back right after the test as
+sent, and encoded if it comes back otherwise.
+
+Every variant of every test is a pattern of a single automaton, built once
+per corpus, so a response is looked at once whatever the size of the
+corpus, instead of once per regular expression. The nonce is not on the
+patterns: it is hex, which neither HTML escaping nor URL quoting touch, so
+it is checked right before every match instead. Without it, a payload
+stored by a form and shown on every page (a guestbook, the latest
+comments) would flag every later form sent the same payload.
+"""
+
+REFLECTED = 'reflected'
+ENCODED = 'encoded'
+ABSENT = 'absent'
+OUTCOMES = (REFLECTED, ENCODED, ABSENT)  # best first
+TAGGED_AFTER = ('uri', 'upload')  # the families of models/scheduling.py tagged after the test
+# never looked at: the host kept throttling the request until the retries ran out
+UNVERIFIED = 'unverified'
+
+MARKER = 'xsc'
+# not an XSS, but an input which blocks or encodes every character of it will
+# block or encode every payload; one which lets any of them through may not
+PROBE = '\'"><probe>'
+PROBE_CHARACTERS = '\'"<>'
+NONCE_LENGTH = 6
+
+def nonce():
+    """A new nonce, for a request."""
+    return secrets.token_hex(NONCE_LENGTH // 2)
+
+def canary(test):
+    """The canary of test: always the same for the same test, so the
+    automaton can be built before anything is sent."""
+    test = test if isinstance(test, bytes) else test.encode('utf-8', 'surrogatepass')
+    return MARKER + hashlib.blake2b(test, digest_size=4).hexdigest()
+
+class PatternAutomaton:
+    """An Aho-Corasick automaton without failure links: every pattern starts
+    with the same marker, so a match can only start where the marker is.
+    Those places are found by str.find, at C speed, and the automaton is
+    only walked from them; the walk never goes further than the longest
+    pattern. Same matches as the full automaton, a fraction of the work
+    when there are few markers in the text, which is always."""
+    def __init__(self, marker, patterns):
+        """Patterns is an iterable of (pattern, value). Every pattern must
+        start with marker."""
+        self.marker = marker
+        self._goto = [{}]
+        self._output = [None]
+        self._longest = 0
+        for pattern, value in patterns:
+            if not pattern.startswith(marker):
+                raise ValueError("Pattern {0!r} doesn't start with {1!r}".format(pattern, marker))
+            self._add(pattern, value)
+
+    def _add(self, pattern, value):
+        self._longest = max(self._longest, len(pattern))
+        state = 0
+        for character in pattern:
+            next_state = self._goto[state].get(character)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][character] = next_state
+                self._goto.append({})
+                self._output.append(None)
+            state = next_state
+        self._output[state] = value
+
+    def iter_matches(self, text):
+        """Yield (start, value) for every pattern found on text."""
+        goto = self._goto
+        output = self._output
+        start = text.find(self.marker)
+        while start != -1:
+            state = 0
+            for character in text[start:start + self._longest]:
+                state = goto[state].get(character)
+                if state is None:
+                    break
+                if output[state] is not None:
+                    yield start, output[state]
+            start = text.find(self.marker, start + 1)
+
+class ReflectionVerifier:
+    """Tags the tests of a corpus and tells where they ended up. Use
+    for_corpus to get the one of a corpus, which is built only once."""
+    def __init__(self, tests):
+        self._tagged = {}
+        self._canaries = {}
+        self._tagged_after = {}  # test: what comes before its tag, as text
+        patterns = []
+        for test in tests:
+            test_canary = self._canaries[test] = canary(test)
+            if family(test) in TAGGED_AFTER:
+                self._tagged_after[test] = (test.decode('utf-8', 'replace')
+                                            if isinstance(test, bytes) else test + '//')
+                continue
+            tagged = test_canary.encode() + test if isinstance(test, bytes) else test_canary + test
+            self._tagged[test] = tagged
+            text = tagged.decode('utf-8', 'replace') if isinstance(tagged, bytes) else tagged
+            patterns.append((test_canary, (test_canary, ENCODED)))
+            for encoded in (html.escape(text), html.escape(text, quote=False),
+                            quote(text), quote_plus(text)):
+                if encoded != text:
+                    patterns.append((encoded, (test_canary, ENCODED)))
+            patterns.append((text, (test_canary, REFLECTED)))
+        self._automaton = PatternAutomaton(MARKER, patterns)
+
+    @classmethod
+    @functools.lru_cache(maxsize=4)
+    def for_corpus(cls, corpus):
+        """The verifier of every test of corpus, and of the PROBE."""
+        return cls((PROBE,) + corpus.common_tests + corpus.get_tests + corpus.post_tests +
+                   corpus.file_upload_tests)
+
+    def tag(self, test, request_nonce=''):
+        """The test, with its canary and request_nonce in front, or after
+        it if its family is one of TAGGED_AFTER."""
+        if test in self._tagged_after:
+            if isinstance(test, bytes):
+                return test + (request_nonce + self._canaries[test]).encode()
+            return self._tagged_after[test] + request_nonce + self._canaries[test]
+        tagged = self._tagged.get(test)
+        if tagged is None:
+            return test
+        if isinstance(tagged, bytes):
+            return request_nonce.encode() + tagged
+        return request_nonce + tagged
+
+    def probe_survivors(self, text, request_nonce=''):
+        """The characters of PROBE_CHARACTERS that came back as sent,
+        right after the canary of the PROBE sent with request_nonce, on the
+        response text. Empty if the canary is not there: the input doesn't
+        make it to the response."""
+        probe_canary = request_nonce + (self._canaries.get(PROBE) or canary(PROBE))
+        survivors = set()
+        start = text.find(probe_canary)
+        while start != -1:
+            start += len(probe_canary)
+            # up to where the probe ends, or a bit further if it didn't make it whole
+            window = text[start:start + 8 * len(PROBE)]
+            end = window.find('probe')
+            survivors.update(character for character in PROBE_CHARACTERS
+                             if character in (window if end == -1 else window[:end]))
+            start = text.find(probe_canary, start)
+        return survivors
+
+    def verify(self, text, test, request_nonce=''):
+        """Return REFLECTED, ENCODED or ABSENT, for test sent with
+        request_nonce on the response text. Test sent by other requests
+        doesn't count."""
+        test_canary = self._canaries.get(test) or canary(test)
+        if request_nonce + test_canary not in text:
+            return ABSENT
+        if test in self._tagged_after:
+            return self._verify_tagged_after(text, test, request_nonce + test_canary)
+        best = ABSENT
+        for start, (match_canary, outcome) in self._automaton.iter_matches(text):
+            if (match_canary == test_canary and OUTCOMES.index(outcome) < OUTCOMES.index(best)
+                    and start >= len(request_nonce)
+                    and text.startswith(request_nonce, start - len(request_nonce))):
+                best = outcome
+                if best == REFLECTED:
+                    break
+        return best
+
+    def _verify_tagged_after(self, text, test, tag):
+        before = self._tagged_after[test]
+        start = text.find(tag)
+        while start != -1:
+            if start >= len(before) and text.startswith(before, start - len(before)):
+                return REFLECTED
+            start = text.find(tag, start + 1)
+        return ENCODED
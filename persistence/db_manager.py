@@ -1,11 +1,143 @@
-import dataset
+import queue
+import sqlite3
+import threading
+import time
+from logs.logger import logger
 
-class DBManager:
-    def __init__(self, url):
-        self.table_name = url
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS xss (
+    id INTEGER PRIMARY KEY,
+    scan TEXT NOT NULL,
+    url TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    method TEXT NOT NULL,
+    found_at REAL NOT NULL,
+    reflection TEXT
+);
+CREATE INDEX IF NOT EXISTS xss_scan_url ON xss (scan, url);
+CREATE INDEX IF NOT EXISTS xss_found_at ON xss (found_at);
+"""
+
+class ResultWriter(threading.Thread):
+    """The only thread which writes to the database. Workers hand it their
+    XSS lists through a bounded queue and go on with their lives; it writes
+    them in batches, each batch in a single transaction, over one
+    connection which lives as long as the scan.
+
+    Every XSS goes to the xss table, with the initial url of the scan on
+    the scan column and where its payload ended up on the response, if it
+    was verified, on the reflection column. Databases of older versions,
+    with a table per initial url, are moved to it the first time.
+    """
+    _STOP = object()
+
+    def __init__(self, scan, path='persistence/xss.db', batch_size=500,
+                 flush_interval=1.0, max_pending=10000, stats=None, journal_mode='WAL'):
+        """Scan is the initial url. A batch is written when batch_size XSS
+        are waiting or when the oldest one has waited flush_interval
+        seconds, whatever happens first. If max_pending XSS lists are
+        queued, workers will wait for the writer to catch up. If a
+        ScanStats is given, every batch is timed on it as db_write.
+        Journal_mode is the sqlite one: WAL only works if every process
+        writing to path is on the same host, DELETE works anywhere."""
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.scan = scan
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal_mode = journal_mode
+        self._pending = queue.Queue(maxsize=max_pending)
+        self.scan_stats = stats
+        self.rows_written = 0
+
+    def stats(self):
+        return dict(rows_written=self.rows_written, lists_queued=self._pending.qsize())
 
     def write_xss_list_to_db(self, xss_list):
-        with dataset.connect('sqlite:///persistence/xss.db') as connection:
-            for xss in xss_list:
-                data = dict(url=xss.url, payload=xss.payload, method=xss.method)
-                connection[self.table_name].insert(data)
+        """Queue the XSS on xss_list to be written. Doesn't touch the disk."""
+        if xss_list:
+            self._pending.put(xss_list)
+
+    def close(self):
+        """Write whatever is still queued and wait for the writer to finish."""
+        self._pending.put(ResultWriter._STOP)
+        self.join()
+
+    def run(self):
+        connection = self._connect()
+        try:
+            self._write_until_stopped(connection)
+        finally:
+            connection.close()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute('PRAGMA journal_mode={0}'.format(self.journal_mode))
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(SCHEMA)
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(xss)')]
+        if 'reflection' not in columns:  # a database from before it existed
+            connection.execute('ALTER TABLE xss ADD COLUMN reflection TEXT')
+        self._migrate_scan_tables(connection)
+        return connection
+
+    def _migrate_scan_tables(self, connection):
+        """Older versions wrote every scan to a table of its own, named
+        after its initial url, with url, payload and method columns. Copy
+        them to the xss table, with their names as scan, and drop them.
+        When they were found is not known: older than anything else."""
+        tables = []
+        for name, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                        "AND name NOT LIKE 'sqlite_%' AND name != 'xss'"):
+            quoted = '"{0}"'.format(name.replace('"', '""'))
+            columns = {row[1] for row in connection.execute('PRAGMA table_info({0})'.format(quoted))}
+            if {'url', 'payload', 'method'} <= columns:
+                tables.append((name, quoted))
+        if not tables:
+            return
+        with connection:
+            for name, quoted in tables:
+                connection.execute('INSERT INTO xss (scan, url, payload, method, found_at) '
+                                   'SELECT ?, url, payload, method, 0 FROM ' + quoted, (name,))
+                connection.execute('DROP TABLE ' + quoted)
+        logger.info("Moved the XSS of {0} scans of an older version to the xss table."
+                    .format(len(tables)))
+
+    def _write_until_stopped(self, connection):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                xss_list = self._pending.get(timeout=timeout)
+            except queue.Empty:
+                xss_list = None
+            if xss_list is ResultWriter._STOP:
+                self._flush(connection, batch)
+                return
+            if xss_list is not None:
+                now = time.time()
+                batch.extend((self.scan, xss.url, xss.payload, xss.method, now, xss.reflection)
+                             for xss in xss_list)
+                deadline = deadline or time.monotonic() + self.flush_interval
+            if len(batch) >= self.batch_size or (deadline and time.monotonic() >= deadline):
+                self._flush(connection, batch)
+                batch = []
+                deadline = None
+
+    def _flush(self, connection, batch):
+        """Write batch in a single transaction, rolling back if it fails.
+        A failed batch is logged and lost, but the writer keeps going."""
+        if not batch:
+            return
+        started = time.perf_counter()
+        try:
+            with connection:
+                connection.executemany('INSERT INTO xss (scan, url, payload, method, found_at, '
+                                       'reflection) VALUES (?, ?, ?, ?, ?, ?)', batch)
+            self.rows_written += len(batch)
+            if self.scan_stats is not None:
+                self.scan_stats.observe('db_write', time.perf_counter() - started)
+        except sqlite3.Error:
+            logger.exception("Could not write {0} XSS to the database.".format(len(batch)))
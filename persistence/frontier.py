@@ -0,0 +1,292 @@
+import collections
+import hashlib
+import math
+import queue
+import sqlite3
+import threading
+import time
+from logs.logger import logger
+from models.models import URL
+
+"""The frontier: every URL the scan found and still has to process, plus
+the fingerprint of every URL it ever found, so none is processed twice.
+
+It is meant to survive big sites and dead processes. URLs waiting to be
+processed are kept in memory up to a limit, and written to disk beyond it.
+URLs already seen are kept as 64 bit fingerprints instead of URL objects,
+and they can also go to disk, with a Bloom filter in front so new URLs
+don't need a disk lookup. And every so often everything needed to continue
+the scan is checkpointed to disk, so scanner.py --resume can pick it up.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending (id INTEGER PRIMARY KEY, url TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS visited (fingerprint INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS queued (url TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value);
+"""
+
+def fingerprint(url):
+    """A 64 bit fingerprint of the key of url. Fits on a sqlite INTEGER."""
+    key = '\n'.join(url.key).encode('utf-8', 'surrogatepass')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big', signed=True)
+
+class BloomFilter:
+    """A Bloom filter of fingerprints: no false negatives, and about
+    error_rate false positives when holding capacity fingerprints."""
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, fingerprint):
+        # double hashing over the two halves of the fingerprint
+        first, second = fingerprint & 0xffffffff, (fingerprint >> 32) & 0xffffffff
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, fingerprint):
+        for position in self._positions(fingerprint):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, fingerprint):
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(fingerprint))
+
+class Frontier:
+    """A thread-safe queue of URLs which doesn't take a URL it has already
+    seen. Claiming is atomic: put returns True only for the one caller which
+    got to add the URL, so no URL is processed twice, however many workers
+    find it at the same time.
+
+    Works like a queue.Queue with task_done and join, except task_done
+    takes the URL which is done, so the frontier knows which URLs are
+    being processed when it checkpoints.
+    """
+    poll_interval = None  # every change is made here and notified, see SharedFrontier
+
+    def __init__(self, path='persistence/frontier.db', max_pending_in_memory=100000,
+                 max_visited_in_memory=1000000, checkpoint_interval=60,
+                 bloom_error_rate=0.001):
+        """Path is the sqlite file where URLs are spilled and checkpointed.
+        Beyond max_pending_in_memory waiting URLs, new ones go to disk.
+        Beyond max_visited_in_memory fingerprints, they go to disk and to a
+        Bloom filter. A checkpoint is done every checkpoint_interval seconds
+        (None to never do one on its own)."""
+        self.path = path
+        self.max_pending_in_memory = max_pending_in_memory
+        self.max_visited_in_memory = max_visited_in_memory
+        self.checkpoint_interval = checkpoint_interval
+        self.bloom_error_rate = bloom_error_rate
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._all_tasks_done = threading.Condition(self._lock)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript(SCHEMA)
+        self._pending = collections.deque()  # url strings
+        self._spill_buffer = []
+        self._spilled = 0  # urls on the pending table not read back yet
+        self._spill_cursor = 0  # id of the last url read back from pending
+        self._seen = set()
+        self._unsaved_fingerprints = []
+        self._bloom = None  # only needed once fingerprints are on disk
+        self._in_flight = collections.Counter()
+        self._last_checkpoint = time.monotonic()
+        self.unfinished_tasks = 0
+
+    @classmethod
+    def open(cls, path='persistence/frontier.db', resume=False, **kwargs):
+        """Return a Frontier on path. If resume, continue from its last
+        checkpoint, raising ValueError if there is none; else, forget
+        whatever was on it."""
+        frontier = cls(path, **kwargs)
+        if resume:
+            frontier._resume()
+        else:
+            frontier._clear()
+        return frontier
+
+    def put(self, url):
+        """Add url if it was never seen. Return True if it was added."""
+        url_fingerprint = fingerprint(url)
+        with self._lock:
+            if self._is_seen(url_fingerprint):
+                return False
+            self._mark_seen(url_fingerprint)
+            self.unfinished_tasks += 1
+            if len(self._pending) < self.max_pending_in_memory and not self._spilled_anything():
+                self._pending.append(url.url)
+            else:
+                self._spill(url.url)
+            self._not_empty.notify()
+            return True
+
+    def get(self, block=True, timeout=None):
+        """Remove and return a URL. Like queue.Queue.get, raises queue.Empty
+        if not block and there is none, or if none came before timeout."""
+        with self._not_empty:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self._pending and not self._read_back_spilled():
+                if not block:
+                    raise queue.Empty
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self._not_empty.wait(remaining)
+            url_string = self._pending.popleft()
+            self._in_flight[url_string] += 1
+            return URL(url_string)
+
+    def task_done(self, url):
+        """Mark url, which was returned by get, as processed."""
+        with self._lock:
+            self._in_flight[url.url] -= 1
+            if self._in_flight[url.url] <= 0:
+                del self._in_flight[url.url]
+            self.unfinished_tasks -= 1
+            if self.unfinished_tasks <= 0:
+                self._all_tasks_done.notify_all()
+            if (self.checkpoint_interval is not None and
+                    time.monotonic() - self._last_checkpoint >= self.checkpoint_interval):
+                self._checkpoint()
+
+    def join(self):
+        """Block until every URL put was marked as done."""
+        with self._all_tasks_done:
+            while self.unfinished_tasks:
+                self._all_tasks_done.wait()
+
+    def qsize(self):
+        with self._lock:
+            return len(self._pending) + len(self._spill_buffer) + self._spilled
+
+    def stats(self):
+        with self._lock:
+            return dict(queued=len(self._pending) + len(self._spill_buffer) + self._spilled,
+                        in_progress=sum(self._in_flight.values()),
+                        unfinished=self.unfinished_tasks,
+                        spilled=len(self._spill_buffer) + self._spilled,
+                        seen_in_memory=len(self._seen),
+                        seen_on_disk=self._bloom is not None)
+
+    def checkpoint(self):
+        """Save everything needed to resume the scan."""
+        with self._lock:
+            self._checkpoint()
+
+    def close(self):
+        self.checkpoint()
+        with self._lock:
+            self._connection.close()
+
+    def _is_seen(self, url_fingerprint):
+        if url_fingerprint in self._seen:
+            return True
+        if self._bloom is None or url_fingerprint not in self._bloom:
+            return False
+        return self._connection.execute('SELECT 1 FROM visited WHERE fingerprint = ?',
+                                        (url_fingerprint,)).fetchone() is not None
+
+    def _mark_seen(self, url_fingerprint):
+        self._seen.add(url_fingerprint)
+        self._unsaved_fingerprints.append(url_fingerprint)
+        if len(self._seen) > self.max_visited_in_memory:
+            self._move_seen_to_disk()
+
+    def _move_seen_to_disk(self):
+        if self._bloom is None:
+            self._bloom = BloomFilter(self.max_visited_in_memory * 10, self.bloom_error_rate)
+        self._save_fingerprints()
+        for url_fingerprint in self._seen:
+            self._bloom.add(url_fingerprint)
+        self._seen = set()
+
+    def _save_fingerprints(self):
+        with self._connection:
+            self._connection.executemany('INSERT OR IGNORE INTO visited VALUES (?)',
+                                         ((f,) for f in self._unsaved_fingerprints))
+        self._unsaved_fingerprints = []
+
+    def _spilled_anything(self):
+        return bool(self._spill_buffer or self._spilled)
+
+    def _spill(self, url_string):
+        self._spill_buffer.append(url_string)
+        if len(self._spill_buffer) >= 1000:
+            self._flush_spill_buffer()
+
+    def _flush_spill_buffer(self):
+        if self._spill_buffer:
+            with self._connection:
+                self._connection.executemany('INSERT INTO pending (url) VALUES (?)',
+                                             ((url,) for url in self._spill_buffer))
+            self._spilled += len(self._spill_buffer)
+            self._spill_buffer = []
+
+    def _read_back_spilled(self):
+        """Move a batch of URLs from disk to memory. Return True if any.
+        Rows are not deleted until the next checkpoint, which is the one
+        that saves them elsewhere."""
+        self._flush_spill_buffer()
+        if not self._spilled:
+            return False
+        batch_size = max(self.max_pending_in_memory // 2, 1)
+        rows = self._connection.execute('SELECT id, url FROM pending WHERE id > ? '
+                                        'ORDER BY id LIMIT ?',
+                                        (self._spill_cursor, batch_size)).fetchall()
+        for row_id, url_string in rows:
+            self._pending.append(url_string)
+            self._spill_cursor = row_id
+        self._spilled -= len(rows)
+        return bool(rows)
+
+    def _checkpoint(self):
+        """URLs in memory, waiting or being processed, are saved on the
+        queued table, as are the fingerprints not on disk yet. In a single
+        transaction, so a crash leaves the previous checkpoint intact."""
+        self._flush_spill_buffer()
+        with self._connection:
+            self._connection.executemany('INSERT OR IGNORE INTO visited VALUES (?)',
+                                         ((f,) for f in self._unsaved_fingerprints))
+            self._connection.execute('DELETE FROM queued')
+            self._connection.executemany('INSERT INTO queued VALUES (?)',
+                                         ((url,) for url in self._in_flight))
+            self._connection.executemany('INSERT INTO queued VALUES (?)',
+                                         ((url,) for url in self._pending))
+            self._connection.execute('DELETE FROM pending WHERE id <= ?', (self._spill_cursor,))
+            self._connection.execute("INSERT OR REPLACE INTO meta VALUES ('checkpoint_at', ?)",
+                                     (time.time(),))
+        self._unsaved_fingerprints = []
+        self._last_checkpoint = time.monotonic()
+        logger.info("Frontier checkpointed: {0} URLs to go.".format(
+            len(self._pending) + len(self._in_flight) + self._spilled))
+
+    def _clear(self):
+        with self._connection:
+            for table in ('pending', 'visited', 'queued', 'meta'):
+                self._connection.execute('DELETE FROM {0}'.format(table))
+
+    def _resume(self):
+        """Load the last checkpoint. Fingerprints stay on disk, behind a
+        Bloom filter. URLs spilled after the checkpoint are still on the
+        pending table, so they are waiting too; URLs processed after it
+        will be processed again."""
+        checkpoint_at = self._connection.execute(
+            "SELECT value FROM meta WHERE name = 'checkpoint_at'").fetchone()
+        if checkpoint_at is None:
+            self._connection.close()
+            raise ValueError("There is no checkpoint to resume on {0}.".format(self.path))
+        # the fingerprints of URLs spilled after the checkpoint were not saved
+        spilled_urls = self._connection.cursor().execute('SELECT url FROM pending')
+        with self._connection:
+            self._connection.executemany('INSERT OR IGNORE INTO visited VALUES (?)',
+                                         ((fingerprint(URL(url)),) for (url,) in spilled_urls))
+        visited = self._connection.execute('SELECT COUNT(*) FROM visited').fetchone()[0]
+        self._bloom = BloomFilter(max(visited * 2, self.max_visited_in_memory * 10),
+                                  self.bloom_error_rate)
+        for (url_fingerprint,) in self._connection.execute('SELECT fingerprint FROM visited'):
+            self._bloom.add(url_fingerprint)
+        self._pending.extend(url for (url,) in self._connection.execute('SELECT url FROM queued'))
+        self._spilled = self._connection.execute('SELECT COUNT(*) FROM pending').fetchone()[0]
+        self.unfinished_tasks = len(self._pending) + self._spilled
+        logger.info("Resuming scan: {0} URLs seen, {1} to go.".format(visited, self.unfinished_tasks))
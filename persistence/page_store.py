@@ -0,0 +1,270 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from logs.logger import logger
+from models.models import URL, XSS
+
+"""What a scan learnt about every page, kept for the next scan of the same
+site, so most of it doesn't need doing again. For every page: its ETag and
+Last-Modified headers, a hash of its content and its links. For every form
+attacked: its surface key and what was found on it.
+
+The next scan asks for every known page with a conditional GET. If the
+server answers 304 Not Modified, or the page comes back the same as it
+was, its links are taken from here and the page is neither parsed nor
+attacked: the XSS found on it last time are reported again instead. Forms
+already attacked are not attacked again on pages which did change, either:
+the surface index is seeded with them, as if they had been attacked earlier
+in this scan.
+
+Every scan gets a number, and pages and the XSS found on them are kept
+with the number of the last scan which looked at them, so the XSS of a page
+are those of its last visit, however many scans ago it changed.
+
+Everything is forgotten if the payloads change, or how they are sent and
+checked, as every form must be attacked again.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    content_hash TEXT NOT NULL,
+    links TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    scan INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS findings (
+    url TEXT NOT NULL,
+    scan INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    method TEXT NOT NULL,
+    reflection TEXT
+);
+CREATE INDEX IF NOT EXISTS findings_url ON findings (url, scan);
+CREATE TABLE IF NOT EXISTS surfaces (
+    surface TEXT PRIMARY KEY,
+    findings TEXT NOT NULL,
+    tested_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value);
+"""
+
+def scan_digest(corpus, settings=None):
+    """A hash of the payloads of corpus and of settings, a dict of whatever
+    else changes what is found with them."""
+    digest = hashlib.blake2b(corpus.digest().encode(), digest_size=16)
+    digest.update(json.dumps(settings or {}, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def content_hash(text):
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).hexdigest()
+
+def dump_surface_key(key):
+    method, action_key, query_names = key
+    return json.dumps([method, list(action_key), sorted(query_names)])
+
+def load_surface_key(surface):
+    method, action_key, query_names = json.loads(surface)
+    return (method, tuple(action_key), frozenset(query_names))
+
+def _as_text(payload):
+    return {name: test.decode('utf-8', 'replace') if isinstance(test, bytes) else test
+            for name, test in payload.items()}
+
+def dump_findings(findings):
+    return json.dumps([(_as_text(payload),) + tuple(rest) for payload, *rest in findings])
+
+def load_findings(text):
+    return [tuple(finding) for finding in json.loads(text)]
+
+class StoredPage:
+    """A page as it was on a previous scan."""
+    __slots__ = ('etag', 'last_modified', 'content_hash', 'links', 'findings')
+
+    def __init__(self, etag, last_modified, content_hash, links, findings=()):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_hash = content_hash
+        self.links = links  # url strings
+        self.findings = findings  # (payload as json, method, reflection)
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def is_unchanged(self, response):
+        return response.status_code == 304 or content_hash(response.text) == self.content_hash
+
+    def get_links(self):
+        return {URL(link) for link in self.links}
+
+    def get_xss(self, url):
+        """The XSS found on url, this page, on its last visit."""
+        return [XSS(url, json.loads(payload), method, reflection)
+                for payload, method, reflection in self.findings]
+
+class PageStore:
+    """Thread-safe, like the Frontier. Writes are kept in memory and written
+    batch_size at a time, pages and surfaces together. Journal_mode works as
+    on the ResultWriter."""
+    def __init__(self, path='persistence/pages.db', batch_size=200, journal_mode='WAL'):
+        self.path = path
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode={0}'.format(journal_mode))
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(pages)')]
+        if columns and 'scan' not in columns:
+            # from before XSS were kept: its pages can't be skipped, their XSS would be lost
+            self._connection.execute('DROP TABLE pages')
+        self._connection.executescript(SCHEMA)
+        self.scan = self._next_scan()
+        self._pages = []
+        self._findings = []
+        self._surfaces = []
+        self.unchanged = 0
+        self.changed = 0
+        self.new = 0
+        self.xss_copied = 0
+
+    @classmethod
+    def open(cls, path='persistence/pages.db', corpus=None, settings=None, **kwargs):
+        """Return a PageStore on path. If corpus, the PayloadCorpus of the
+        scan, or settings, a dict of the options which change what is found
+        with it, are not those the stored forms were attacked with,
+        everything stored is forgotten."""
+        page_store = cls(path, **kwargs)
+        if corpus is not None:
+            page_store._check_corpus(scan_digest(corpus, settings))
+        return page_store
+
+    def previous_visit(self, url):
+        """Return the StoredPage of url, with its XSS, or None if it was
+        never visited."""
+        with self._lock:
+            row = self._connection.execute('SELECT etag, last_modified, content_hash, links, scan '
+                                           'FROM pages WHERE url = ?', (url.url,)).fetchone()
+            if row is None:
+                return None
+            etag, last_modified, stored_hash, links, scan = row
+            findings = self._connection.execute('SELECT payload, method, reflection '
+                                                'FROM findings WHERE url = ? AND scan = ?',
+                                                (url.url, scan)).fetchall()
+        return StoredPage(etag, last_modified, stored_hash, json.loads(links), findings)
+
+    def record_page(self, url, response, links, previous=None):
+        """Remember url as it came on response, with links, a collection
+        of URLs. Previous is its StoredPage, if any, which is only used to
+        count it as changed or new."""
+        row = (url.url, response.headers.get('ETag'), response.headers.get('Last-Modified'),
+               content_hash(response.text), json.dumps(sorted(link.url for link in links)),
+               time.time(), self.scan)
+        with self._lock:
+            if previous is None:
+                self.new += 1
+            else:
+                self.changed += 1
+            self._pages.append(row)
+            self._flush_if_full()
+
+    def record_findings(self, xss_list):
+        """Remember the XSS on xss_list, found on this scan, each with the
+        page it was found on."""
+        with self._lock:
+            self._findings.extend((xss.url, self.scan, xss.payload, xss.method, xss.reflection)
+                                  for xss in xss_list)
+            self._flush_if_full()
+
+    def record_unchanged(self, url, previous):
+        """Remember url, whose StoredPage is previous, as visited on this
+        scan, with the same XSS as last time."""
+        row = (url.url, previous.etag, previous.last_modified, previous.content_hash,
+               json.dumps(previous.links), time.time(), self.scan)
+        with self._lock:
+            self.unchanged += 1
+            self.xss_copied += len(previous.findings)
+            self._pages.append(row)
+            self._findings.extend((url.url, self.scan) + tuple(finding)
+                                  for finding in previous.findings)
+            self._flush_if_full()
+
+    def record_surface(self, key, findings):
+        """Remember the findings of a form, by surface key. Meant to be the
+        on_complete of the AttackSurfaceIndex."""
+        with self._lock:
+            self._surfaces.append((dump_surface_key(key), dump_findings(findings), time.time()))
+            self._flush_if_full()
+
+    def seed(self, surface_index):
+        """Tell surface_index about every form attacked on previous scans."""
+        with self._lock:
+            rows = self._connection.execute('SELECT surface, findings FROM surfaces').fetchall()
+        for surface, findings in rows:
+            surface_index.seed(load_surface_key(surface), load_findings(findings))
+        logger.info("Incremental scan: {0} forms already attacked.".format(len(rows)))
+
+    def stats(self):
+        with self._lock:
+            return dict(unchanged=self.unchanged, changed=self.changed, new=self.new,
+                        xss_copied=self.xss_copied)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._connection.close()
+
+    def _flush_if_full(self):
+        if len(self._pages) + len(self._findings) + len(self._surfaces) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        """Pages, XSS and surfaces go in the same transaction: a page is
+        never stored without the XSS found on it before, nor without the
+        forms that were attacked on it."""
+        if not self._pages and not self._findings and not self._surfaces:
+            return
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO surfaces VALUES (?, ?, ?)',
+                                         self._surfaces)
+            self._connection.executemany('INSERT INTO findings VALUES (?, ?, ?, ?, ?)',
+                                         self._findings)
+            self._connection.executemany('INSERT OR REPLACE INTO pages '
+                                         'VALUES (?, ?, ?, ?, ?, ?, ?)', self._pages)
+        self._pages = []
+        self._findings = []
+        self._surfaces = []
+
+    def _next_scan(self):
+        """Number this scan, and forget the XSS of pages visited again since."""
+        with self._connection:
+            row = self._connection.execute("SELECT value FROM meta WHERE name = 'scan'").fetchone()
+            scan = (row[0] if row is not None else 0) + 1
+            self._connection.execute("INSERT OR REPLACE INTO meta VALUES ('scan', ?)", (scan,))
+            self._connection.execute('DELETE FROM findings WHERE NOT EXISTS (SELECT 1 FROM pages '
+                                     'WHERE pages.url = findings.url AND pages.scan = findings.scan)')
+        return scan
+
+    def _check_corpus(self, digest):
+        row = self._connection.execute("SELECT value FROM meta WHERE name = 'corpus'").fetchone()
+        if row is not None and row[0] == digest:
+            return
+        if row is not None:
+            logger.info("The payloads, or how they are sent or checked, changed since the last "
+                        "scan: every page will be attacked.")
+        with self._connection:
+            self._connection.execute('DELETE FROM pages')
+            self._connection.execute('DELETE FROM findings')
+            self._connection.execute('DELETE FROM surfaces')
+            self._connection.execute("INSERT OR REPLACE INTO meta VALUES ('corpus', ?)", (digest,))
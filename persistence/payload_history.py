@@ -0,0 +1,98 @@
+import collections
+import sqlite3
+import threading
+import time
+
+"""How often every payload found something, over every scan that used the
+same database. Kept on the payload_history table of the xss database, next
+to what was found: for every payload, how many forms (or inputs, on a
+single injection) it was sent to and on how many of them it was flagged.
+
+Payloads are the tests as they are on the xss_tests files, not as sent:
+upload tests are bytes, and sqlite keeps them as blobs.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS payload_history (
+    payload PRIMARY KEY,
+    family TEXT NOT NULL,
+    sent INTEGER NOT NULL,
+    hits INTEGER NOT NULL
+);
+"""
+
+class PayloadHistory:
+    """Thread-safe, like the PageStore. Everything is read once when opened
+    and kept in memory; what this scan adds is written on flush and close,
+    and on the same cadence as the ResultWriter, so a scan dying loses
+    about as much of it as of its XSS."""
+    def __init__(self, path='persistence/xss.db', journal_mode='WAL', batch_size=500,
+                 flush_interval=1.0):
+        """What was recorded is written once batch_size payloads are
+        waiting or the first of them has waited flush_interval seconds, on
+        the next record. Journal_mode works as on the ResultWriter."""
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode={0}'.format(journal_mode))
+        self._connection.executescript(SCHEMA)
+        self._counts = {payload: (sent, hits) for payload, sent, hits in self._connection.execute(
+            'SELECT payload, sent, hits FROM payload_history')}
+        self._families = {}
+        self._pending = collections.defaultdict(lambda: [0, 0])
+        self._deadline = None
+
+    @classmethod
+    def open(cls, path='persistence/xss.db', **kwargs):
+        return cls(path, **kwargs)
+
+    def counts(self, tests):
+        """The (sent, hits) of every test on tests, (0, 0) if never sent."""
+        with self._lock:
+            return [self._counts.get(test, (0, 0)) for test in tests]
+
+    def record(self, sent, hits, families):
+        """Add sent and hits, counters by test, to the history. Families is
+        a dict from every test on sent to its family."""
+        with self._lock:
+            for test, times in sent.items():
+                test_sent, test_hits = self._counts.get(test, (0, 0))
+                self._counts[test] = (test_sent + times, test_hits + hits[test])
+                pending = self._pending[test]
+                pending[0] += times
+                pending[1] += hits[test]
+                self._families[test] = families[test]
+            if self._deadline is None:
+                self._deadline = time.monotonic() + self.flush_interval
+            if len(self._pending) >= self.batch_size or time.monotonic() >= self._deadline:
+                self._flush()
+
+    def stats(self):
+        with self._lock:
+            return dict(payloads=len(self._counts),
+                        sent=sum(sent for sent, _ in self._counts.values()),
+                        hits=sum(hits for _, hits in self._counts.values()))
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._connection.close()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        with self._connection:
+            self._connection.executemany(
+                'INSERT INTO payload_history (payload, family, sent, hits) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(payload) DO UPDATE SET sent = sent + excluded.sent, '
+                'hits = hits + excluded.hits, family = excluded.family',
+                [(test, self._families[test], sent, hits)
+                 for test, (sent, hits) in self._pending.items()])
+        self._pending.clear()
+        self._deadline = None
@@ -0,0 +1,431 @@
+import collections
+import contextlib
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from logs.logger import logger
+from models.models import URL
+from persistence.frontier import fingerprint
+from persistence.page_store import dump_findings, dump_surface_key, load_findings, load_surface_key
+
+"""A frontier shared by several scanner processes, on one host or on many,
+so they can split a single scan between them. Everything lives on a sqlite
+file every process opens: every URL any of them found, and whether it is
+waiting, being processed or done.
+
+A process claims a URL by taking a lease on it: the URL is its own for
+lease_seconds, and the process keeps renewing the leases of the URLs it
+holds. If the process dies, its leases stop being renewed and expire, and
+its URLs go back to waiting for somebody else, so no URL is lost. And no
+URL is processed twice, unless its process was taken for dead.
+
+URLs are partitioned by the hash of their key: with --shard I/N, a process
+claims the URLs of its partition first and only takes the others when its
+own are all gone, so every process gets a slice of the site, the same one
+every time, instead of racing the others for the same rows.
+
+Only one thread of every process, its syncer, ever touches the file. The
+threads (or coroutines) of the scan work on memory: get takes a URL of a
+batch the syncer leased beforehand, put and task_done leave their URL for
+the syncer to write. Every sync is a single transaction: the URLs put go
+in, then the URLs done are marked so, then a new batch is leased if the
+last one is running out. A page is marked done on the same transaction its
+links go in, or after it, never before: a process dying in between loses
+nothing, its page is done again by somebody else.
+
+A sync that fails, because the file stayed locked for too long, is tried
+again: nothing leaves memory until it made it to the file. If syncing
+fails for longer than a lease, the leases of the process are not renewed
+either, so they expire and the other processes take its URLs over.
+
+The forms attacked by every process go on the file too, and are seeded on
+the AttackSurfaceIndex of the others, so a form found by two processes is
+attacked by one. Unless both found it before either was done with it.
+
+The scan is over when no URL is waiting nor leased, whoever processed them.
+"""
+
+PENDING, LEASED, DONE = 0, 1, 2
+
+BUCKETS = 1024  # a URL goes on bucket fingerprint % BUCKETS, shard I/N takes buckets % N == I
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (
+    id INTEGER PRIMARY KEY,
+    fingerprint INTEGER NOT NULL UNIQUE,
+    url TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    state INTEGER NOT NULL,
+    owner TEXT,
+    lease_expires REAL,
+    leases INTEGER NOT NULL DEFAULT 0
+);
+DROP INDEX IF EXISTS urls_state;
+-- bucket is on it so the URLs of other partitions are skipped without reading their rows
+CREATE INDEX IF NOT EXISTS urls_claim ON urls (state, id, bucket);
+CREATE TABLE IF NOT EXISTS workers (name TEXT PRIMARY KEY, shard TEXT, heartbeat REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS surfaces (
+    id INTEGER PRIMARY KEY,
+    surface TEXT NOT NULL UNIQUE,
+    owner TEXT NOT NULL,
+    findings TEXT NOT NULL
+);
+"""
+
+CLOSE_ATTEMPTS = 5
+
+def worker_name():
+    """Unique among every process of every host."""
+    return '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+class SharedFrontier:
+    """Works like a Frontier (persistence/frontier.py): put claims a URL
+    for the whole scan, and get, task_done and join work the same, except
+    unfinished_tasks and join are about every process, not this one. None
+    of them touches the file, so they are as cheap as a queue.Queue's and
+    can be called from an event loop.
+
+    The syncer leases up to batch URLs at a time, and leases more when half
+    of them were taken. It syncs as soon as a URL is done, or the batch runs
+    low, and every sync_interval seconds anyway, to see what the others did.
+    Changes made by other processes notify nobody here, so whoever waits for
+    one without get or join polls every poll_interval seconds. Only the last
+    max_known URLs put are remembered here; the file remembers them all.
+
+    The sqlite file is not on WAL mode, which needs every process on the
+    same host: on a rollback journal it can be on any filesystem whose
+    locks work. Leases expire by the wall clock, so across hosts
+    lease_seconds must be well over how far their clocks are apart."""
+    def __init__(self, path='persistence/shared_frontier.db', shard=0, shards=1,
+                 lease_seconds=60, batch=16, sync_interval=1.0, poll_interval=0.05,
+                 name=None, max_known=1000000):
+        if not 0 <= shard < shards <= BUCKETS:
+            raise ValueError("Shard {0}/{1} out of range".format(shard, shards))
+        self.path = path
+        self.shard = shard
+        self.shards = shards
+        self.lease_seconds = lease_seconds
+        self.batch = max(batch, 1)
+        self.sync_interval = sync_interval
+        self.poll_interval = poll_interval
+        self.max_known = max_known
+        self.name = name or worker_name()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)  # a sync finished
+        self._wake = threading.Condition(self._lock)  # the syncer has something to do
+        # autocommit, every transaction is explicit
+        self._connection = sqlite3.connect(path, timeout=max(lease_seconds / 3, 1),
+                                           check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(SCHEMA)
+        self._known = set()  # fingerprints this process put lately
+        self._known_before = set()  # the ones put before those, see put
+        self._ready = collections.deque()  # leased, not handed out yet
+        self._to_put = {}  # fingerprint: url, not written yet
+        self._done = []  # urls done, not written yet
+        self._surfaces_done = []  # (surface key, findings) attacked here, not written yet
+        self._surface_index = None
+        self._last_surface = 0  # id of the last surface of the others seen
+        self._more_to_claim = True
+        self._sync_wanted = False
+        self._syncs = 0
+        self._unfinished = 0  # on the file, at the last sync
+        self._states = {}
+        self._workers = 0
+        self._last_renewal = time.monotonic()
+        self._in_progress = 0
+        self._counters = dict(claimed=0, stolen=0, requeued=0, lost_leases=0, failed_syncs=0)
+        self._stopping = False
+        self._closed = False
+        self._syncer = threading.Thread(target=self._run, daemon=True)
+
+    @classmethod
+    def open(cls, path='persistence/shared_frontier.db', resume=False, **kwargs):
+        """Return a SharedFrontier on path, with this process registered on
+        it. If no other process is working on it and not resume, whatever
+        was on it is forgotten and a new scan starts; else, this process
+        joins the scan on it."""
+        frontier = cls(path, **kwargs)
+        frontier._register(resume)
+        frontier._syncer.start()
+        return frontier
+
+    def put(self, url):
+        """Add url if this process didn't put it lately. Return True if it
+        was added; whether it was put before, here or by another process,
+        is up to the file."""
+        url_fingerprint = fingerprint(url)
+        with self._lock:
+            if url_fingerprint in self._known or url_fingerprint in self._known_before:
+                return False
+            if len(self._known) >= self.max_known // 2:
+                # forget the oldest half: if they are put again, the file drops them
+                self._known_before, self._known = self._known, set()
+            self._known.add(url_fingerprint)
+            self._to_put[url_fingerprint] = url.url
+        return True
+
+    def get(self, block=True, timeout=None):
+        """Return a leased URL. Like queue.Queue.get, raises queue.Empty if
+        not block and there is none, or if none came before timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while not self._ready:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Empty
+                self._changed.wait(remaining)
+            url = self._ready.popleft()
+            self._in_progress += 1
+            if len(self._ready) < self.batch / 2 and self._more_to_claim:
+                self._wake.notify()
+            return URL(url)
+
+    def task_done(self, url):
+        """Mark url, which was returned by get, as done, along with every
+        URL put until now. If its lease was lost, the process which took it
+        over will do it again; unless it didn't yet, then it is done for it
+        too."""
+        with self._lock:
+            self._in_progress -= 1
+            self._done.append(url.url)
+            self._wake.notify()
+
+    @property
+    def unfinished_tasks(self):
+        """URLs waiting or leased, by any process, as of the last sync, and
+        the ones put here since."""
+        with self._lock:
+            return self._unfinished + len(self._to_put)
+
+    def join(self):
+        """Block until every URL put, by any process, was marked as done."""
+        with self._lock:
+            while self._unfinished or self._to_put or self._done:
+                self._changed.wait()
+
+    def qsize(self):
+        """URLs leased by this process and not handed out yet: the ones get
+        can return right away."""
+        with self._lock:
+            return len(self._ready)
+
+    def stats(self):
+        """As of the last sync. URLs done and the processes on the scan are
+        only counted every lease_seconds / 3."""
+        with self._lock:
+            stats = dict(queued=self._states.get(PENDING, 0),
+                         in_progress=self._states.get(LEASED, 0), unfinished=self._unfinished,
+                         done=self._states.get(DONE, 0), mine_in_progress=self._in_progress,
+                         mine_ready=len(self._ready), workers=self._workers,
+                         shard='{0}/{1}'.format(self.shard, self.shards))
+            stats.update(self._counters)
+            return stats
+
+    def checkpoint(self):
+        """Write every URL put until now, and wait for it."""
+        with self._lock:
+            syncs = self._syncs
+            while self._syncs == syncs or self._to_put:
+                self._sync_wanted = True
+                self._wake.notify()
+                self._changed.wait(self.sync_interval)
+
+    def share_surfaces(self, surface_index):
+        """Put the forms completed on surface_index on the file, and share
+        the ones completed by other processes with it. Chains on its
+        on_complete: set any other before."""
+        on_complete = surface_index.on_complete
+
+        def record(key, findings):
+            if on_complete is not None:
+                on_complete(key, findings)
+            with self._lock:
+                self._surfaces_done.append((key, findings))
+        self._surface_index = surface_index
+        surface_index.on_complete = record
+
+    def close(self):
+        """Write what is left, give back the URLs leased and not done, if
+        any, and leave the scan."""
+        with self._lock:
+            self._stopping = True
+            self._wake.notify()
+        self._syncer.join()
+        for attempt in range(CLOSE_ATTEMPTS):
+            try:
+                self._sync(leaving=True)
+                break
+            except sqlite3.OperationalError as error:
+                logger.warning("Could not leave the shared frontier on %s: %s", self.path, error)
+        else:
+            logger.error("Gave up leaving the shared frontier on %s: the leases of %s will "
+                         "expire in %ss.", self.path, self.name, self.lease_seconds)
+        with self._lock:
+            self._closed = True
+            self._connection.close()
+
+    @contextlib.contextmanager
+    def _write(self):
+        """A write transaction, holding the lock of the file from the start
+        so two processes never claim the same URL."""
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield self._connection
+            self._connection.execute('COMMIT')
+        except BaseException:
+            self._connection.execute('ROLLBACK')
+            raise
+
+    def _register(self, resume):
+        now = time.time()
+        with self._write() as connection:
+            connection.execute('DELETE FROM workers WHERE heartbeat < ?',
+                               (now - self.lease_seconds,))
+            others = connection.execute('SELECT COUNT(*) FROM workers').fetchone()[0]
+            if not others and not resume:
+                connection.execute('DELETE FROM urls')
+                connection.execute('DELETE FROM surfaces')
+            connection.execute('INSERT INTO workers VALUES (?, ?, ?)',
+                               (self.name, '{0}/{1}'.format(self.shard, self.shards), now))
+            states, self._workers = self._count(connection, now)
+        self._states = states
+        self._unfinished = states[PENDING] + states[LEASED]
+        if others or resume:
+            logger.info("Joining the shared scan on %s as %s, shard %s/%s: %s URLs to go.",
+                        self.path, self.name, self.shard, self.shards, self._unfinished)
+
+    def _run(self):
+        """The syncer: sync whenever there is something to, or every
+        sync_interval, until close. Whatever goes wrong, it keeps trying:
+        if it died, get, join and checkpoint would wait for it forever."""
+        while True:
+            with self._lock:
+                if not self._stopping and not self._needs_sync():
+                    self._wake.wait(self.sync_interval)
+                if self._stopping:
+                    return
+            try:
+                self._sync()
+            except sqlite3.OperationalError as error:
+                self._sync_failed()
+                logger.warning("Could not sync with the shared frontier on %s, will try "
+                               "again: %s", self.path, error)
+            except Exception:
+                self._sync_failed()
+                logger.exception("Unexpected error while syncing with the shared frontier "
+                                 "on %s, will try again.", self.path)
+
+    def _sync_failed(self):
+        with self._lock:
+            self._counters['failed_syncs'] += 1
+            self._wake.wait(self.sync_interval)
+
+    def _needs_sync(self):
+        return (self._done or self._sync_wanted or
+                (len(self._ready) < self.batch / 2 and self._more_to_claim))
+
+    def _sync(self, leaving=False):
+        """Write what is waiting on memory and lease a new batch, if needed,
+        on one transaction. If it fails, everything is left on memory for
+        the next one."""
+        now = time.time()
+        with self._lock:
+            self._sync_wanted = False
+            to_put, done, surfaces = dict(self._to_put), list(self._done), list(self._surfaces_done)
+            wanted = 0 if leaving or len(self._ready) >= self.batch / 2 else (
+                self.batch - len(self._ready))
+        renew = leaving or time.monotonic() - self._last_renewal >= self.lease_seconds / 3
+        with self._write() as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO urls (fingerprint, url, bucket, state) VALUES (?, ?, ?, ?)',
+                [(url_fingerprint, url, url_fingerprint % BUCKETS, PENDING)
+                 for url_fingerprint, url in to_put.items()])
+            lost = [url for url in done if not connection.execute(
+                'UPDATE urls SET state = ?, owner = NULL, lease_expires = NULL '
+                'WHERE fingerprint = ? AND (state = ? OR (state = ? AND owner = ?))',
+                (DONE, fingerprint(URL(url)), PENDING, LEASED, self.name)).rowcount]
+            connection.executemany(
+                'INSERT OR IGNORE INTO surfaces (surface, owner, findings) VALUES (?, ?, ?)',
+                [(dump_surface_key(key), self.name, dump_findings(findings))
+                 for key, findings in surfaces])
+            requeued = connection.execute(
+                'UPDATE urls SET state = ?, owner = NULL, lease_expires = NULL '
+                'WHERE state = ? AND lease_expires < ?', (PENDING, LEASED, now)).rowcount
+            if leaving:
+                connection.execute('UPDATE urls SET state = ?, owner = NULL, lease_expires = NULL '
+                                   'WHERE state = ? AND owner = ?', (PENDING, LEASED, self.name))
+                connection.execute('DELETE FROM workers WHERE name = ?', (self.name,))
+            elif renew:
+                connection.execute('UPDATE urls SET lease_expires = ? WHERE state = ? AND owner = ?',
+                                   (now + self.lease_seconds, LEASED, self.name))
+                connection.execute('UPDATE workers SET heartbeat = ? WHERE name = ?',
+                                   (now, self.name))
+            claimed, stolen = self._claim(connection, wanted, now) if wanted else ([], 0)
+            shared = [] if self._surface_index is None else connection.execute(
+                'SELECT id, surface, findings FROM surfaces WHERE id > ? AND owner != ?',
+                (self._last_surface, self.name)).fetchall()
+            states, workers = self._count(connection, now, everything=renew)
+        if renew:
+            self._last_renewal = time.monotonic()
+        with self._lock:
+            # only what made it to the file leaves memory
+            for url_fingerprint in to_put:
+                del self._to_put[url_fingerprint]
+            del self._done[:len(done)]
+            del self._surfaces_done[:len(surfaces)]
+            states.setdefault(DONE, self._states.get(DONE, 0))
+            self._states = states
+            self._unfinished = states[PENDING] + states[LEASED]
+            if workers is not None:
+                self._workers = workers
+            self._ready.extend(claimed)
+            self._more_to_claim = len(claimed) == wanted
+            self._counters['claimed'] += len(claimed)
+            self._counters['stolen'] += stolen
+            self._counters['requeued'] += requeued
+            self._counters['lost_leases'] += len(lost)
+        for surface_id, surface, findings in shared:
+            self._surface_index.share(load_surface_key(surface), load_findings(findings))
+            self._last_surface = surface_id
+        with self._lock:
+            self._syncs += 1
+            self._changed.notify_all()
+        for url in lost:
+            logger.warning("Lost the lease of %s before it was done.", url)
+        if requeued:
+            logger.warning("%s URLs whose lease expired were requeued.", requeued)
+
+    def _claim(self, connection, wanted, now):
+        """Lease up to wanted URLs: the ones of our partition if any, else
+        anyone's. Return them, and how many were not of our partition."""
+        rows = connection.execute(
+            'SELECT id, url FROM urls WHERE state = ? AND bucket % ? = ? ORDER BY id LIMIT ?',
+            (PENDING, self.shards, self.shard, wanted)).fetchall()
+        mine = len(rows)
+        if mine < wanted and self.shards > 1:
+            rows += connection.execute(
+                'SELECT id, url FROM urls WHERE state = ? AND bucket % ? != ? ORDER BY id LIMIT ?',
+                (PENDING, self.shards, self.shard, wanted - mine)).fetchall()
+        connection.executemany(
+            'UPDATE urls SET state = ?, owner = ?, lease_expires = ?, leases = leases + 1 '
+            'WHERE id = ?', [(LEASED, self.name, now + self.lease_seconds, row[0]) for row in rows])
+        return [url for row_id, url in rows], len(rows) - mine
+
+    def _count(self, connection, now, everything=True):
+        """Return the URLs of every state, and the processes alive; but
+        only the unfinished URLs if not everything, as counting the others
+        takes longer the bigger the scan."""
+        states = {PENDING: 0, LEASED: 0}
+        states.update(connection.execute('SELECT state, COUNT(*) FROM urls WHERE state < ? '
+                                         'GROUP BY state', (DONE,)))
+        if not everything:
+            return states, None
+        states[DONE] = connection.execute('SELECT COUNT(*) FROM urls WHERE state = ?',
+                                          (DONE,)).fetchone()[0]
+        return states, connection.execute('SELECT COUNT(*) FROM workers WHERE heartbeat >= ?',
+                                          (now - self.lease_seconds,)).fetchone()[0]
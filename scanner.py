@@ -1,33 +1,49 @@
-import time
 import requests
+from functools import partial
 import threading
+import asyncio
 import queue
 import argparse
 import json
 import sys
-from logs.logger import logger
-from persistence.db_manager import DBManager
-from models.models import ScrappedWebsite, XSSDetector, URL
-from utils.utils import WebIO
+from logs.logger import logger, configure_logging
+from persistence.db_manager import ResultWriter
+from persistence.frontier import Frontier
+from persistence.shared_frontier import SharedFrontier
+from persistence.page_store import PageStore
+from persistence.payload_history import PayloadHistory
+from models.extractors import EXTRACTORS
+from models.parsing import InlineParser, make_parser
+from models.models import XSSDetector, URL, PayloadCorpus, AttackSurfaceIndex
+from models.verification import ReflectionVerifier
+from models.scheduling import PayloadPolicy, EARLY_STOPS
+from utils.utils import WebIO, HostScheduler
+from utils.stats import ScanStats, StatsReporter, StatsServer
 
 class Worker(threading.Thread):
     """Worker threads to get the information gotten by the classes in the model
     and write to the database."""
 
     # class attributes, accesed by every Worker instance
-    websites_to_visit = queue.Queue()
-    visited_websites = set()  # a nice set
+    websites_to_visit = None  # the Frontier, opened by main
+    corpus = None  # the PayloadCorpus, loaded once by main
+    reload_payloads = False
+    injection = 'batch'  # see XSSDetector
+    verify = 'status'
+    policy = PayloadPolicy()  # see models/scheduling.py
+    surface_index = AttackSurfaceIndex()
+    parser = InlineParser()  # see models/parsing.py
+    stats = ScanStats()  # see utils/stats.py
+    page_store = None  # the PageStore, if the scan is incremental
 
-    def __init__(self, lock, web_io, initial_url):
+    def __init__(self, web_io, result_writer):
         threading.Thread.__init__(self)
         self.daemon = True  # when none of these exist anymore, exit
-        self.lock = lock
         self.web_io = web_io
-        self.initial_url = initial_url
+        self.result_writer = result_writer
 
     def run(self):
-        """Create an instance of the DB manager and start the actual job."""
-        self.db_manager = DBManager(self.initial_url)
+        """Start the actual job."""
         self.safely_continously_check_websites_for_xss()
 
     def safely_continously_check_websites_for_xss(self):
@@ -39,51 +55,240 @@ class Worker(threading.Thread):
         In any case, always mark the task as done, so the program will exit.
         """
         while True:
+            url = Worker.websites_to_visit.get()
             try:
-                self.check_website_for_xss()
+                self.check_website_for_xss(url)
             except:
                 logger.exception("Unhandled exception while processing a website."
                                  "Will continue with next website on queue.")
                 continue
             finally:
-                Worker.websites_to_visit.task_done()
+                Worker.websites_to_visit.task_done(url)
 
-    def check_website_for_xss(self):
-        """The heavy work. Get an URL from the Queue, check if it was already
-        visited, scrap it, scan it and write to the database whatever we found.
+    def check_website_for_xss(self, url):
+        """The heavy work. Scrap the url gotten from the frontier, scan it and
+        write to the database whatever we found. The frontier never hands out
+        the same URL twice, so there is no need to check if it was visited.
 
-        Return True if website was processed, False if website was already visited.
+        On an incremental scan, a website which didn't change since the
+        last one is not parsed nor attacked: its links and XSS are the
+        stored ones.
+
+        Return True if website was processed, False if it could not be fetched.
         Not that is very useful, but allows the loop to continue smoothly.
         """
-        url = Worker.websites_to_visit.get()
-        if url in Worker.visited_websites:
-            logger.warning("URL {0} was already visited so it wont be processed".format(url))
+        page_store = Worker.page_store
+        previous = page_store.previous_visit(url) if page_store is not None else None
+        with Worker.stats.timer('fetch', url.netloc):
+            website = self.web_io.get_website(url.url, previous and previous.conditional_headers())
+        if website is None:
+            Worker.stats.count('pages_failed')
             return False
-        Worker.visited_websites |= {url}
-        website_as_string = self.web_io.get_website_as_string(url.url)
-        if website_as_string:
-            scrapped_website = ScrappedWebsite(url, website_as_string)
-            xss_found = self.extract_xss_from_website(scrapped_website)
+        Worker.stats.count('pages')
+        if previous is not None and previous.is_unchanged(website):
+            Worker.stats.count('pages_unchanged')
+            xss_found = previous.get_xss(url)
+            Worker.stats.count('xss_found', len(xss_found))
             self.write_xss_to_db(xss_found)
-            self.append_new_websites(scrapped_website)
+            page_store.record_unchanged(url, previous)
+            self.append_new_websites(previous.get_links())
+            return True
+        with Worker.stats.timer('parse'):
+            scrapped_website = Worker.parser.parse(url, website.text)
+        xss_found = self.extract_xss_from_website(scrapped_website)
+        Worker.stats.count('xss_found', len(xss_found))
+        self.write_xss_to_db(xss_found)
+        new_urls = scrapped_website.get_unique_relevant_links()
+        self.append_new_websites(new_urls)
+        if page_store is not None:
+            page_store.record_findings(xss_found)
+            page_store.record_page(url, website, new_urls, previous)
         return True
 
     def extract_xss_from_website(self, scrapped_website):
         """Return a list of XSS found on the scrapped_website as XSS objects."""
-        xss_detector = XSSDetector(scrapped_website, self.web_io)
-        xss_found = xss_detector.detect()
+        if Worker.reload_payloads:
+            Worker.corpus = Worker.corpus.refreshed()
+        with Worker.stats.timer('attacks'):
+            xss_detector = XSSDetector(scrapped_website, self.web_io, Worker.corpus,
+                                       Worker.surface_index, Worker.injection,
+                                       make_verifier(Worker.verify, Worker.corpus),
+                                       reflected_only=Worker.verify == 'reflection',
+                                       policy=Worker.policy)
+        Worker.stats.count('attacks', len(xss_detector.attack_information))
+        with Worker.stats.timer('detect'):
+            xss_found = xss_detector.detect()
         return xss_found
 
-    def append_new_websites(self, scrapped_website):
-        """Appends any relevant link to the queue to be processed in the future."""
-        new_urls = scrapped_website.get_unique_relevant_links()
+    def append_new_websites(self, new_urls):
+        """Appends the new_urls to the frontier to be processed in the future.
+        Links it already saw are ignored by it."""
         for  url in new_urls:
             Worker.websites_to_visit.put(url)
 
     def write_xss_to_db(self, xss_list):
-        """Locking operation!. Writes to the db all the xss on xss_list."""
-        with self.lock:  #sqlite is fine with being read by multiple threads, not writing
-            self.db_manager.write_xss_list_to_db(xss_list)
+        """Hands the xss on xss_list to the ResultWriter, which is the only
+        one writing to the db. Only blocks if the writer is far behind."""
+        self.result_writer.write_xss_list_to_db(xss_list)
+
+class AsyncScanner:
+    """The asyncio alternative to the Worker threads. Every page fetch and
+    every payload submission is a coroutine on a single event loop, so the
+    amount of in-flight requests is bounded by concurrency instead of by how
+    many OS threads we can afford."""
+
+    def __init__(self, web_io, result_writer, frontier, concurrency, corpus,
+                 reload_payloads=False, parser=None, stats=None, page_store=None,
+                 injection='batch', verify='status', policy=None):
+        """Web_io should be an instance of AsyncWebIO found on utils.async_utils.
+        Pages are processed by concurrency coroutines, which share the
+        frontier (persistence/frontier.py). It is never waited on: coroutines
+        with nothing to do wait on a condition instead, which is notified
+        when new URLs are added or when the last one is done. Every stage
+        is timed on stats, a ScanStats, just like the Workers do. If a
+        page_store is given, the scan is incremental. Injection and verify
+        work as the arguments of scanner.py with the same name, and policy
+        is the PayloadPolicy of every XSSDetector.
+
+        The frontier, the page store and the result writer may block, on
+        a lock, on the disk or on a full queue, so they are only called
+        through _in_thread: the loop never waits for them."""
+        self.web_io = web_io
+        self.result_writer = result_writer
+        self.frontier = frontier
+        self.concurrency = concurrency
+        self.corpus = corpus
+        self.reload_payloads = reload_payloads
+        self.parser = parser or InlineParser()
+        self.surface_index = AttackSurfaceIndex()
+        self.stats = stats or ScanStats()
+        self.page_store = page_store
+        self.injection = injection
+        self.verify = verify
+        self.policy = policy or PayloadPolicy()
+        self._frontier_changed = None
+
+    def run(self):
+        """Scan until there is nothing left to visit."""
+        asyncio.run(self.scan())
+
+    async def _in_thread(self, function, *args):
+        """Call function on a thread of the executor of the loop, so the
+        other coroutines go on meanwhile, and return what it returns."""
+        return await asyncio.get_running_loop().run_in_executor(None, partial(function, *args))
+
+    async def scan(self):
+        """Wait for the frontier to be drained: every URL put on it was
+        marked as done, and every website puts its links before being marked
+        as done itself, so when none is left, none will come."""
+        self._frontier_changed = asyncio.Condition()
+        await self.web_io.open()
+        workers = [asyncio.ensure_future(self.safely_continously_check_websites_for_xss())
+                   for _ in range(self.concurrency)]
+        if self.frontier.poll_interval is not None:
+            workers.append(asyncio.ensure_future(self.poll_frontier()))
+        try:
+            async with self._frontier_changed:
+                await self._frontier_changed.wait_for(lambda: not self.frontier.unfinished_tasks)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await self.web_io.close()
+
+    async def safely_continously_check_websites_for_xss(self):
+        """Same as the Worker method with the same name: never let a bad
+        URL kill the coroutine, and always mark the URL as done."""
+        while True:
+            try:
+                url = await self._in_thread(self.frontier.get, False)
+            except queue.Empty:
+                async with self._frontier_changed:
+                    await self._frontier_changed.wait()
+                continue
+            try:
+                await self.check_website_for_xss(url)
+            except Exception:
+                logger.exception("Unhandled exception while processing a website."
+                                 "Will continue with next website on queue.")
+            finally:
+                await self._in_thread(self.frontier.task_done, url)
+                if not self.frontier.unfinished_tasks:
+                    async with self._frontier_changed:
+                        self._frontier_changed.notify_all()
+
+    async def poll_frontier(self):
+        """URLs leased or done by the syncer of a shared frontier notify
+        nobody on the loop, so every poll_interval seconds as many
+        coroutines as there are URLs to get are notified, or all of them
+        if there is nothing left to do."""
+        while True:
+            await asyncio.sleep(self.frontier.poll_interval)
+            ready = self.frontier.qsize()
+            if ready or not self.frontier.unfinished_tasks:
+                async with self._frontier_changed:
+                    if ready:
+                        self._frontier_changed.notify(ready)
+                    else:
+                        self._frontier_changed.notify_all()
+
+    async def check_website_for_xss(self, url):
+        """Scrap url, scan it and write to the database whatever we found,
+        skipping what didn't change on an incremental scan, as the Workers
+        do. Return False if it could not be fetched, True otherwise."""
+        previous = None
+        if self.page_store is not None:
+            previous = await self._in_thread(self.page_store.previous_visit, url)
+        with self.stats.timer('fetch', url.netloc):
+            website = await self.web_io.get_website(url.url,
+                                                    previous and previous.conditional_headers())
+        if website is None:
+            self.stats.count('pages_failed')
+            return False
+        self.stats.count('pages')
+        if previous is not None and previous.is_unchanged(website):
+            self.stats.count('pages_unchanged')
+            xss_found = previous.get_xss(url)
+            self.stats.count('xss_found', len(xss_found))
+            await self._in_thread(self.result_writer.write_xss_list_to_db, xss_found)
+            await self._in_thread(self.page_store.record_unchanged, url, previous)
+            await self.append_new_websites(previous.get_links())
+            return True
+        with self.stats.timer('parse'):
+            scrapped_website = await self.parser.parse_async(url, website.text)
+        if self.reload_payloads:
+            self.corpus = self.corpus.refreshed()
+        with self.stats.timer('attacks'):
+            xss_detector = XSSDetector(scrapped_website, self.web_io, self.corpus,
+                                       self.surface_index, self.injection,
+                                       make_verifier(self.verify, self.corpus),
+                                       reflected_only=self.verify == 'reflection',
+                                       policy=self.policy)
+        self.stats.count('attacks', len(xss_detector.attack_information))
+        with self.stats.timer('detect'):
+            xss_found = await xss_detector.detect_async()
+        self.stats.count('xss_found', len(xss_found))
+        await self._in_thread(self.result_writer.write_xss_list_to_db, xss_found)
+        new_urls = scrapped_website.get_unique_relevant_links()
+        await self.append_new_websites(new_urls)
+        if self.page_store is not None:
+            await self._in_thread(self._record_page, url, website, new_urls, previous, xss_found)
+        return True
+
+    def _record_page(self, url, website, new_urls, previous, xss_found):
+        self.page_store.record_findings(xss_found)
+        self.page_store.record_page(url, website, new_urls, previous)
+
+    async def append_new_websites(self, new_urls):
+        """Put new_urls on the frontier and wake up a coroutine per URL added."""
+        added = await self._in_thread(self._put_all, new_urls)
+        if added:
+            async with self._frontier_changed:
+                self._frontier_changed.notify(added)
+
+    def _put_all(self, new_urls):
+        """Return how many of new_urls the frontier didn't have."""
+        return sum(self.frontier.put(new_url) for new_url in new_urls)
 
 def parse_args():
     """Parses the arguments provided in the terminal"""
@@ -95,6 +300,115 @@ def parse_args():
     parser = argparse.ArgumentParser(description=description_string)
     parser.add_argument("initial_url", type=str, help="The seed URL (NOT URI) for the program.")
     parser.add_argument("threads", type=int, help="Amount of threads to be used.")
+    parser.add_argument("--engine", choices=("threads", "async"), default="threads",
+                        help=("How to run the scan. 'threads' uses one Worker thread per "
+                              "thread asked for, 'async' runs every request as a "
+                              "coroutine on a single event loop and ignores threads."))
+    parser.add_argument("--concurrency", type=int, default=100,
+                        help=("Maximum amount of in-flight requests for the async engine. "
+                              "A single host gets at most --max-per-host of them."))
+    parser.add_argument("--pool-size", type=int, default=None,
+                        help=("Amount of keep-alive connections per host. Defaults to "
+                              "--concurrency with the async engine, to threads otherwise."))
+    parser.add_argument("--retries", type=int, default=2,
+                        help="How many times a failed request is retried.")
+    parser.add_argument("--backoff", type=float, default=0.3,
+                        help="Backoff factor between retries, in seconds.")
+    parser.add_argument("--timeout", type=float, default=5,
+                        help="Seconds to wait for a server to connect or answer.")
+    parser.add_argument("--max-body-size", type=float, default=5,
+                        help=("Most megabytes read of any response. Pages over it are "
+                              "skipped, as are pages which are not HTML: their bodies "
+                              "are never downloaded."))
+    parser.add_argument("--parser", choices=sorted(EXTRACTORS), default="stream",
+                        help=("How to extract links and forms from websites. 'stream' "
+                              "does it in a single pass without building a DOM, 'soup' "
+                              "uses BeautifulSoup and is slower, but may cope better "
+                              "with some broken HTML."))
+    parser.add_argument("--parse-processes", type=int, default=0,
+                        help=("Parse websites on this many processes instead of on "
+                              "the thread that fetched them, so parsing uses more than "
+                              "one core. -1 means one per core."))
+    parser.add_argument("--parse-queue", type=int, default=None,
+                        help=("Maximum amount of websites waiting to be parsed when "
+                              "using --parse-processes. Defaults to twice the processes."))
+    parser.add_argument("--no-adaptive", action="store_true",
+                        help=("Don't adapt how many requests each host gets at the same "
+                              "time to how it is coping. Every thread goes as fast as it can."))
+    parser.add_argument("--max-per-host", type=int, default=None,
+                        help=("Most requests a host gets at the same time when adapting. "
+                              "Defaults to --pool-size, which it can't be over."))
+    parser.add_argument("--injection", choices=("batch", "single"), default="batch",
+                        help=("How payloads are sent to forms. 'batch' sends each payload "
+                              "to every input of a form at once, and only narrows it down "
+                              "to the vulnerable inputs when it is flagged, the inputs left "
+                              "out getting their defaults. 'single' sends each "
+                              "payload to each input alone, and nothing else."))
+    parser.add_argument("--verify", choices=("status", "reflection"), default="status",
+                        help=("What makes a payload an XSS. 'status' needs the server to "
+                              "accept it, and catches payloads stored and shown elsewhere. "
+                              "'reflection' needs it to come back on the response as it "
+                              "was sent, which is far less noisy but misses those."))
+    parser.add_argument("--early-stop", choices=EARLY_STOPS, default="input",
+                        help=("Stop sending payloads to an input ('input') or to a whole "
+                              "form ('form') once one was found on it. Payloads that found "
+                              "the most on previous scans are sent first. 'none' sends "
+                              "every payload to every input."))
+    parser.add_argument("--no-probe", action="store_true",
+                        help=("Don't probe forms before attacking them. The probe leaves "
+                              "out the inputs which block or encode the characters every "
+                              "payload needs."))
+    parser.add_argument("--reload-payloads", action="store_true",
+                        help=("Reload the xss_tests files while scanning if they "
+                              "are modified. Otherwise they are read once at startup."))
+    parser.add_argument("--resume", action="store_true",
+                        help=("Continue the scan checkpointed on the --frontier file "
+                              "instead of starting from initial_url."))
+    parser.add_argument("--frontier", type=str, default="persistence/frontier.db",
+                        help="Where URLs to visit are spilled to and checkpointed.")
+    parser.add_argument("--checkpoint-interval", type=float, default=60,
+                        help="Seconds between checkpoints of the frontier.")
+    parser.add_argument("--max-queue-in-memory", type=int, default=100000,
+                        help="URLs to visit kept in memory. The rest go to disk.")
+    parser.add_argument("--max-visited-in-memory", type=int, default=1000000,
+                        help=("Fingerprints of seen URLs kept in memory. The rest go "
+                              "to disk, behind a Bloom filter."))
+    parser.add_argument("--shared-frontier", type=str, default=None,
+                        help=("Split the scan with every other scanner.py using this sqlite "
+                              "file as its shared frontier, instead of --frontier. The "
+                              "first one to open it starts the scan over, unless --resume; "
+                              "the rest join it. Point --database to the same file on "
+                              "all of them to share the results too."))
+    parser.add_argument("--shard", type=shard, default=(0, 1),
+                        help=("I/N: with a shared frontier, this process is shard I of N "
+                              "(from 0), and visits the URLs of its slice of the site first. "
+                              "Defaults to 0/1."))
+    parser.add_argument("--lease-seconds", type=float, default=60,
+                        help=("With a shared frontier, seconds a URL stays with a process "
+                              "which stopped renewing its lease, before another one takes it."))
+    parser.add_argument("--progress-interval", type=float, default=10,
+                        help="Seconds between progress lines. 0 for none.")
+    parser.add_argument("--stats-file", type=str, default=None,
+                        help=("Dump every stat of the scan as json to this file, at "
+                              "every progress line and when the scan finishes."))
+    parser.add_argument("--stats-port", type=int, default=None,
+                        help=("Serve every stat of the scan as json on "
+                              "http://127.0.0.1:STATS_PORT/ while it runs."))
+    parser.add_argument("--incremental", action="store_true",
+                        help=("Only attack what changed since the last incremental scan. "
+                              "Known pages are asked for with conditional GETs, and the "
+                              "ones which didn't change are not attacked again, nor are "
+                              "forms attacked on any page before."))
+    parser.add_argument("--pages-db", type=str, default="persistence/pages.db",
+                        help="Where the pages and forms of incremental scans are kept.")
+    parser.add_argument("--database", type=str, default="persistence/xss.db",
+                        help="The sqlite file where the XSS found are written.")
+    parser.add_argument("--log-file", type=str, default="logs/logs.log",
+                        help="Where the log is written. An empty string for nowhere.")
+    parser.add_argument("--log-level", choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        default="INFO", help="The least important records written to the log.")
+    parser.add_argument("--log-json", action="store_true",
+                        help="Write the log as json, one record per line.")
     parser.add_argument("--cookies", type=str, default=None,
                         help=("You can specify cookies to be used in the requests. "
                             "You must provide it as a json which lools like this: \n "
@@ -113,22 +427,247 @@ def process_cookies(json_cookie_string):
         logger.exception("You provided a non-valid string for cookies.")
         sys.exit(1)
 
+def shard(value):
+    """Parses I/N for --shard."""
+    try:
+        index, total = (int(number) for number in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("{0!r} is not I/N".format(value))
+    if not 0 <= index < total:
+        raise argparse.ArgumentTypeError("{0!r}: I must be between 0 and N - 1".format(value))
+    return index, total
+
+def pool_size(args):
+    """By default a single host may get every request the scan has in
+    flight, as many as threads or --concurrency."""
+    if args.pool_size is not None:
+        return args.pool_size
+    return args.concurrency if args.engine == 'async' else args.threads
+
+def max_per_host(args):
+    """More requests to a host than keep-alive connections to it would only
+    wait for a connection anyway."""
+    return min(args.max_per_host or pool_size(args), pool_size(args))
+
+def megabytes(value):
+    return int(value * 1024 * 1024)
+
+def open_frontier(args):
+    """Open the frontier, seeding it with the initial url unless we are
+    resuming a previous scan. A shared one is seeded anyway: if another
+    process already did, it is ignored. Its processes lease as many URLs
+    at a time as they process at once."""
+    if args.shared_frontier:
+        frontier = SharedFrontier.open(args.shared_frontier, resume=args.resume,
+                                       shard=args.shard[0], shards=args.shard[1],
+                                       lease_seconds=args.lease_seconds,
+                                       batch=args.concurrency if args.engine == 'async'
+                                       else args.threads)
+        frontier.put(URL(args.initial_url))
+        frontier.checkpoint()
+        return frontier
+    try:
+        frontier = Frontier.open(args.frontier, resume=args.resume,
+                                 max_pending_in_memory=args.max_queue_in_memory,
+                                 max_visited_in_memory=args.max_visited_in_memory,
+                                 checkpoint_interval=args.checkpoint_interval)
+    except ValueError as error:
+        logger.error("Can't resume the scan: %s", error)
+        sys.exit(1)
+    if not args.resume:
+        frontier.put(URL(args.initial_url))
+        # so a scan dying before the first checkpoint can be resumed too
+        frontier.checkpoint()
+    return frontier
+
+STAGES = ('fetch', 'parse', 'attacks', 'detect', 'request', 'db_write')
+
+def make_verifier(verify, corpus):
+    """The ReflectionVerifier of corpus, or None with --verify status: then
+    payloads are sent as they are, without canaries."""
+    return ReflectionVerifier.for_corpus(corpus) if verify == 'reflection' else None
+
+def journal_mode(args):
+    """WAL shares memory between the processes using a file, so they must
+    all be on the same host. The processes of a --shared-frontier may not
+    be, and may share the --database and the --pages-db."""
+    return 'DELETE' if args.shared_frontier else 'WAL'
+
+def make_policy(args):
+    """The PayloadPolicy of the scan, with the history of the payloads on
+    the --database."""
+    return PayloadPolicy(PayloadHistory.open(args.database, journal_mode=journal_mode(args)),
+                         args.early_stop, probe=not args.no_probe)
+
+def open_page_store(args, corpus, surface_index):
+    """Return the PageStore if the scan is incremental, else None. The forms
+    attacked on previous scans are seeded on surface_index, and the ones
+    attacked on this one will be recorded on the store."""
+    if not args.incremental:
+        return None
+    page_store = PageStore.open(args.pages_db, corpus,
+                                dict(injection=args.injection, verify=args.verify,
+                                     early_stop=args.early_stop, probe=not args.no_probe),
+                                journal_mode=journal_mode(args))
+    page_store.seed(surface_index)
+    surface_index.on_complete = page_store.record_surface
+    return page_store
+
+def share_surfaces(frontier, surface_index):
+    """With a shared frontier, the forms attacked by any process are not
+    attacked again by the others. After open_page_store, whose on_complete
+    it chains on."""
+    if isinstance(frontier, SharedFrontier):
+        frontier.share_surfaces(surface_index)
+
+def start_stats(args, stats, web_io, frontier, surface_index, result_writer,
+                page_store=None, policy=None):
+    """Plug every stat of the scan into stats, and start reporting them as
+    the arguments ask. Return whatever stop_stats needs to stop them."""
+    stats.add_source('frontier', frontier.stats)
+    stats.add_source('pool', lambda: web_io.pool_stats().as_dict())
+    stats.add_source('forms', surface_index.stats)
+    stats.add_source('writer', result_writer.stats)
+    if web_io.scheduler is not None:
+        stats.add_source('host_limits', web_io.scheduler.stats)
+    if page_store is not None:
+        stats.add_source('page_store', page_store.stats)
+    if policy is not None:
+        stats.add_source('payloads', policy.stats)
+    reporter = server = None
+    if args.progress_interval > 0 or args.stats_file:
+        reporter = StatsReporter(stats, args.progress_interval or 10, args.stats_file,
+                                 show=args.progress_interval > 0)
+        reporter.start()
+    if args.stats_port is not None:
+        server = StatsServer(stats, args.stats_port).start()
+    return reporter, server
+
+def stop_stats(reporter, server):
+    if reporter is not None:
+        reporter.stop()
+    if server is not None:
+        server.stop()
+
+def report_stats(stats, web_io):
+    """Print and log a summary of the stats of the finished scan."""
+    snapshot = stats.snapshot()
+    lines = [stats.progress_line(snapshot)]
+    for stage in STAGES:
+        if stage in snapshot['stages']:
+            lines.append("Stage {0}: {count} times, {total_s}s in total, {mean_ms}ms average, "
+                         "p50 {p50_ms}ms, p99 {p99_ms}ms".format(stage, **snapshot['stages'][stage]))
+    lines.append("Connection pools: {0}".format(web_io.pool_stats()))
+    lines.append("Forms: {surfaces} distinct forms attacked, {hits} found again "
+                 "and skipped, {seeded} attacked on previous scans, {shared} by other "
+                 "processes".format(**snapshot['forms']))
+    counters = snapshot['counters']
+    skipped = {reason: counters.get('pages_skipped_' + reason, 0)
+               for reason in ('content_type', 'binary', 'too_large')}
+    if any(skipped.values()):
+        lines.append("Skipped pages: {content_type} not HTML by their Content-Type, {binary} "
+                     "binary, {too_large} too large; {0:.1f}MB never parsed".format(
+                         counters.get('bytes_skipped', 0) / 1024 / 1024, **skipped))
+    if 'payloads' in snapshot:
+        lines.append("Payloads: {payloads_sent} sent, {not_sent} not sent to inputs already "
+                     "found vulnerable, {pruned_inputs} inputs pruned by {probes} probe requests"
+                     .format(**snapshot['payloads']))
+    if 'shard' in snapshot['frontier']:
+        lines.append("Shared frontier: shard {shard}, {claimed} URLs visited, {stolen} of other "
+                     "shards, {requeued} expired leases requeued, {lost_leases} leases lost, "
+                     "{failed_syncs} syncs failed, {done} URLs done by {workers} processes "
+                     "still on it"
+                     .format(**snapshot['frontier']))
+    if 'page_store' in snapshot:
+        lines.append("Incremental scan: {unchanged} pages unchanged, not attacked again, "
+                     "{xss_copied} XSS of theirs copied from the last scan; {changed} changed, "
+                     "{new} new".format(**snapshot['page_store']))
+    for host, host_stats in sorted(snapshot.get('host_limits', {}).items()):
+        lines.append("Host {0}: limit {limit} at the end, {requests} requests, {errors} failed, "
+                     "{throttled} throttled, {latency_ms}ms average".format(host, **host_stats))
+    logger.info("Scan finished.\n" + "\n".join(lines))
+    for line in lines:
+        print(line)
+
 def main():
     """Starts up the program. As many threads specified on the arguments
     passed to the program are created, each one will process an URL as
     described on the Worker class.
     """
     args = parse_args()
-    web_io = WebIO(process_cookies(args.cookies))
-    initial_url = URL(args.initial_url)
-    Worker.websites_to_visit.put(initial_url)
-    lock = threading.Lock()
+    configure_logging(args.log_file, args.log_level, args.log_json)
+    if args.engine == 'async':
+        return main_async(args)
+    Worker.stats = ScanStats()
+    scheduler = None if args.no_adaptive else HostScheduler(maximum=max_per_host(args))
+    web_io = WebIO(process_cookies(args.cookies), pool_size=pool_size(args),
+                   retries=args.retries, backoff_factor=args.backoff,
+                   timeout=args.timeout, scheduler=scheduler, stats=Worker.stats,
+                   max_body_size=megabytes(args.max_body_size))
+    Worker.websites_to_visit = open_frontier(args)
+    Worker.corpus = PayloadCorpus.load()
+    Worker.reload_payloads = args.reload_payloads
+    Worker.injection = args.injection
+    Worker.verify = args.verify
+    Worker.policy = make_policy(args)
+    Worker.parser = make_parser(args.parser, args.parse_processes, args.parse_queue)
+    Worker.page_store = open_page_store(args, Worker.corpus, Worker.surface_index)
+    share_surfaces(Worker.websites_to_visit, Worker.surface_index)
+    result_writer = ResultWriter(args.initial_url, args.database, stats=Worker.stats,
+                                 journal_mode=journal_mode(args))
+    result_writer.start()
+    reporting = start_stats(args, Worker.stats, web_io, Worker.websites_to_visit,
+                            Worker.surface_index, result_writer, Worker.page_store,
+                            Worker.policy)
     for t in range(args.threads):
-        w = Worker(lock, web_io, args.initial_url)
+        w = Worker(web_io, result_writer)
         w.start()
-        time.sleep(1) # HORRIBLE HACK TO AVOID ALMOST-IMPOSSIBLE RACE-CONDITION D:
     Worker.websites_to_visit.join()
-    print("Progam is finished! Check the database on persistence/xss.db.")
+    Worker.websites_to_visit.close()
+    result_writer.close()
+    Worker.parser.close()
+    if Worker.page_store is not None:
+        Worker.page_store.close()
+    Worker.policy.history.close()
+    stop_stats(*reporting)
+    report_stats(Worker.stats, web_io)
+    print("Progam is finished! Check the database on {0}.".format(args.database))
+    return None
+
+def main_async(args):
+    """Starts up the program with the asyncio engine. aiohttp is only
+    imported here, so the threaded engine doesn't need it."""
+    from utils.async_utils import AsyncWebIO, AsyncHostScheduler
+    stats = ScanStats()
+    scheduler = None if args.no_adaptive else AsyncHostScheduler(maximum=max_per_host(args))
+    web_io = AsyncWebIO(process_cookies(args.cookies), args.concurrency,
+                        pool_size=pool_size(args), retries=args.retries,
+                        backoff_factor=args.backoff, timeout=args.timeout,
+                        scheduler=scheduler, stats=stats,
+                        max_body_size=megabytes(args.max_body_size))
+    result_writer = ResultWriter(args.initial_url, args.database, stats=stats,
+                                 journal_mode=journal_mode(args))
+    result_writer.start()
+    parser = make_parser(args.parser, args.parse_processes, args.parse_queue)
+    frontier = open_frontier(args)
+    scanner = AsyncScanner(web_io, result_writer, frontier, args.concurrency,
+                           PayloadCorpus.load(), args.reload_payloads, parser, stats,
+                           injection=args.injection, verify=args.verify,
+                           policy=make_policy(args))
+    scanner.page_store = open_page_store(args, scanner.corpus, scanner.surface_index)
+    share_surfaces(frontier, scanner.surface_index)
+    reporting = start_stats(args, stats, web_io, frontier, scanner.surface_index,
+                            result_writer, scanner.page_store, scanner.policy)
+    scanner.run()
+    frontier.close()
+    result_writer.close()
+    parser.close()
+    if scanner.page_store is not None:
+        scanner.page_store.close()
+    scanner.policy.history.close()
+    stop_stats(*reporting)
+    report_stats(stats, web_io)
+    print("Progam is finished! Check the database on {0}.".format(args.database))
     return None
 
 if __name__ == '__main__':
@@ -1,7 +1,30 @@
-from models.models import URL, XSS, ScrappedWebsite, XSSDetector
-from utils.utils import WebIO
+from models.models import URL, XSS, ScrappedWebsite, XSSDetector, PayloadCorpus, AttackSurfaceIndex
+from models.extractors import extract
+from models.parsing import InlineParser, ProcessPoolParser
+from persistence.frontier import Frontier, BloomFilter, fingerprint
+from persistence.shared_frontier import SharedFrontier, BUCKETS
+from persistence.page_store import PageStore
+from persistence.db_manager import ResultWriter
+from persistence.payload_history import PayloadHistory
+from models.scheduling import PayloadPolicy, family
+from models.verification import PatternAutomaton, ReflectionVerifier, REFLECTED, ENCODED, ABSENT, PROBE, UNVERIFIED
+from utils.utils import WebIO, HostLimit, HostScheduler, BodyReader, retry_after_seconds
+from utils.stats import Histogram, ScanStats
+from logs.logger import logger, configure_logging, stop_logging
+from benchmarks.site import SyntheticSite
 import requests
 import unittest
+import unittest.mock
+import threading
+import tempfile
+import os
+import json
+import asyncio
+import collections
+import queue
+import html
+import sqlite3
+import time
 
 class TestURL(unittest.TestCase):
     example_url = "http://example.com/path?query=myquery#4"
@@ -27,6 +50,22 @@ class TestURL(unittest.TestCase):
         self.assertEqual(URL(TestURL.example_url), URL(TestURL.example_url_2))
         self.assertNotEqual(URL(TestURL.example_url), URL(TestURL.example_url_3))
 
+    def test_url_normalization(self):
+        self.assertEqual(URL("HTTP://Example.COM:80/Path?b=2&a=1"), URL("http://example.com/Path?a=1&b=2"))
+        self.assertNotEqual(URL("http://example.com/Path"), URL("http://example.com/path"))
+        self.assertEqual(URL("http://example.com"), URL("http://example.com/"))
+        self.assertEqual(URL("http://example.com/Path?b=2&a=1").url, "http://example.com/Path?b=2&a=1")
+
+    def test_url_hash_is_consistent_with_equality(self):
+        self.assertEqual(len({URL(TestURL.example_url), URL(TestURL.example_url_2),
+                              URL(TestURL.example_url_3)}), 2)
+
+    def test_relative_url_resolution(self):
+        gotten_from = URL("http://example.com/dir/page.html")
+        self.assertEqual(URL("other.html", gotten_from=gotten_from).url, "http://example.com/dir/other.html")
+        self.assertEqual(URL("../up", gotten_from=gotten_from).url, "http://example.com/up")
+        self.assertEqual(URL("//another.com/x", gotten_from=gotten_from).netloc, "another.com")
+
 class TestScrappedWebsite(unittest.TestCase):
     website = "https://google-gruyere.appspot.com/201813828985/"
     website_as_string = requests.get(website, cookies={'GRUYERE': '58850990|c||author', 'GRUYERE_ID': '201813828985'}).text
@@ -53,6 +92,44 @@ class TestScrappedWebsite(unittest.TestCase):
         self.assertEqual(TestScrappedWebsite.another_scrapped_website.get_exposed_inputs(), inputs)
 
 
+class TestExtractors(unittest.TestCase):
+    html = ('<a href="/a">a</a><a>no href</a><a href="/b?x=1&amp;y=2">b</a>'
+            '<form action="/search" method="POST"><input name="q" value="hi">'
+            '<input type="file" name="f"><textarea name="t">some text</textarea>'
+            '<select name="s"><option>one</option><option value="2" selected>two</option>'
+            '</select><button name="b" value="go">Go</button></form>')
+
+    def test_extractors_agree(self):
+        links = ['/a', '/b?x=1&y=2']
+        forms = [('POST', '/search', [('text', 'q', 'hi'), ('file', 'f', None),
+                                      ('textarea', 't', 'some text'), ('select', 's', '2'),
+                                      ('button', 'b', 'go')])]
+        for extractor in ('stream', 'soup'):
+            extraction = extract(TestExtractors.html, extractor)
+            self.assertEqual(extraction.links, links)
+            self.assertEqual(extraction.forms, forms)
+
+    def test_exposed_forms(self):
+        scrapped_website = ScrappedWebsite(URL("http://example.com/"), TestExtractors.html)
+        self.assertEqual(scrapped_website.get_exposed_forms(),
+                         [('post', URL("http://example.com/search"),
+                           [(False, 'q'), (True, 'f'), (False, 't'), (False, 's'), (False, 'b')])])
+
+
+class TestParsers(unittest.TestCase):
+    def test_process_pool_parser_matches_inline(self):
+        url = URL("http://example.com/")
+        html = TestExtractors.html + '<a href="/a">a again</a>'
+        inline = InlineParser().parse(url, html)
+        pool_parser = ProcessPoolParser(processes=1)
+        try:
+            pooled = pool_parser.parse(url, html)
+        finally:
+            pool_parser.close()
+        self.assertEqual(pooled.get_unique_relevant_links(), inline.get_unique_relevant_links())
+        self.assertEqual(pooled.get_exposed_forms(), inline.get_exposed_forms())
+
+
 class TestXSSDetector(unittest.TestCase):
     xss_detector = XSSDetector(TestScrappedWebsite.another_scrapped_website, WebIO(cookies=None))
 
@@ -65,3 +142,1088 @@ class TestXSSDetector(unittest.TestCase):
         TestXSSDetector.xss_detector._file_upload_tests = []
         TestXSSDetector.xss_detector.attack_information = TestXSSDetector.xss_detector._create_attack_information()
         self.assertEqual(TestXSSDetector.xss_detector.detect(), known_xss)
+
+
+class TestBatchInjection(unittest.TestCase):
+    html = ('<form action="/signup" method="post">' +
+            ''.join('<input name="field{0}">'.format(i) for i in range(16)) +
+            '<input type="hidden" name="token" value="abc"><input type="email" name="mail">'
+            '<input type="checkbox" name="terms"><input type="submit" value="Go"></form>')
+    corpus = PayloadCorpus('xss_tests', ('<script>', '<img>'), (), (), (), {})
+
+    class WebIO:
+        """Flags a request only if its vulnerable field has a payload."""
+        def __init__(self, vulnerable):
+            self.vulnerable = vulnerable
+            self.payloads = []
+
+        def was_request_accepted(self, url, method, is_upload, payload):
+            self.payloads.append(payload)
+            return payload.get(self.vulnerable, '').startswith('<')
+
+    class AsyncWebIO(WebIO):
+        async def was_request_accepted(self, url, method, is_upload, payload):
+            return TestBatchInjection.WebIO.was_request_accepted(self, url, method, is_upload, payload)
+
+    def detector(self, web_io, injection='batch'):
+        scrapped_website = ScrappedWebsite(URL("http://example.com/"), TestBatchInjection.html)
+        return XSSDetector(scrapped_website, web_io, TestBatchInjection.corpus, injection=injection)
+
+    def test_first_requests_look_like_a_browser_submission(self):
+        detector = self.detector(self.WebIO(None))
+        self.assertEqual(len(detector.attack_information), 2)
+        method, url, is_upload, payload = detector.attack_information[0]
+        self.assertEqual(payload['field7'], '<script>')
+        self.assertEqual(payload['mail'], '<script>')
+        # a server may reflect hidden fields and checkboxes as well
+        self.assertEqual(payload['token'], '<script>')
+        self.assertEqual(payload['terms'], '<script>')
+        self.assertNotIn('', payload)
+
+    def test_finds_hidden_fields_like_single_injection(self):
+        web_io = self.WebIO('token')
+        xss_found = self.detector(web_io).detect()
+        self.assertEqual(len(xss_found), 2)
+        for xss in xss_found:
+            payload = json.loads(xss.payload)
+            self.assertEqual([name for name, value in payload.items() if value.startswith('<')],
+                             ['token'])
+            self.assertEqual(payload['terms'], 'on')
+        self.assertEqual(len(self.detector(self.WebIO('token'), 'single').detect()), 2)
+
+    def test_no_vulnerable_field_costs_a_request_per_payload(self):
+        web_io = self.WebIO(None)
+        self.assertEqual(self.detector(web_io).detect(), [])
+        self.assertEqual(len(web_io.payloads), 2)
+
+    def test_bisects_down_to_the_vulnerable_field(self):
+        web_io = self.WebIO('field5')
+        xss_found = self.detector(web_io).detect()
+        self.assertEqual(len(xss_found), 2)
+        for xss in xss_found:
+            payload = json.loads(xss.payload)
+            self.assertEqual([name for name, value in payload.items() if value.startswith('<')],
+                             ['field5'])
+            self.assertEqual(payload['field6'], 'test')
+        single_web_io = self.WebIO('field5')
+        self.detector(single_web_io, 'single').detect()
+        self.assertLess(len(web_io.payloads) * 2, len(single_web_io.payloads))
+
+    def test_async_finds_the_same(self):
+        web_io = self.AsyncWebIO('mail')
+        xss_found = asyncio.run(self.detector(web_io).detect_async())
+        self.assertEqual(xss_found, self.detector(self.WebIO('mail')).detect())
+
+
+class TestReflectionVerifier(unittest.TestCase):
+    corpus = PayloadCorpus('xss_tests', ('<script>alert(1)</script>', '"><img src=x>'),
+                           (), (), (), {})
+
+    class WebIO:
+        """Answers with the comment field as render makes it."""
+        def __init__(self, render):
+            self.render = render
+
+        def get_page_response(self, url, method, is_upload, payload):
+            return TestReflectionVerifier.Response(self.render(payload.get('comment', '')))
+
+    class Response:
+        def __init__(self, text, status_code=200, truncated=False):
+            self.text = text
+            self.status_code = status_code
+            self.truncated = truncated
+
+        def __bool__(self):
+            return self.status_code < 400
+
+    def setUp(self):
+        self.verifier = ReflectionVerifier.for_corpus(TestReflectionVerifier.corpus)
+        self.test = '<script>alert(1)</script>'
+        self.tagged = self.verifier.tag(self.test)
+
+    def test_automaton_finds_every_pattern(self):
+        automaton = PatternAutomaton('xs', [('xsa', 1), ('xsab', 2), ('xsb', 3)])
+        self.assertEqual(list(automaton.iter_matches('xsabc xsb xs xsa')),
+                         [(0, 1), (0, 2), (6, 3), (13, 1)])
+        self.assertRaises(ValueError, PatternAutomaton, 'xs', [('a', 1)])
+
+    def test_outcomes(self):
+        self.assertEqual(self.verifier.verify('<p>' + self.tagged + '</p>', self.test), REFLECTED)
+        self.assertEqual(self.verifier.verify(html.escape(self.tagged), self.test), ENCODED)
+        self.assertEqual(self.verifier.verify(self.tagged[:11] + 'alert(1)', self.test), ENCODED)
+        self.assertEqual(self.verifier.verify('<p>nothing</p>', self.test), ABSENT)
+        other = self.verifier.tag('"><img src=x>')
+        self.assertEqual(self.verifier.verify(other, self.test), ABSENT)
+
+    def test_only_the_request_nonce_counts(self):
+        sent = self.verifier.tag(self.test, 'a1b2c3')
+        self.assertEqual(self.verifier.verify(sent, self.test, 'a1b2c3'), REFLECTED)
+        self.assertEqual(self.verifier.verify(html.escape(sent), self.test, 'a1b2c3'), ENCODED)
+        self.assertEqual(self.verifier.verify(sent, self.test, 'd4e5f6'), ABSENT)
+        self.assertEqual(self.verifier.verify(sent[:6], self.test, 'a1b2c3'), ABSENT)
+
+    def test_uris_and_uploads_are_tagged_after(self):
+        uri, upload = 'javascript:alert(1)', b'GIF89a<script>alert(1)</script>'
+        verifier = ReflectionVerifier((uri, upload))
+        sent = verifier.tag(uri, 'a1b2c3')
+        self.assertTrue(sent.startswith(uri + '//a1b2c3xsc'))
+        self.assertEqual(verifier.verify('<a href="{0}">'.format(sent), uri, 'a1b2c3'), REFLECTED)
+        self.assertEqual(verifier.verify(sent.replace(':', '&#58;'), uri, 'a1b2c3'), ENCODED)
+        self.assertEqual(verifier.verify(sent, uri, 'd4e5f6'), ABSENT)
+        sent = verifier.tag(upload, 'a1b2c3')
+        self.assertTrue(sent.startswith(upload))
+        self.assertEqual(verifier.verify(sent.decode(), upload, 'a1b2c3'), REFLECTED)
+
+    def test_stored_payloads_only_flag_the_form_storing_them(self):
+        html_forms = ('<form action="/guestbook"><input name="comment"></form>'
+                      '<form action="/search"><input name="q"></form>')
+        scrapped_website = ScrappedWebsite(URL("http://example.com/"), html_forms)
+
+        class Guestbook:
+            """Shows every comment ever stored on every page."""
+            def __init__(self):
+                self.comments = []
+
+            def get_page_response(self, url, method, is_upload, payload):
+                if url.endswith('/guestbook'):
+                    self.comments.append(payload['comment'])
+                return TestReflectionVerifier.Response(''.join(self.comments))
+        detector = XSSDetector(scrapped_website, Guestbook(), TestReflectionVerifier.corpus,
+                               injection='batch', verifier=self.verifier, reflected_only=True)
+        xss_found = detector.detect()
+        self.assertEqual(len(xss_found), 2)
+        self.assertTrue(all('comment' in json.loads(xss.payload) for xss in xss_found))
+
+    def test_detector_flags_only_reflected_payloads(self):
+        html_form = '<form action="/c"><input name="q"><textarea name="comment"></textarea></form>'
+        scrapped_website = ScrappedWebsite(URL("http://example.com/"), html_form)
+        for render, expected in ((lambda comment: comment, [REFLECTED, REFLECTED]),
+                                 (html.escape, [])):
+            web_io = self.WebIO(render)
+            detector = XSSDetector(scrapped_website, web_io, TestReflectionVerifier.corpus,
+                                   injection='batch', verifier=self.verifier, reflected_only=True)
+            xss_found = detector.detect()
+            self.assertEqual([xss.reflection for xss in xss_found], expected)
+            for xss in xss_found:
+                self.assertIn('xsc', json.loads(xss.payload)['comment'])
+        detector = XSSDetector(scrapped_website, self.WebIO(html.escape),
+                               TestReflectionVerifier.corpus, verifier=self.verifier)
+        self.assertEqual({xss.reflection for xss in detector.detect()}, {ENCODED, ABSENT})
+
+    def test_what_may_be_past_the_max_body_size_is_unverified(self):
+        html_form = '<form action="/c"><textarea name="comment"></textarea></form>'
+        scrapped_website = ScrappedWebsite(URL("http://example.com/"), html_form)
+
+        class WebIO:
+            def get_page_response(self, url, method, is_upload, payload):
+                comment = payload['comment']
+                if comment.endswith('<script>alert(1)</script>'):
+                    return TestReflectionVerifier.Response(comment, truncated=True)
+                return TestReflectionVerifier.Response('x' * 50, truncated=True)
+        detector = XSSDetector(scrapped_website, WebIO(), TestReflectionVerifier.corpus,
+                               verifier=self.verifier, reflected_only=True)
+        self.assertEqual(sorted(xss.reflection for xss in detector.detect()),
+                         [REFLECTED, UNVERIFIED])
+
+    def test_probe_keeps_inputs_open_inside_attributes(self):
+        breakout = '" autofocus onfocus=alert(1) x="'
+        corpus = PayloadCorpus('xss_tests', ('<script>alert(1)</script>', breakout), (), (), (), {})
+        verifier = ReflectionVerifier.for_corpus(corpus)
+        html_form = '<form action="/c"><input name="comment"></form>'
+        scrapped_website = ScrappedWebsite(URL("http://example.com/"), html_form)
+        in_attribute = lambda comment: '<input value="{0}">'.format(
+            comment.replace('<', '&lt;').replace('>', '&gt;'))
+        for render, found in ((in_attribute, [breakout]), (html.escape, []),
+                              (lambda comment: '', [])):
+            policy = PayloadPolicy(probe=True)
+            detector = XSSDetector(scrapped_website, self.WebIO(render), corpus, injection='batch',
+                                   verifier=verifier, reflected_only=True, policy=policy)
+            self.assertEqual([json.loads(xss.payload)['comment'][17:] for xss in detector.detect()],
+                             found)
+            self.assertEqual(policy.stats()['pruned_inputs'], 0 if found else 1)
+        probe = verifier.tag(PROBE)
+        self.assertEqual(verifier.probe_survivors(in_attribute(probe)), {'"', "'"})
+        self.assertEqual(verifier.probe_survivors(html.escape(probe) + '<p>'), set())
+
+    def test_old_databases_get_the_reflection_column(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'xss.db')
+            connection = sqlite3.connect(path)
+            connection.execute('CREATE TABLE xss (id INTEGER PRIMARY KEY, scan TEXT NOT NULL, '
+                               'url TEXT NOT NULL, payload TEXT NOT NULL, method TEXT NOT NULL, '
+                               'found_at REAL NOT NULL)')
+            connection.close()
+            writer = ResultWriter('http://example.com/', path)
+            writer.start()
+            writer.write_xss_list_to_db([XSS(URL("http://example.com/"), {'q': 'x'}, 'get',
+                                             REFLECTED)])
+            writer.close()
+            connection = sqlite3.connect(path)
+            self.assertEqual(connection.execute('SELECT reflection FROM xss').fetchall(),
+                             [(REFLECTED,)])
+            connection.close()
+
+    def test_old_databases_get_their_scan_tables_moved(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'xss.db')
+            connection = sqlite3.connect(path)
+            connection.execute('CREATE TABLE "http://example.com/" (id INTEGER PRIMARY KEY, '
+                               'url TEXT, payload TEXT, method TEXT)')
+            connection.execute('INSERT INTO "http://example.com/" (url, payload, method) '
+                               'VALUES (?, ?, ?)', ('http://example.com/a', '{"q": "x"}', 'get'))
+            connection.commit()
+            connection.close()
+            writer = ResultWriter('http://example.com/', path)
+            writer.start()
+            writer.close()
+            connection = sqlite3.connect(path)
+            self.assertEqual(connection.execute('SELECT scan, url, payload, method FROM xss')
+                             .fetchall(), [('http://example.com/', 'http://example.com/a',
+                                            '{"q": "x"}', 'get')])
+            self.assertEqual(connection.execute("SELECT name FROM sqlite_master WHERE type = "
+                                                "'table'").fetchall(), [('xss',)])
+            connection.close()
+
+
+class TestPayloadPolicy(unittest.TestCase):
+    tests = tuple('<script>alert({0})</script>'.format(i) for i in range(10)) + \
+        tuple('<img src=x onerror=alert({0})>'.format(i) for i in range(10))
+    corpus = PayloadCorpus('xss_tests', tests, (), (), (), {})
+    html = ('<form action="/a" method="get"><input name="a"><input name="b"><input name="c">'
+            '<input name="d"></form>')
+
+    class WebIO:
+        """Flags a request if a payload got to one of the vulnerable fields."""
+        def __init__(self, *vulnerable):
+            self.vulnerable = vulnerable
+            self.payloads = []
+
+        def was_request_accepted(self, url, method, is_upload, payload):
+            self.payloads.append(payload)
+            return any('<' in payload.get(name, '') for name in self.vulnerable)
+
+    def detect(self, web_io, policy):
+        scrapped_website = ScrappedWebsite(URL("http://example.com/"), TestPayloadPolicy.html)
+        return XSSDetector(scrapped_website, web_io, TestPayloadPolicy.corpus,
+                           injection='batch', policy=policy).detect()
+
+    def test_order(self):
+        self.assertEqual((family('<script>'), family('<svg onload=x>'), family('javascript:x'),
+                          family('"><b>'), family('">'), family('x'), family(b'x')),
+                         ('script', 'event_handler', 'uri', 'tag', 'breakout', 'other', 'upload'))
+        ordered = PayloadPolicy().order(TestPayloadPolicy.tests)
+        self.assertEqual(ordered[:4], [TestPayloadPolicy.tests[0], TestPayloadPolicy.tests[10],
+                                       TestPayloadPolicy.tests[1], TestPayloadPolicy.tests[11]])
+
+        class History:
+            def counts(self, tests):
+                return [(10, 9) if test == TestPayloadPolicy.tests[15] else (10, 0)
+                        for test in tests]
+        ordered = PayloadPolicy(History()).order(TestPayloadPolicy.tests)
+        self.assertEqual(ordered[0], TestPayloadPolicy.tests[15])
+        self.assertEqual(family(ordered[1]), 'event_handler')
+
+    def test_early_stop(self):
+        every = self.WebIO('b', 'c')
+        self.assertEqual(len(self.detect(every, PayloadPolicy())), 40)
+        per_input = self.WebIO('b', 'c')
+        policy = PayloadPolicy(early_stop='input')
+        xss_found = self.detect(per_input, policy)
+        self.assertEqual({name for xss in xss_found for name, value in json.loads(xss.payload).items()
+                          if '<' in value}, {'b', 'c'})
+        self.assertLess(len(per_input.payloads), len(every.payloads))
+        self.assertEqual(policy.stats()['not_sent'], 16)  # the last two waves, to b and c
+        per_form = self.WebIO('b', 'c')
+        self.detect(per_form, PayloadPolicy(early_stop='form'))
+        self.assertLessEqual(len(per_form.payloads), len(per_input.payloads))
+
+    def test_probe_prunes_inputs_which_block_everything(self):
+        web_io = self.WebIO()
+        policy = PayloadPolicy(probe=True)
+        self.assertEqual(self.detect(web_io, policy), [])
+        self.assertEqual(len(web_io.payloads), 1)
+        self.assertEqual(policy.stats()['pruned_inputs'], 4)
+        web_io = self.WebIO('d')
+        xss_found = self.detect(web_io, PayloadPolicy(probe=True))
+        self.assertEqual(len(xss_found), 20)
+        for payload in web_io.payloads[-20:]:
+            self.assertEqual([name for name, value in payload.items() if '<' in value], ['d'])
+
+    def test_history_is_kept_on_the_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'xss.db')
+            policy = PayloadPolicy(PayloadHistory.open(path))
+            self.detect(self.WebIO('a'), policy)
+            policy.record(collections.Counter({b'<upload>': 1}), collections.Counter())
+            policy.history.close()
+            history = PayloadHistory.open(path)
+            self.assertEqual(history.counts(TestPayloadPolicy.tests[:1] + (b'<upload>', 'x')),
+                             [(1, 1), (1, 0), (0, 0)])
+            self.assertEqual(history.stats(), dict(payloads=21, sent=21, hits=20))
+
+    def test_history_is_written_as_it_goes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'xss.db')
+            history = PayloadHistory.open(path, batch_size=2, flush_interval=3600)
+            families = {'a': 'other', 'b': 'other'}
+            history.record(collections.Counter('a'), collections.Counter(), families)
+            self.assertEqual(PayloadHistory.open(path).stats()['payloads'], 0)
+            history.record(collections.Counter('b'), collections.Counter('b'), families)
+            # never closed, as if the scan died
+            self.assertEqual(PayloadHistory.open(path).stats(), dict(payloads=2, sent=2, hits=1))
+            history.close()
+
+
+class TestPayloadCorpus(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.write('common', "<script>alert(1)</script>\n<svg onload=alert(1)>\n")
+        self.write('get_method', "<svg onload=alert(1)>\n<img src=x onerror=alert(1)>\n")
+        self.write('post_method', "<img src=x onerror=alert(1)>\n<img src=x onerror=alert(1)>\n")
+        os.mkdir(os.path.join(self.directory.name, 'upload_tests'))
+        self.write('upload_tests/1.html', "<script>alert(1)</script>")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, content):
+        with open(os.path.join(self.directory.name, name), 'w') as f:
+            f.write(content)
+
+    def test_load_deduplicates_across_files(self):
+        corpus = PayloadCorpus.load(self.directory.name)
+        self.assertEqual(corpus.common_tests, ("<script>alert(1)</script>", "<svg onload=alert(1)>"))
+        self.assertEqual(corpus.get_tests, ("<img src=x onerror=alert(1)>",))
+        self.assertEqual(corpus.post_tests, ("<img src=x onerror=alert(1)>",))
+        self.assertEqual(corpus.file_upload_tests, (b"<script>alert(1)</script>",))
+
+    def test_refreshed_only_reloads_when_files_change(self):
+        corpus = PayloadCorpus.load(self.directory.name)
+        self.assertIs(corpus.refreshed(), corpus)
+        self.write('upload_tests/2.html', "<svg onload=alert(2)>")
+        refreshed = corpus.refreshed()
+        self.assertIsNot(refreshed, corpus)
+        self.assertEqual(len(refreshed.file_upload_tests), 2)
+
+
+class TestAttackSurfaceIndex(unittest.TestCase):
+    action = URL("http://example.com/search")
+    page = URL("http://example.com/")
+    another_page = URL("http://example.com/about")
+    payload = {'q': "<script>alert(1)</script>"}
+
+    def test_surface_is_attacked_once(self):
+        index = AttackSurfaceIndex()
+        key = index.surface_key('get', TestAttackSurfaceIndex.action, ['q'])
+        self.assertIsNone(index.claim(key, TestAttackSurfaceIndex.page))
+        index.complete(key, [(TestAttackSurfaceIndex.payload, 'get')])
+        self.assertEqual(index.claim(key, TestAttackSurfaceIndex.another_page),
+                         [XSS(TestAttackSurfaceIndex.another_page, TestAttackSurfaceIndex.payload, 'get')])
+        self.assertEqual(index.stats(), dict(surfaces=1, seeded=0, shared=0, hits=1, misses=1))
+
+    def test_waiting_pages_get_findings_on_complete(self):
+        index = AttackSurfaceIndex()
+        key = index.surface_key('get', TestAttackSurfaceIndex.action, ['q'])
+        index.claim(key, TestAttackSurfaceIndex.page)
+        self.assertEqual(index.claim(key, TestAttackSurfaceIndex.another_page), [])
+        self.assertEqual(index.complete(key, [(TestAttackSurfaceIndex.payload, 'get')]),
+                         [XSS(TestAttackSurfaceIndex.another_page, TestAttackSurfaceIndex.payload, 'get')])
+
+
+class TestFrontier(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'frontier.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def urls(self, amount):
+        return [URL("http://example.com/page{0}".format(i)) for i in range(amount)]
+
+    def test_put_claims_each_url_once(self):
+        frontier = Frontier.open(self.path)
+        self.assertTrue(frontier.put(URL("http://example.com/a?x=1&y=2")))
+        self.assertFalse(frontier.put(URL("http://EXAMPLE.com/a?y=2&x=1#top")))
+        self.assertEqual(frontier.unfinished_tasks, 1)
+        frontier.close()
+
+    def test_spills_to_disk_and_back(self):
+        frontier = Frontier.open(self.path, max_pending_in_memory=2, max_visited_in_memory=3)
+        urls = self.urls(10)
+        for url in urls:
+            frontier.put(url)
+        self.assertFalse(any(frontier.put(url) for url in urls))
+        got = [frontier.get(block=False) for _ in urls]
+        self.assertEqual(set(got), set(urls))
+        for url in got:
+            frontier.task_done(url)
+        frontier.join()
+        frontier.close()
+
+    def test_resume_from_checkpoint(self):
+        frontier = Frontier.open(self.path, max_pending_in_memory=2)
+        urls = self.urls(5)
+        for url in urls:
+            frontier.put(url)
+        frontier.task_done(frontier.get())
+        in_flight = frontier.get()
+        frontier.checkpoint()
+        resumed = Frontier.open(self.path, resume=True)
+        self.assertEqual(resumed.unfinished_tasks, 4)
+        self.assertFalse(resumed.put(urls[0]))
+        self.assertEqual({resumed.get(block=False) for _ in range(4)}, set(urls[1:]))
+        self.assertIn(in_flight, urls[1:])
+        resumed.close()
+
+    def test_resume_without_checkpoint_fails(self):
+        Frontier.open(self.path).put(URL("http://example.com/"))
+        self.assertRaises(ValueError, Frontier.open, self.path, resume=True)
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add(i * 7919 - 2 ** 62)
+        self.assertTrue(all(i * 7919 - 2 ** 62 in bloom for i in range(1000)))
+
+
+class TestSharedFrontier(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'shared.db')
+        self.frontiers = []
+
+    def tearDown(self):
+        for frontier in self.frontiers:
+            if not frontier._closed:
+                frontier.close()
+        self.directory.cleanup()
+
+    def open(self, **kwargs):
+        kwargs.setdefault('sync_interval', 0.05)
+        frontier = SharedFrontier.open(self.path, **kwargs)
+        self.frontiers.append(frontier)
+        return frontier
+
+    def stop_syncing(self, frontier):
+        """As good as dead, as far as the others can tell."""
+        with frontier._lock:
+            frontier._stopping = True
+            frontier._wake.notify()
+        frontier._syncer.join()
+
+    def urls(self, amount):
+        return [URL("http://example.com/page{0}".format(i)) for i in range(amount)]
+
+    def test_processes_share_urls_and_completion(self):
+        first, second = self.open(shard=0, shards=2), self.open(shard=1, shards=2)
+        urls = self.urls(20)
+        self.assertTrue(all(first.put(url) for url in urls[:10]))
+        self.assertFalse(any(first.put(url) for url in urls[:10]))
+        self.assertTrue(all(second.put(url) for url in urls))
+        first.checkpoint()
+        second.checkpoint()
+        self.assertEqual(second.unfinished_tasks, 20)  # as of the last sync, its own
+        got = {first: [], second: []}
+        for frontier in (first, second):
+            while True:
+                try:
+                    got[frontier].append(frontier.get(timeout=0.2))
+                except queue.Empty:
+                    break
+        self.assertEqual(sorted(got[first] + got[second], key=str), sorted(urls, key=str))
+        for frontier, its_urls in got.items():
+            for url in its_urls:
+                frontier.task_done(url)
+        first.join()
+        second.join()
+        self.assertEqual(second.unfinished_tasks, 0)
+        self.assertRaises(queue.Empty, first.get, timeout=0.1)
+
+    def test_urls_of_its_shard_first(self):
+        frontier = self.open(shard=1, shards=2, batch=20)
+        urls = self.urls(20)
+        for url in urls:
+            frontier.put(url)
+        frontier.checkpoint()
+        got = [frontier.get(block=False) for _ in urls]
+        of_shard = [fingerprint(url) % BUCKETS % 2 == 1 for url in got]
+        self.assertEqual(of_shard, sorted(of_shard, reverse=True))
+        self.assertEqual(frontier.stats()['stolen'], of_shard.count(False))
+
+    def test_expired_leases_are_requeued(self):
+        crashed = self.open(lease_seconds=0.2)
+        survivor = self.open(lease_seconds=0.2)
+        crashed.put(URL("http://example.com/"))
+        crashed.checkpoint()
+        url = crashed.get(block=False)
+        self.stop_syncing(crashed)
+        self.assertRaises(queue.Empty, survivor.get, block=False)
+        with self.assertLogs(logger, 'WARNING') as logged:
+            self.assertEqual(survivor.get(timeout=5), url)
+            crashed.task_done(url)
+            crashed._sync()  # it wakes up late
+        self.assertEqual(len(logged.records), 2)
+        self.assertEqual(crashed.stats()['lost_leases'], 1)
+        self.assertEqual(survivor.unfinished_tasks, 1)
+        survivor.task_done(url)
+        survivor.join()
+        self.assertEqual(survivor.stats()['requeued'], 1)
+
+    def test_heartbeat_keeps_leases(self):
+        owner, other = self.open(lease_seconds=0.2), self.open(lease_seconds=0.2)
+        owner.put(URL("http://example.com/"))
+        owner.checkpoint()
+        url = owner.get(block=False)
+        self.assertRaises(queue.Empty, other.get, timeout=0.5)
+        owner.task_done(url)
+
+    def test_failed_syncs_lose_nothing(self):
+        frontier = self.open(lease_seconds=3)
+        frontier.put(URL("http://example.com/"))
+        frontier.checkpoint()
+        url = frontier.get(block=False)
+        blocker = sqlite3.connect(self.path, isolation_level=None)
+        blocker.execute('BEGIN IMMEDIATE')
+        with self.assertLogs(logger, 'WARNING'):
+            frontier.put(URL("http://example.com/link"))
+            frontier.task_done(url)
+            time.sleep(1.5)
+        self.assertGreaterEqual(frontier.stats()['failed_syncs'], 1)
+        self.assertEqual(frontier.unfinished_tasks, 2)
+        blocker.execute('ROLLBACK')
+        blocker.close()
+        link = frontier.get(timeout=5)
+        self.assertEqual(link, URL("http://example.com/link"))
+        frontier.task_done(link)
+        frontier.join()
+        self.assertEqual(frontier.stats()['lost_leases'], 0)
+
+    def test_syncer_survives_unexpected_errors(self):
+        frontier = self.open()
+        claim, calls = frontier._claim, []
+
+        def claim_but_the_first_time(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise RuntimeError("bug")
+            return claim(*args)
+        with unittest.mock.patch.object(frontier, '_claim', side_effect=claim_but_the_first_time):
+            with self.assertLogs(logger, 'ERROR'):
+                frontier.put(URL("http://example.com/"))
+                url = frontier.get(timeout=5)
+        self.assertEqual(url, URL("http://example.com/"))
+        self.assertGreaterEqual(frontier.stats()['failed_syncs'], 1)
+        frontier.task_done(url)
+        frontier.join()
+
+    def test_remembers_only_the_last_urls_put(self):
+        frontier = self.open(max_known=4)
+        urls = self.urls(10)
+        self.assertTrue(all(frontier.put(url) for url in urls))
+        self.assertLessEqual(len(frontier._known) + len(frontier._known_before), 4)
+        self.assertFalse(frontier.put(urls[-1]))
+        self.assertTrue(frontier.put(urls[0]))  # forgotten here, not on the file
+        frontier.checkpoint()
+        self.assertEqual(frontier.unfinished_tasks, 10)
+
+    def test_shares_attacked_forms(self):
+        first, second = self.open(), self.open()
+        indexes = AttackSurfaceIndex(), AttackSurfaceIndex()
+        first.share_surfaces(indexes[0])
+        second.share_surfaces(indexes[1])
+        key = AttackSurfaceIndex.surface_key('get', URL("http://example.com/search"), ['q'])
+        self.assertIsNone(indexes[0].claim(key, URL("http://example.com/")))
+        indexes[0].complete(key, [({'q': '<script>'}, 'get')])
+        first.checkpoint()
+        second.checkpoint()
+        page = URL("http://example.com/other")
+        self.assertEqual(indexes[1].claim(key, page), [XSS(page, {'q': '<script>'}, 'get')])
+        self.assertEqual(indexes[1].stats()['shared'], 1)
+
+    def test_starts_over_unless_joining(self):
+        first = self.open()
+        first.put(URL("http://example.com/"))
+        first.checkpoint()
+        self.assertEqual(self.open().unfinished_tasks, 1)
+        for frontier in self.frontiers:
+            frontier.close()
+        self.assertEqual(self.open(resume=True).unfinished_tasks, 1)
+        self.frontiers[-1].close()
+        self.assertEqual(self.open().unfinished_tasks, 0)
+
+
+class TestPageStore(unittest.TestCase):
+    class Response:
+        def __init__(self, text, status_code=200, headers=None):
+            self.text = text
+            self.status_code = status_code
+            self.headers = headers or {}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'pages.db')
+        self.corpus = PayloadCorpus('xss_tests', ('<script>',), (), (), (b'upload',), {})
+        self.url = URL("http://example.com/")
+        self.key = AttackSurfaceIndex.surface_key('get', URL("http://example.com/search"), ['q'])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def scan_once(self, settings=None):
+        page_store = PageStore.open(self.path, self.corpus, settings)
+        page_store.record_surface(self.key, [({'q': '<script>'}, 'get')])
+        page_store.record_findings([XSS(self.url, {'q': '<script>'}, 'get', REFLECTED)])
+        page_store.record_page(self.url, self.Response('<html>', headers={'ETag': '"1"'}),
+                               {URL("http://example.com/about")})
+        page_store.close()
+
+    def test_shared_databases_are_not_on_wal(self):
+        def journal_mode(path):
+            connection = sqlite3.connect(path)
+            try:
+                return connection.execute('PRAGMA journal_mode').fetchone()[0]
+            finally:
+                connection.close()
+        xss_path = os.path.join(self.directory.name, 'xss.db')
+        for mode in ('wal', 'delete'):
+            PageStore.open(self.path, self.corpus, journal_mode=mode).close()
+            PayloadHistory.open(xss_path, journal_mode=mode).close()
+            writer = ResultWriter('http://example.com/', xss_path, journal_mode=mode)
+            writer.start()
+            writer.close()
+            self.assertEqual((journal_mode(self.path), journal_mode(xss_path)), (mode, mode))
+
+    def test_remembers_pages(self):
+        self.scan_once()
+        page_store = PageStore.open(self.path, self.corpus)
+        previous = page_store.previous_visit(self.url)
+        self.assertEqual(previous.conditional_headers(), {'If-None-Match': '"1"'})
+        self.assertTrue(previous.is_unchanged(self.Response('', status_code=304)))
+        self.assertTrue(previous.is_unchanged(self.Response('<html>')))
+        self.assertFalse(previous.is_unchanged(self.Response('<html><form>')))
+        self.assertEqual(previous.get_links(), {URL("http://example.com/about")})
+        self.assertIsNone(page_store.previous_visit(URL("http://example.com/new")))
+        page_store.close()
+
+    def test_seeds_attacked_forms(self):
+        self.scan_once()
+        page_store = PageStore.open(self.path, self.corpus)
+        index = AttackSurfaceIndex()
+        page_store.seed(index)
+        page = URL("http://example.com/other")
+        self.assertEqual(index.claim(self.key, page), [XSS(page, {'q': '<script>'}, 'get')])
+        page_store.close()
+
+    def test_unchanged_pages_keep_their_xss(self):
+        self.scan_once()
+        xss = [XSS(self.url, {'q': '<script>'}, 'get', REFLECTED)]
+        for scan in range(2):
+            page_store = PageStore.open(self.path, self.corpus)
+            previous = page_store.previous_visit(self.url)
+            self.assertEqual(previous.get_xss(self.url), xss)
+            self.assertEqual(previous.get_xss(self.url)[0].reflection, REFLECTED)
+            page_store.record_unchanged(self.url, previous)
+            self.assertEqual(page_store.stats()['xss_copied'], 1)
+            page_store.close()
+        page_store = PageStore.open(self.path, self.corpus)
+        page_store.record_page(self.url, self.Response('<html><p>'), set())
+        page_store.close()
+        page_store = PageStore.open(self.path, self.corpus)
+        self.assertEqual(page_store.previous_visit(self.url).get_xss(self.url), [])
+        page_store.close()
+
+    def test_forgets_everything_if_settings_change(self):
+        self.scan_once(dict(injection='batch', verify='reflection'))
+        page_store = PageStore.open(self.path, self.corpus, dict(injection='single',
+                                                                 verify='reflection'))
+        self.assertIsNone(page_store.previous_visit(self.url))
+        page_store.close()
+
+    def test_forgets_everything_if_payloads_change(self):
+        self.scan_once()
+        corpus = PayloadCorpus('xss_tests', ('<script>', '<img>'), (), (), (b'upload',), {})
+        page_store = PageStore.open(self.path, corpus)
+        self.assertIsNone(page_store.previous_visit(self.url))
+        index = AttackSurfaceIndex()
+        page_store.seed(index)
+        self.assertIsNone(index.claim(self.key, self.url))
+        page_store.close()
+
+
+class TestScanStats(unittest.TestCase):
+    def test_histogram_percentiles(self):
+        histogram = Histogram()
+        for milliseconds in range(1, 101):
+            histogram.observe(milliseconds / 1000)
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.percentile(0.5), 0.05, delta=0.05 * 0.19)
+        self.assertAlmostEqual(histogram.percentile(0.99), 0.099, delta=0.099 * 0.19)
+        self.assertEqual(histogram.percentile(1), 0.1)
+
+    def test_timer_counts_in_flight_and_hosts(self):
+        stats = ScanStats()
+        with stats.timer('fetch', 'example.com'):
+            self.assertEqual(stats.snapshot()['in_flight'], {'fetch': 1})
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['in_flight'], {})
+        self.assertEqual(snapshot['stages']['fetch']['count'], 1)
+        self.assertEqual(snapshot['hosts']['example.com']['fetch']['count'], 1)
+
+    def test_snapshot_has_sources_and_is_json(self):
+        stats = ScanStats()
+        stats.count('pages', 3)
+        stats.add_source('frontier', lambda: {'queued': 7})
+        stats.add_source('broken', lambda: 1 / 0)
+        snapshot = json.loads(json.dumps(stats.snapshot()))
+        self.assertEqual(snapshot['counters'], {'pages': 3})
+        self.assertEqual(snapshot['frontier'], {'queued': 7})
+        self.assertNotIn('broken', snapshot)
+        self.assertIn('3 pages', stats.progress_line())
+
+class TestBodyReader(unittest.TestCase):
+    def read(self, body_reader, chunks):
+        for chunk in chunks:
+            if not body_reader.feed(chunk):
+                break
+        return body_reader
+
+    def test_pages_must_be_html(self):
+        body_reader = BodyReader(page=True)
+        self.assertFalse(body_reader.wants_body(200, {'Content-Type': 'application/pdf'}))
+        self.assertEqual(body_reader.skipped, 'content_type')
+        self.assertEqual(body_reader.skipped_bytes({'Content-Length': '5000'}), 5000)
+        for content_type in ('text/html; charset=utf-8', 'application/xhtml+xml', None):
+            self.assertTrue(BodyReader(page=True).wants_body(200, {'Content-Type': content_type}))
+        self.assertTrue(BodyReader(page=True).wants_body(404, {'Content-Type': 'text/plain'}))
+        self.assertTrue(BodyReader().wants_body(200, {'Content-Type': 'application/json'}))
+
+    def test_binary_pages_are_not_read_past_the_first_chunk(self):
+        for first_chunk in (b'%PDF-1.4 ...', b'<html>\x00\x00'):
+            body_reader = self.read(BodyReader(page=True), [first_chunk, b'never read'])
+            self.assertEqual((body_reader.skipped, body_reader.body), ('binary', b''))
+            self.assertEqual(body_reader.bytes_read, len(first_chunk))
+        body_reader = self.read(BodyReader(page=True), [b'<html>', b'%PDF'])
+        self.assertEqual((body_reader.skipped, body_reader.body), (None, b'<html>%PDF'))
+
+    def test_max_size(self):
+        chunks = [b'<p>' * 10] * 10
+        body_reader = self.read(BodyReader(max_size=50, page=True), chunks)
+        self.assertEqual((body_reader.skipped, body_reader.body), ('too_large', b''))
+        self.assertEqual(body_reader.bytes_read, 60)
+        body_reader = self.read(BodyReader(max_size=50), chunks)
+        self.assertEqual((body_reader.skipped, body_reader.body), (None, b'<p>' * 16 + b'<p'))
+        self.assertTrue(body_reader.truncated)
+        self.assertFalse(self.read(BodyReader(max_size=300), chunks).truncated)
+        stats = ScanStats()
+        BodyReader(page=True).count_skipped(stats, {})
+        self.read(BodyReader(max_size=50, page=True), chunks).count_skipped(stats, {})
+        self.assertEqual(stats.snapshot()['counters'],
+                         {'pages_skipped_too_large': 1, 'bytes_skipped': 60})
+
+
+class TestLogging(unittest.TestCase):
+    def tearDown(self):
+        stop_logging()
+
+    def log_to(self, path, **kwargs):
+        configure_logging(path, console_level='CRITICAL', **kwargs)
+        for i in range(25):
+            logger.warning("Could not connect to the URL %s.", i)
+        logger.debug("Not important enough.")
+        stop_logging()
+        with open(path) as log_file:
+            return log_file.read().splitlines()
+
+    def test_repeats_are_summarized(self):
+        with tempfile.TemporaryDirectory() as directory:
+            lines = self.log_to(os.path.join(directory, 'logs.log'), burst=10)
+        self.assertEqual(len(lines), 11)
+        self.assertTrue(lines[0].endswith("Could not connect to the URL 0."))
+        self.assertTrue(lines[-1].endswith("Could not connect to the URL 24. (x15 more like it in 0s)"))
+
+    def test_summaries_dont_wait_for_the_next_record(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'logs.log')
+            configure_logging(path, console_level='CRITICAL', burst=1, interval=0.1)
+            for i in range(3):
+                logger.warning("Could not connect to the URL %s.", i)
+            time.sleep(0.5)
+            with open(path) as log_file:
+                lines = [line for line in log_file if "Could not connect" in line]
+            stop_logging()
+        self.assertEqual(len(lines), 2)
+        self.assertIn("Could not connect to the URL 2. (x2 more like it in", lines[-1])
+
+    def test_json(self):
+        with tempfile.TemporaryDirectory() as directory:
+            lines = self.log_to(os.path.join(directory, 'logs.log'), json_format=True, burst=30)
+        records = [json.loads(line) for line in lines]
+        self.assertEqual(len(records), 25)
+        self.assertEqual((records[3]['level'], records[3]['message']),
+                         ('WARNING', "Could not connect to the URL 3."))
+
+
+class TestHostLimit(unittest.TestCase):
+    def respond(self, host_limit, now, latency, status, retry_after=None):
+        host_limit.in_flight += 1
+        host_limit.on_response(now, latency, status, retry_after)
+
+    def test_grows_until_maximum(self):
+        host_limit = HostLimit(initial=2, maximum=8)
+        for i in range(20):
+            self.respond(host_limit, i, 0.05, 200)
+        self.assertEqual(host_limit.limit, 8)
+
+    def test_cuts_when_throttled_and_honours_retry_after(self):
+        host_limit = HostLimit(initial=8, maximum=8)
+        self.respond(host_limit, 100, 0.05, 200)
+        self.respond(host_limit, 101, 0.05, 429, retry_after=30)
+        self.assertEqual(host_limit.limit, 4)
+        self.assertEqual(host_limit.wait_time(101), 30)
+        self.assertEqual(host_limit.wait_time(131), 0)
+
+    def test_cuts_once_per_round_trip(self):
+        host_limit = HostLimit(initial=8, maximum=8)
+        self.respond(host_limit, 100, 1, 200)
+        self.respond(host_limit, 101, 1, None)
+        self.respond(host_limit, 101.5, 1, None)
+        self.assertEqual(host_limit.limit, 4)
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(retry_after_seconds("120"), 120)
+        self.assertEqual(retry_after_seconds("Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+        self.assertIsNone(retry_after_seconds("soon"))
+        self.assertIsNone(retry_after_seconds(None))
+
+
+class TestWebIO(unittest.TestCase):
+    def test_reuses_pooled_connections(self):
+        with SyntheticSite(pages=1, forms=0) as site:
+            web_io = WebIO({}, pool_size=2)
+            for _ in range(10):
+                self.assertEqual(web_io.get_website(site.url).status_code, 200)
+        self.assertEqual(web_io.pool_stats().as_dict(),
+                         dict(requests_sent=10, connections_opened=1, handshakes_avoided=9,
+                              reuse_ratio=0.9))
+
+    def test_retries_failed_requests(self):
+        with SyntheticSite(pages=1, forms=0, error_rate=1) as site:
+            web_io = WebIO({}, retries=2, backoff_factor=0)
+            self.assertIsNone(web_io.get_website(site.url))
+            self.assertEqual(site.stats.as_dict()['errors'], 3)
+        self.assertEqual(web_io.pool_stats().requests_sent, 3)
+
+    def get_home(self, scheduler=None, **site_options):
+        """Return how long it took, the response and what the site saw."""
+        with SyntheticSite(pages=1, forms=0, **site_options) as site:
+            web_io = WebIO({}, retries=2, backoff_factor=0, scheduler=scheduler)
+            started = time.monotonic()
+            response = web_io.get_website(site.url)
+            return time.monotonic() - started, response, site.stats.as_dict()
+
+    def test_throttled_requests_wait_for_the_scheduler(self):
+        scheduler = HostScheduler()
+        elapsed, response, site_stats = self.get_home(scheduler, throttled=1, retry_after=1)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(elapsed, 0.9)
+        self.assertEqual(site_stats['throttled'], 1)
+        [host_stats] = scheduler.stats().values()
+        self.assertEqual((host_stats['requests'], host_stats['throttled']), (2, 1))
+
+    def test_retry_after_is_capped_without_scheduler(self):
+        with unittest.mock.patch('utils.utils.MAX_RETRY_AFTER', 0.1):
+            elapsed, response, site_stats = self.get_home(throttled=2, retry_after=3600)
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(elapsed, 5)
+        self.assertEqual(site_stats['throttled'], 2)
+
+    def post_comment(self, scheduler=None, retries=2, **site_options):
+        """Return the response to a POST of a comment, and what the site saw."""
+        with SyntheticSite(pages=1, forms=0, **site_options) as site:
+            web_io = WebIO({}, retries=retries, backoff_factor=0, scheduler=scheduler)
+            response = web_io.get_page_response(site.url + 'form0', 'post', False,
+                                                {'comment': '<b>hi</b>'})
+            return response, site.stats.as_dict()
+
+    def test_throttled_posts_are_sent_again(self):
+        for scheduler in (HostScheduler(), None):
+            response, site_stats = self.post_comment(scheduler, throttled=1, retry_after=0)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('<b>hi</b>', response.text)
+            self.assertEqual((site_stats['throttled'], site_stats['attack_requests']), (1, 1))
+
+    def test_posts_throttled_to_the_end_are_unverified(self):
+        corpus = TestReflectionVerifier.corpus
+        html_form = '<form action="/form0" method="post"><textarea name="comment"></textarea></form>'
+        for verifier in (ReflectionVerifier.for_corpus(corpus), None):
+            with SyntheticSite(pages=1, forms=0, throttled=100, retry_after=0) as site:
+                web_io = WebIO({}, retries=1, backoff_factor=0, scheduler=HostScheduler())
+                detector = XSSDetector(ScrappedWebsite(URL(site.url), html_form), web_io, corpus,
+                                       injection='batch', verifier=verifier,
+                                       reflected_only=verifier is not None)
+                xss_found = detector.detect()
+                self.assertEqual(site.stats.as_dict()['throttled'], 4)
+            self.assertEqual([xss.reflection for xss in xss_found], [UNVERIFIED, UNVERIFIED])
+
+    def test_async_throttled_requests_wait_for_the_scheduler(self):
+        from utils.async_utils import AsyncWebIO, AsyncHostScheduler
+        scheduler = AsyncHostScheduler()
+
+        async def get_home(url):
+            web_io = AsyncWebIO({}, 4, retries=2, backoff_factor=0, scheduler=scheduler)
+            await web_io.open()
+            try:
+                return await web_io.get_website(url)
+            finally:
+                await web_io.close()
+        with SyntheticSite(pages=1, forms=0, throttled=1, retry_after=1) as site:
+            started = time.monotonic()
+            response = asyncio.run(get_home(site.url))
+            elapsed = time.monotonic() - started
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(elapsed, 0.9)
+        [host_stats] = scheduler.stats().values()
+        self.assertEqual((host_stats['requests'], host_stats['throttled']), (2, 1))
+
+    def test_async_throttled_posts_are_sent_again(self):
+        from utils.async_utils import AsyncWebIO, AsyncHostScheduler
+
+        async def post_comment(url, scheduler):
+            web_io = AsyncWebIO({}, 4, retries=2, backoff_factor=0, scheduler=scheduler)
+            await web_io.open()
+            try:
+                return await web_io.get_page_response(url, 'post', False, {'comment': '<b>hi</b>'})
+            finally:
+                await web_io.close()
+        for scheduler in (AsyncHostScheduler(), None):
+            with SyntheticSite(pages=1, forms=0, throttled=1, retry_after=0) as site:
+                response = asyncio.run(post_comment(site.url + 'form0', scheduler))
+                self.assertEqual(site.stats.as_dict()['throttled'], 1)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('<b>hi</b>', response.text)
+
+
+class TestAsyncEngine(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def web_io(self, concurrency=4, **kwargs):
+        from utils.async_utils import AsyncWebIO
+        kwargs.setdefault('backoff_factor', 0)
+        return AsyncWebIO({}, concurrency, **kwargs)
+
+    def run_with(self, web_io, coroutine):
+        async def run():
+            await web_io.open()
+            try:
+                return await coroutine()
+            finally:
+                await web_io.close()
+        return asyncio.run(run())
+
+    def test_reuses_pooled_connections(self):
+        web_io = self.web_io()
+
+        async def get_home_ten_times():
+            return [(await web_io.get_website(site.url)).status_code for _ in range(10)]
+        with SyntheticSite(pages=1, forms=0) as site:
+            self.assertEqual(self.run_with(web_io, get_home_ten_times), [200] * 10)
+        self.assertEqual((web_io.pool_stats().requests_sent,
+                          web_io.pool_stats().connections_opened), (10, 1))
+
+    def test_retries_failed_requests(self):
+        web_io = self.web_io(retries=2)
+        with SyntheticSite(pages=1, forms=0, error_rate=1) as site:
+            self.assertIsNone(self.run_with(web_io, lambda: web_io.get_website(site.url)))
+            self.assertEqual(site.stats.as_dict()['errors'], 3)
+        self.assertEqual(web_io.pool_stats().requests_sent, 3)
+
+    def test_no_more_requests_in_flight_than_concurrency(self):
+        def elapsed_for_six(concurrency):
+            web_io = self.web_io(concurrency)
+
+            async def get_home_six_times():
+                started = time.monotonic()
+                await asyncio.gather(*(web_io.get_website(site.url) for _ in range(6)))
+                return time.monotonic() - started
+            return self.run_with(web_io, get_home_six_times)
+        with SyntheticSite(pages=1, forms=0, latency=0.1) as site:
+            self.assertGreaterEqual(elapsed_for_six(2), 0.3)
+            self.assertLess(elapsed_for_six(6), 0.3)
+
+    def scan(self, frontier, site, watch=None):
+        """Scan site with an AsyncScanner, on another thread so a scan which
+        never ends fails the test instead of hanging it. Watch, if given, is
+        a coroutine function run on the loop of the scan until it ends."""
+        from scanner import AsyncScanner
+        result_writer = ResultWriter(site.url, os.path.join(self.directory.name, 'xss.db'))
+        result_writer.start()
+        stats = ScanStats()
+        corpus = PayloadCorpus('xss_tests', ('<script>',), (), (), (b'upload',), {})
+        scanner = AsyncScanner(self.web_io(), result_writer, frontier, 4, corpus,
+                               verify='reflection', stats=stats)
+        frontier.put(URL(site.url))
+        frontier.checkpoint()
+        async def run():
+            watcher = asyncio.ensure_future(watch()) if watch is not None else None
+            try:
+                await scanner.scan()
+            finally:
+                if watcher is not None:
+                    watcher.cancel()
+        thread = threading.Thread(target=asyncio.run, args=(run(),), daemon=True)
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive(), "the scan didn't end")
+        frontier.close()
+        result_writer.close()
+        return stats.snapshot()['counters'], result_writer.rows_written
+
+    def reachable_pages(self, site):
+        reachable, to_visit = {0}, [0]
+        while to_visit:
+            for link in site._links[to_visit.pop()]:
+                if link not in reachable:
+                    reachable.add(link)
+                    to_visit.append(link)
+        return len(reachable)
+
+    def test_scans_until_the_frontier_drains(self):
+        with SyntheticSite(pages=30, fanout=3) as site:
+            frontier = Frontier.open(os.path.join(self.directory.name, 'frontier.db'))
+            counters, xss_written = self.scan(frontier, site)
+            pages = self.reachable_pages(site)
+            # the home page is both / and /page0
+            self.assertEqual(site.stats.as_dict()['page_requests'], pages + 1)
+        self.assertEqual(counters['pages'], pages + 1)
+        self.assertEqual(xss_written, pages + 1)  # the comment of the shared form 0, once a page
+        self.assertEqual(frontier.unfinished_tasks, 0)
+
+    def test_a_slow_frontier_does_not_stall_the_loop(self):
+        class SlowFrontier(Frontier):
+            def put(self, url):
+                time.sleep(0.2)  # as if spilling to a busy disk
+                return super().put(url)
+        stalls = []
+
+        async def watch():
+            while True:
+                started = time.monotonic()
+                await asyncio.sleep(0.01)
+                stalls.append(time.monotonic() - started)
+        with SyntheticSite(pages=10, fanout=3) as site:
+            frontier = SlowFrontier.open(os.path.join(self.directory.name, 'frontier.db'))
+            counters, _ = self.scan(frontier, site, watch)
+            self.assertEqual(counters['pages'], self.reachable_pages(site) + 1)
+        self.assertLess(max(stalls), 0.15)
+
+    def test_scans_until_a_shared_frontier_drains(self):
+        with SyntheticSite(pages=30, fanout=3) as site:
+            frontier = SharedFrontier.open(os.path.join(self.directory.name, 'shared.db'),
+                                           batch=4, sync_interval=0.05)
+            counters, xss_written = self.scan(frontier, site)
+            self.assertEqual(counters['pages'], self.reachable_pages(site) + 1)
@@ -0,0 +1,231 @@
+import asyncio
+import time
+import aiohttp
+from urllib.parse import urlsplit
+from logs.logger import logger
+from utils.utils import (PoolStats, HostLimit, BodyReader, WebResponse, THROTTLE_STATUSES,
+                         MAX_BODY_SIZE, MAX_RETRY_AFTER, CHUNK_SIZE, retry_after_seconds,
+                         retried_statuses)
+
+"""The asyncio counterpart of utils.WebIO. Only imported when the scanner
+is started with --engine async, so aiohttp is not needed otherwise."""
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+class AsyncHostScheduler:
+    """The HostScheduler of utils, for coroutines: every request waits until
+    its host has room for it, as decided by the HostLimit of the host."""
+    def __init__(self, initial=2, minimum=1, maximum=10):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self._hosts = {}
+        self._changed = None
+
+    def host_limit(self, host):
+        host_limit = self._hosts.get(host)
+        if host_limit is None:
+            host_limit = self._hosts[host] = HostLimit(min(self.initial, self.maximum),
+                                                       self.minimum, self.maximum)
+        return host_limit
+
+    async def acquire(self, host):
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        async with self._changed:
+            host_limit = self.host_limit(host)
+            while True:
+                wait_time = host_limit.wait_time(time.monotonic())
+                if wait_time == 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._changed.wait(), wait_time)
+                except asyncio.TimeoutError:
+                    pass
+            host_limit.in_flight += 1
+
+    async def release(self, host, latency, status, retry_after=None):
+        async with self._changed:
+            self.host_limit(host).on_response(time.monotonic(), latency, status, retry_after)
+            self._changed.notify_all()
+
+    def stats(self):
+        return {host: host_limit.as_dict() for host, host_limit in self._hosts.items()}
+
+class AsyncWebIO:
+    """A class to handle all requests to the web from inside an event loop.
+    Mirrors the WebIO interface, but every method is a coroutine. At most
+    concurrency requests will be in flight at the same time."""
+    def __init__(self, cookies, concurrency, pool_size=10, retries=2,
+                 backoff_factor=0.3, timeout=5, scheduler=None, stats=None,
+                 max_body_size=MAX_BODY_SIZE):
+        """Hold the cookies, the limit of in-flight requests and the same
+        pooling and retry policy WebIO has. The session is created by open(),
+        as it must live inside the running loop. If an AsyncHostScheduler is
+        given, every request waits for it to let it through, and if a
+        ScanStats is given, every request is timed on it. Bodies are read
+        as WebIO reads them."""
+        self.cookies = cookies
+        self.scheduler = scheduler
+        self.stats = stats
+        self.concurrency = concurrency
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.max_body_size = max_body_size
+        self._requests_sent = 0
+        self._connections_opened = 0
+        self._semaphore = None
+        self._session = None
+
+    async def open(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.pool_size)
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._count_request)
+        trace_config.on_connection_create_end.append(self._count_connection)
+        self._session = aiohttp.ClientSession(cookies=self.cookies,
+                                              connector=connector,
+                                              trace_configs=[trace_config],
+                                              timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def _count_request(self, session, context, params):
+        self._requests_sent += 1
+
+    async def _count_connection(self, session, context, params):
+        self._connections_opened += 1
+
+    def pool_stats(self):
+        """Return a PoolStats, just like WebIO.pool_stats."""
+        return PoolStats(self._requests_sent, self._connections_opened)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def safe_website_io(self, method, url, files=None, page=False, **kwargs):
+        """All requests finally end up here. Same contract as
+        WebIO.safe_website_io: never raise because of the network, return
+        None instead. Failed connections, idempotent requests answered
+        with one of RETRY_STATUSES and any request answered with one of
+        THROTTLE_STATUSES are retried with an exponential backoff,
+        or what Retry-After asks up to MAX_RETRY_AFTER; but, as on WebIO,
+        429 and 503 are left to the scheduler if there is one. files works
+        like the requests argument of the same name, and page is passed on
+        to the BodyReader of the response."""
+        if self.scheduler is None and self.stats is None:
+            return await self._website_io(method, url, files, page, **kwargs)
+        host = urlsplit(url).netloc
+        if self.scheduler is None:
+            return await self._timed_website_io(host, method, url, files, page, **kwargs)
+        for retry in range(self.retries + 1):
+            await self.scheduler.acquire(host)
+            started = time.monotonic()
+            response = None
+            try:
+                response = await self._timed_website_io(host, method, url, files, page, **kwargs)
+            finally:
+                status = response.status_code if response is not None else None
+                retry_after = response.retry_after if response is not None else None
+                await self.scheduler.release(host, time.monotonic() - started, status,
+                                             retry_after_seconds(retry_after))
+            if status not in THROTTLE_STATUSES:
+                break
+        return response
+
+    async def _timed_website_io(self, host, method, url, files, page, **kwargs):
+        if self.stats is None:
+            return await self._website_io(method, url, files, page, **kwargs)
+        with self.stats.timer('request', host):
+            return await self._website_io(method, url, files, page, **kwargs)
+
+    async def _website_io(self, method, url, files, page, **kwargs):
+        retry_statuses = retried_statuses(self.scheduler)
+        wait = 0
+        async with self._semaphore:
+            for retry in range(self.retries + 1):
+                if retry:
+                    await asyncio.sleep(wait)
+                if files is not None:
+                    # a FormData can only be sent once
+                    kwargs['data'] = self._as_form_data(files)
+                try:
+                    async with self._session.request(method, url, **kwargs) as response:
+                        response = await self._read(response, page)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    wait = self.backoff_factor * 2 ** retry
+                    continue
+                except aiohttp.ClientError:
+                    break
+                if response.status_code in retry_statuses and (
+                        method in IDEMPOTENT_METHODS or response.status_code in THROTTLE_STATUSES):
+                    if retry < self.retries:
+                        retry_after = retry_after_seconds(response.retry_after)
+                        wait = (self.backoff_factor * 2 ** retry if retry_after is None
+                                else min(retry_after, MAX_RETRY_AFTER))
+                        continue
+                return response
+        logger.warning("Could not connect to the URL %s.", url)
+        return None
+
+    async def _read(self, response, page):
+        """Stream the body of response through a BodyReader, as WebIO._read
+        does, into a WebResponse. Leaving the response before the end closes
+        the connection."""
+        body_reader = BodyReader(self.max_body_size, page)
+        if body_reader.wants_body(response.status, response.headers):
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                if not body_reader.feed(chunk):
+                    break
+        return WebResponse(response.status, body_reader.body, response.headers,
+                           response.charset or 'utf-8', body_reader)
+
+    async def get_website_as_string(self, url):
+        """Get the website as a string, or None if it was not possible."""
+        website = await self.get_website(url)
+        if website:
+            return website.text
+
+    async def get_website(self, url, headers=None):
+        """Get the response of the website, or None if it was not possible
+        or it is not an HTML page. Same as WebIO.get_website."""
+        website = await self.safe_website_io('GET', url, page=True, headers=headers)
+        if website is not None and website.body_reader.skipped:
+            website.body_reader.count_skipped(self.stats, website.headers)
+            return None
+        if website:
+            return website
+
+    async def get_page_response(self, base_url, method, is_upload, payload):
+        """Gets the base_url response when a request with method method
+        and payload payload is given."""
+        if method == 'get':
+            response = await self.safe_website_io('GET', base_url, params=payload)
+        elif method == 'post' and is_upload:
+            response = await self.safe_website_io('POST', base_url, files=payload)
+        elif method == 'post' and not is_upload:
+            response = await self.safe_website_io('POST', base_url, data=payload)
+        else:
+            response = None
+        return response
+
+    async def was_request_accepted(self, url, method, is_upload, payload):
+        """Return True if the the url url gave a status code between 200 and 300
+        when requesting via the method method and payload payload, None if
+        the host was still throttling it when the retries ran out. Else,
+        return False.
+        """
+        response = await self.get_page_response(url, method, is_upload, payload)
+        if response is not None and response.status_code in THROTTLE_STATUSES:
+            return None
+        return bool(response and 200 <= response.status_code < 300)
+
+    def _as_form_data(self, payload):
+        """aiohttp has no files= argument: uploads are multipart fields
+        with a filename, which is what requests does for us on WebIO."""
+        form_data = aiohttp.FormData()
+        for name, content in payload.items():
+            form_data.add_field(name, content, filename=name or 'file')
+        return form_data
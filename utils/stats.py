@@ -0,0 +1,245 @@
+import collections
+import http.server
+import json
+import math
+import os
+import socketserver
+import threading
+import time
+from logs.logger import logger
+
+"""Where time goes while a scan runs. Every stage a website goes through is
+timed: fetch, parse, attacks (building the attack information), detect
+(sending the payloads) and db_write, plus every single request, which is
+also kept per host. Everything else worth knowing about a running scan
+(the frontier, the connection pools, the forms, the host limits) is plugged
+in as a source, so a snapshot has all of it in one place.
+
+It is meant to be always on: timing something costs two lock acquisitions
+and a few additions, nothing compared to a request.
+"""
+
+class Histogram:
+    """Counts of durations in buckets growing by a fourth of an octave from
+    0.1ms, so percentiles are off by 19% at most whatever the durations."""
+    MINIMUM = 0.0001
+    RATIO = 2 ** 0.25
+    BUCKETS = 100  # up to about an hour
+    __slots__ = ('counts', 'count', 'total', 'maximum')
+
+    def __init__(self):
+        self.counts = [0] * Histogram.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def observe(self, seconds):
+        if seconds <= Histogram.MINIMUM:
+            bucket = 0
+        else:
+            bucket = min(int(math.ceil(math.log(seconds / Histogram.MINIMUM, Histogram.RATIO))),
+                         Histogram.BUCKETS - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def percentile(self, fraction):
+        """The upper bound of the bucket holding the fraction percentile."""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(Histogram.MINIMUM * Histogram.RATIO ** bucket, self.maximum)
+        return self.maximum
+
+    def as_dict(self):
+        milliseconds = lambda seconds: round(seconds * 1000, 2)
+        return dict(count=self.count,
+                    total_s=round(self.total, 3),
+                    mean_ms=milliseconds(self.total / self.count if self.count else 0),
+                    p50_ms=milliseconds(self.percentile(0.5)),
+                    p90_ms=milliseconds(self.percentile(0.9)),
+                    p99_ms=milliseconds(self.percentile(0.99)),
+                    max_ms=milliseconds(self.maximum))
+
+class _Timer:
+    """What ScanStats.timer returns. A class instead of a contextmanager
+    generator, which is several times slower to enter and exit."""
+    __slots__ = ('stats', 'stage', 'host', 'started')
+
+    def __init__(self, stats, stage, host):
+        self.stats = stats
+        self.stage = stage
+        self.host = host
+
+    def __enter__(self):
+        self.stats._start(self.stage)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats._finish(self.stage, time.perf_counter() - self.started, self.host)
+
+class ScanStats:
+    """Thread-safe counters and histograms of a scan. Use timer around each
+    stage, count for anything worth counting and add_source for stats kept
+    somewhere else."""
+    def __init__(self):
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._stages = collections.defaultdict(Histogram)
+        self._hosts = collections.defaultdict(lambda: collections.defaultdict(Histogram))
+        self._in_flight = collections.Counter()
+        self._counters = collections.Counter()
+        self._sources = collections.OrderedDict()
+
+    def timer(self, stage, host=None):
+        """A context manager timing stage, and stage on host if given. It
+        works on coroutines too: the time awaited is part of the stage."""
+        return _Timer(self, stage, host)
+
+    def observe(self, stage, seconds, host=None):
+        with self._lock:
+            self._observe(stage, seconds, host)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def add_source(self, name, source):
+        """Source is called with no arguments on every snapshot and must
+        return something json can dump, which goes under name."""
+        self._sources[name] = source
+
+    def _start(self, stage):
+        with self._lock:
+            self._in_flight[stage] += 1
+
+    def _finish(self, stage, seconds, host):
+        with self._lock:
+            self._in_flight[stage] -= 1
+            self._observe(stage, seconds, host)
+
+    def _observe(self, stage, seconds, host):
+        self._stages[stage].observe(seconds)
+        if host is not None:
+            self._hosts[host][stage].observe(seconds)
+
+    def snapshot(self):
+        """Everything known about the scan, as a dict json can dump."""
+        with self._lock:
+            snapshot = collections.OrderedDict([
+                ('elapsed_s', round(time.monotonic() - self.started, 3)),
+                ('counters', dict(self._counters)),
+                ('in_flight', {stage: n for stage, n in self._in_flight.items() if n}),
+                ('stages', {stage: histogram.as_dict()
+                            for stage, histogram in self._stages.items()}),
+                ('hosts', {host: {stage: histogram.as_dict()
+                                  for stage, histogram in stages.items()}
+                           for host, stages in self._hosts.items()}),
+            ])
+        # sources have locks of their own, which we must not take while holding ours
+        for name, source in list(self._sources.items()):
+            try:
+                snapshot[name] = source()
+            except Exception:
+                logger.exception("Could not get the {0} stats.".format(name))
+        return snapshot
+
+    def progress_line(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        counters = snapshot['counters']
+        requests = snapshot['stages'].get('request', {}).get('count', 0)
+        elapsed = max(snapshot['elapsed_s'], 0.001)
+        frontier = snapshot.get('frontier', {})
+        return ("[{elapsed:.0f}s] {pages} pages, {requests} requests ({rate:.1f}/s), "
+                "{queued} queued, {in_flight} requests in flight, {xss} XSS found".format(
+                    elapsed=elapsed, pages=counters.get('pages', 0), requests=requests,
+                    rate=requests / elapsed, queued=frontier.get('queued', 0),
+                    in_flight=snapshot['in_flight'].get('request', 0),
+                    xss=counters.get('xss_found', 0)))
+
+def write_snapshot(snapshot, path):
+    """Write snapshot to path as json. Readers never see half a file."""
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as snapshot_file:
+        json.dump(snapshot, snapshot_file, indent=2)
+    os.replace(temporary_path, path)
+
+class StatsReporter(threading.Thread):
+    """Every interval seconds, print and log a progress line (unless show
+    is False) and, if path is given, dump a snapshot there. Stop it when
+    the scan is over to get the last snapshot written."""
+    def __init__(self, stats, interval=10, path=None, show=True):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stats = stats
+        self.interval = interval
+        self.path = path
+        self.show = show
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.report(self.show)
+
+    def report(self, show=True):
+        snapshot = self.stats.snapshot()
+        if show:
+            line = self.stats.progress_line(snapshot)
+            logger.info(line)
+            print(line)
+        if self.path:
+            try:
+                write_snapshot(snapshot, self.path)
+            except OSError:
+                logger.exception("Could not write the stats to {0}.".format(self.path))
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+        self.report(show=False)
+
+class StatsServer:
+    """Serve snapshots as json on http://127.0.0.1:port/, on a thread of its
+    own. Only on localhost: they say a lot about what is being scanned."""
+    def __init__(self, stats, port):
+        self.stats = stats
+        self._server = _ThreadingServer(('127.0.0.1', port), _handler_for(stats))
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+def _handler_for(stats):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = json.dumps(stats.snapshot(), indent=2).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+class _ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
@@ -1,49 +1,471 @@
-from functools import wraps
+from functools import wraps, partial
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
 from logs.logger import logger
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+import threading
+import time
 import requests
 
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+THROTTLE_STATUSES = (429, 503)
+MAX_RETRY_AFTER = 10  # seconds a retry waits for a Retry-After, holding its connection
+
+MAX_BODY_SIZE = 5 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+HTML_TYPES = ('text/html', 'application/xhtml+xml')
+BINARY_SIGNATURES = (b'%PDF', b'PK\x03\x04', b'\x89PNG', b'GIF8', b'\xff\xd8\xff', b'\x1f\x8b',
+                     b'RIFF', b'OggS', b'ID3', b'Rar!', b'7z\xbc\xaf', b'\x7fELF')
+
+def content_type(headers):
+    """The media type of the Content-Type header, lowercased, or ''."""
+    return (headers.get('Content-Type') or '').split(';')[0].strip().lower()
+
+def looks_binary(first_bytes):
+    """Whether the first bytes of a body are those of something which is
+    not text: a known file signature, or a NUL byte, which no HTML has."""
+    return first_bytes.startswith(BINARY_SIGNATURES) or b'\x00' in first_bytes[:1024]
+
+class BodyReader:
+    """Reads a response body chunk by chunk, so it never holds more than
+    max_size bytes of it, whatever the server sends. Pages (what the
+    crawler fetches to parse) are read only if they are HTML: not at all if
+    their Content-Type says otherwise, no further than the first chunk if
+    it looks binary, and thrown away if they go over max_size. Any other
+    body is only cut at max_size. Skipped says why a page was skipped, if
+    it was, and truncated whether a body was cut."""
+    def __init__(self, max_size=MAX_BODY_SIZE, page=False):
+        self.max_size = max_size
+        self.page = page
+        self.skipped = None
+        self.truncated = False
+        self.bytes_read = 0
+        self._body = bytearray()
+
+    def wants_body(self, status_code, headers):
+        """Whether the body of a response with those headers is worth reading."""
+        media_type = content_type(headers)
+        if self.page and status_code < 400 and media_type and media_type not in HTML_TYPES:
+            self.skipped = 'content_type'
+        return self.skipped is None
+
+    def feed(self, chunk):
+        """Add the next chunk of the body. Return False if no more is wanted."""
+        if self.page and not self.bytes_read and looks_binary(chunk):
+            self.skipped = 'binary'
+        self.bytes_read += len(chunk)
+        if self.skipped:
+            return False
+        self._body += chunk
+        if len(self._body) > self.max_size:
+            if self.page:
+                self.skipped = 'too_large'
+            self.truncated = True
+            del self._body[self.max_size:]
+            return False
+        return True
+
+    @property
+    def body(self):
+        return b'' if self.skipped else bytes(self._body)
+
+    def skipped_bytes(self, headers):
+        """The size of the skipped page: what its Content-Length says, if
+        anything, or what was read of it."""
+        try:
+            return max(int(headers.get('Content-Length')), self.bytes_read)
+        except (TypeError, ValueError):
+            return self.bytes_read
+
+    def count_skipped(self, stats, headers):
+        if self.skipped and stats is not None:
+            stats.count('pages_skipped_' + self.skipped)
+            stats.count('bytes_skipped', self.skipped_bytes(headers))
+
+class WebResponse:
+    """What is left of a response once its body has been read by a
+    BodyReader, whichever library sent it. The connection goes back to the
+    pool as soon as this is created. Content is the body as bytes, only
+    decoded with encoding the first time text is asked for. Body_reader is
+    the BodyReader it was read with."""
+    def __init__(self, status_code, content, headers=None, encoding='utf-8', body_reader=None):
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding
+        self.headers = headers if headers is not None else {}
+        self.retry_after = self.headers.get('Retry-After')
+        self.body_reader = body_reader if body_reader is not None else BodyReader()
+        self._text = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            try:
+                self._text = self.content.decode(self.encoding, 'replace')
+            except LookupError:  # a charset nobody heard of
+                self._text = self.content.decode('utf-8', 'replace')
+        return self._text
+
+    @property
+    def truncated(self):
+        """Whether the body was cut at the max_size of its BodyReader:
+        what was after it is unknown."""
+        return self.body_reader.truncated
+
+    def __bool__(self):
+        """Like requests: True if the status code is under 400."""
+        return self.status_code < 400
+
+class PoolStats:
+    """How well the connection pools are doing. Every request which did not
+    need a new connection is a TCP (and maybe TLS) handshake we avoided."""
+    def __init__(self, requests_sent, connections_opened):
+        self.requests_sent = requests_sent
+        self.connections_opened = connections_opened
+
+    @property
+    def handshakes_avoided(self):
+        return max(self.requests_sent - self.connections_opened, 0)
+
+    @property
+    def reuse_ratio(self):
+        if not self.requests_sent:
+            return 0.0
+        return self.handshakes_avoided / self.requests_sent
+
+    def as_dict(self):
+        return dict(requests_sent=self.requests_sent,
+                    connections_opened=self.connections_opened,
+                    handshakes_avoided=self.handshakes_avoided,
+                    reuse_ratio=round(self.reuse_ratio, 4))
+
+    def __str__(self):
+        return ("{0} requests over {1} connections: {2} handshakes avoided "
+                "(reuse ratio {3:.2%})".format(self.requests_sent, self.connections_opened,
+                                               self.handshakes_avoided, self.reuse_ratio))
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """An HTTPAdapter which counts requests sent and connections opened.
+    urllib3 reconnects a pooled connection the server closed without
+    creating a new one, so the pools' own counters can't be trusted: we
+    count the connect() calls themselves."""
+    def __init__(self, *args, **kwargs):
+        self._lock = threading.Lock()
+        self._requests_sent = 0
+        self._connections_opened = 0
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': self._counting_pool(HTTPConnectionPool),
+            'https': self._counting_pool(HTTPSConnectionPool),
+        }
+
+    def _counting_pool(self, pool_class):
+        adapter = self
+
+        class CountingConnection(pool_class.ConnectionCls):
+            def connect(self):
+                with adapter._lock:
+                    adapter._connections_opened += 1
+                return super().connect()
+
+            def request(self, *args, **kwargs):
+                with adapter._lock:
+                    adapter._requests_sent += 1
+                return super().request(*args, **kwargs)
+
+        return type(pool_class.__name__, (pool_class,), {'ConnectionCls': CountingConnection})
+
+    def pool_stats(self):
+        with self._lock:
+            return PoolStats(self._requests_sent, self._connections_opened)
+
+def retry_after_seconds(value):
+    """Parse a Retry-After header, which is either seconds or an HTTP date.
+    Return None if there is no (valid) header."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+class CappedRetry(Retry):
+    """A Retry which waits as long as a Retry-After header asks, up to
+    MAX_RETRY_AFTER seconds: the request holds a connection (and a thread)
+    meanwhile, and a server asking for an hour would get it."""
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, MAX_RETRY_AFTER)
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        """A host answering 429 or 503 didn't do what it was asked, so those
+        are retried whatever the method: POSTs and uploads too."""
+        if status_code in THROTTLE_STATUSES and status_code in (self.status_forcelist or ()):
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+def retried_statuses(scheduler):
+    """The statuses retried right away. With a scheduler, 429 and 503 are
+    left to it: the host is paused as long as it asks, and the request is
+    sent again once it is not, without holding a connection meanwhile."""
+    if scheduler is None:
+        return RETRY_STATUSES
+    return tuple(status for status in RETRY_STATUSES if status not in THROTTLE_STATUSES)
+
+class HostLimit:
+    """How many requests a host gets at the same time, adjusted AIMD-style
+    as TCP does: it goes up as requests succeed, and it is cut when the
+    host throttles us (429 or 503), when requests fail or time out, or when
+    it answers much slower than it used to. A Retry-After header pauses
+    the host altogether for as long as it asks."""
+    def __init__(self, initial=2, minimum=1, maximum=10, decrease=0.5,
+                 slow_factor=4):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.slow_factor = slow_factor
+        self.in_flight = 0
+        self.paused_until = 0  # time.monotonic() before which nothing is sent
+        self.slow_start = True  # double the limit every round until the first cut
+        self.latency = None  # moving average, in seconds
+        self.fastest = None
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self._last_cut = 0
+
+    def wait_time(self, now):
+        """0 if a request can be sent now, else how long to wait for it.
+        None means until a request in flight is done."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.in_flight >= int(self.limit):
+            return None
+        return 0
+
+    def on_response(self, now, latency, status, retry_after=None):
+        """Record the outcome of a request. status is None if it failed
+        without a response."""
+        self.in_flight -= 1
+        self.requests += 1
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+        if status is None or status in THROTTLE_STATUSES:
+            if status is None:
+                self.errors += 1
+            else:
+                self.throttled += 1
+            self._cut(now, self.decrease)
+            return
+        self.fastest = latency if self.fastest is None else min(self.fastest, latency)
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if latency > self.slow_factor * self.fastest and latency > 0.1:
+            self._cut(now, 0.9)  # getting slow: back off gently
+        elif self.slow_start:
+            self.limit = min(self.limit + 1, self.maximum)
+        else:
+            self.limit = min(self.limit + 1 / self.limit, self.maximum)
+
+    def _cut(self, now, factor):
+        """Cut the limit, at most once per round trip: the failures of
+        requests sent before the previous cut are not news."""
+        self.slow_start = False
+        if now - self._last_cut < (self.latency or 0):
+            return
+        self._last_cut = now
+        self.limit = max(self.limit * factor, self.minimum)
+
+    def as_dict(self):
+        return dict(limit=int(self.limit), in_flight=self.in_flight,
+                    latency_ms=round(self.latency * 1000, 1) if self.latency is not None else None,
+                    requests=self.requests, errors=self.errors, throttled=self.throttled,
+                    paused=self.paused_until > time.monotonic())
+
+class HostScheduler:
+    """Sits in front of every request of a WebIO and makes it wait until its
+    host has room for it, as decided by the HostLimit of the host."""
+    def __init__(self, initial=2, minimum=1, maximum=10):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self._hosts = {}
+        self._changed = threading.Condition()
+
+    def host_limit(self, host):
+        """The HostLimit of host, created if needed. Call with the lock held."""
+        host_limit = self._hosts.get(host)
+        if host_limit is None:
+            host_limit = self._hosts[host] = HostLimit(min(self.initial, self.maximum),
+                                                       self.minimum, self.maximum)
+        return host_limit
+
+    def acquire(self, host):
+        with self._changed:
+            host_limit = self.host_limit(host)
+            while True:
+                wait_time = host_limit.wait_time(time.monotonic())
+                if wait_time == 0:
+                    break
+                self._changed.wait(wait_time)
+            host_limit.in_flight += 1
+
+    def release(self, host, latency, status, retry_after=None):
+        with self._changed:
+            self.host_limit(host).on_response(time.monotonic(), latency, status, retry_after)
+            self._changed.notify_all()
+
+    def stats(self):
+        with self._changed:
+            return {host: host_limit.as_dict() for host, host_limit in self._hosts.items()}
+
 class WebIO:
-    """A class to handle all requests to the web."""
-    def __init__(self, cookies):
-        """Hold the cookies given as parameter."""
+    """A class to handle all requests to the web. Requests go through one
+    pooled, keep-alive session, so the hundreds of payloads sent to the same
+    form action share a handful of connections."""
+    def __init__(self, cookies, pool_size=10, retries=2, backoff_factor=0.3, timeout=5,
+                 scheduler=None, stats=None, max_body_size=MAX_BODY_SIZE):
+        """Hold the cookies given as parameter and create the session.
+        pool_size is the amount of connections kept alive per host. Threads
+        asking for more than that will wait for one to be free instead of
+        opening (and throwing away) extra connections. Failed connections,
+        idempotent requests answered with one of RETRY_STATUSES and any
+        request answered with one of THROTTLE_STATUSES are retried up to
+        retries times, waiting backoff_factor * 2 ** retry
+        seconds in between, or what Retry-After asks up to MAX_RETRY_AFTER.
+        If a HostScheduler is given, every request waits for it to let it
+        through, and it handles 429 and 503: see retried_statuses. If a
+        ScanStats (utils/stats.py) is given,
+        every request is timed on it, as the request stage of its host.
+        Bodies are streamed and never read past max_body_size bytes: see
+        BodyReader."""
         self.cookies = cookies
+        self.timeout = timeout
+        self.scheduler = scheduler
+        self.stats = stats
+        self.max_body_size = max_body_size
+        self.retries = retries
+        retry = CappedRetry(total=retries, backoff_factor=backoff_factor,
+                            status_forcelist=retried_statuses(scheduler), raise_on_status=False,
+                            respect_retry_after_header=scheduler is None)
+        self._adapter = CountingHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                            pool_block=True, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+
+    def pool_stats(self):
+        """Return a PoolStats for every request sent so far."""
+        return self._adapter.pool_stats()
 
     def safe_website_io(self, func, url, *args, **kwargs):
         """All requests finally end up here. We don't want our Workers
         to crash if there was a problem accesing the URL, so try/except that
         and return None. If everything went fine, return whatever
-        func would have returned."""
+        func would have returned. A request the host throttled is sent
+        again once the scheduler lets it, up to retries times, whatever its
+        method: the host didn't do it."""
+        if self.scheduler is None and self.stats is None:
+            return self._website_io(func, url, *args, **kwargs)
+        host = urlsplit(url).netloc
+        if self.scheduler is None:
+            return self._timed_website_io(host, func, url, *args, **kwargs)
+        for retry in range(self.retries + 1):
+            self.scheduler.acquire(host)
+            started = time.monotonic()
+            response = None
+            try:
+                response = self._timed_website_io(host, func, url, *args, **kwargs)
+            finally:
+                status = response.status_code if response is not None else None
+                retry_after = response.headers.get('Retry-After') if response is not None else None
+                self.scheduler.release(host, time.monotonic() - started, status,
+                                       retry_after_seconds(retry_after))
+            if status not in THROTTLE_STATUSES:
+                break
+        return response
+
+    def _timed_website_io(self, host, func, url, *args, **kwargs):
+        if self.stats is None:
+            return self._website_io(func, url, *args, **kwargs)
+        with self.stats.timer('request', host):
+            return self._website_io(func, url, *args, **kwargs)
+
+    def _website_io(self, func, url, *args, **kwargs):
         try:
-            return func(url, cookies=self.cookies, timeout=2, *args, **kwargs)
+            return func(url, cookies=self.cookies, timeout=self.timeout, *args, **kwargs)
         except requests.exceptions.RequestException:
-            logger.warning("Could not connect to the URL {0}. ".format(url))
+            logger.warning("Could not connect to the URL %s.", url)
             return None
 
+    def _read(self, send, url, page=False, **kwargs):
+        """Send a request with send, a method of the session, and stream its
+        body through a BodyReader. Whatever the reader didn't want is never
+        downloaded: the connection is closed instead. Return a WebResponse
+        of what the reader kept."""
+        response = send(url, stream=True, **kwargs)
+        body_reader = BodyReader(self.max_body_size, page)
+        with response:
+            if body_reader.wants_body(response.status_code, response.headers):
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    if not body_reader.feed(chunk):
+                        break
+        return WebResponse(response.status_code, body_reader.body, response.headers,
+                           response.encoding or 'utf-8', body_reader)
+
     def get_website_as_string(self, url):
         """Get the website as a string, or None if it was not possible."""
-        website = self.safe_website_io(requests.get, url)
+        website = self.get_website(url)
         if website:
             return website.text
 
+    def get_website(self, url, headers=None):
+        """Get the response of the website, or None if it was not possible
+        or it is not an HTML page (see BodyReader). Pass If-None-Match or
+        If-Modified-Since on headers to make it a conditional GET, which may
+        get a 304 with an empty body."""
+        website = self.safe_website_io(partial(self._read, self._session.get, page=True),
+                                       url, headers=headers)
+        if website is not None and website.body_reader.skipped:
+            website.body_reader.count_skipped(self.stats, website.headers)
+            return None
+        if website:
+            return website
+
     def get_page_response(self, base_url, method, is_upload, payload):
         """Gets the base_url response when a request with method method
         and payload payload is given."""
         if method == 'get':
-            response = self.safe_website_io(requests.get, base_url, params=payload)
+            response = self.safe_website_io(partial(self._read, self._session.get),
+                                            base_url, params=payload)
         elif method == 'post' and is_upload:
-            response = self.safe_website_io(requests.post, base_url, files=payload)
+            response = self.safe_website_io(partial(self._read, self._session.post),
+                                            base_url, files=payload)
         elif method == 'post' and not is_upload:
-            response = self.safe_website_io(requests.post, base_url, data=payload)
+            response = self.safe_website_io(partial(self._read, self._session.post),
+                                            base_url, data=payload)
         else:
             response = None
         return response
 
     def was_request_accepted(self, url, method, is_upload, payload):
         """Return True if the the url url gave a status code between 200 and 300
-        when requesting via the method method and payload payload. Else,
-        return False.
+        when requesting via the method method and payload payload. Return
+        None if the host was still throttling it when the retries ran out:
+        nobody knows. Else, return False.
         """
         response = self.get_page_response(url, method, is_upload, payload)
+        if response is not None and response.status_code in THROTTLE_STATUSES:
+            return None
         if response and 200 <= response.status_code < 300:
             request_acceped = True
         else: